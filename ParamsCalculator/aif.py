@@ -2,17 +2,163 @@ import os
 import torch
 import logging
 import numpy as np
-from scipy import signal
 import SimpleITK as sitk
 from builtins import object
 
+from precision import compute_dtype
+from ParamsCalculator.mask import PackedVolume
+
 # Arteries Input FUnction (AIF) computation
 
-def cal(raw_perf, sitk_info, config, device):
-    pass
+
+def manual(ctc, packed, voxels):
+    '''
+    AIF averaged over manually picked arterial voxels
+    ctc: packed (n_voxel, time) with its mask.PackedVolume
+    voxels: flattened [slice, row, column] triplets
+    return: aif # (time), rows of the voxels in ctc
+    '''
+    if len(voxels) == 0 or len(voxels) % 3 != 0:
+        raise ValueError('AIF voxels should be given as [slice, row, column] triplets, got %s' % voxels)
+    rows = packed.rows(voxels)
+    if (rows < 0).any():
+        raise ValueError('AIF voxels outside the brain mask: %s' % packed.voxels(rows[rows < 0]).tolist())
+    return ctc[rows.to(ctc.device)].mean(dim = 0), rows
+
+
+def features(ctc):
+    '''
+    Per-voxel curve features in one vectorized pass, in time point units
+    ctc: (n_voxel, time)
+    return: peak height, time to peak, FWHM, first moment, roughness # each (n_voxel)
+    '''
+    peak, ttp = ctc.max(dim = -1)
+    fwhm = (ctc >= peak.unsqueeze(-1) / 2).sum(dim = -1)
+    positive = ctc.clamp(min = 0)
+    area = positive.sum(dim = -1)
+    t = torch.arange(ctc.size(-1), device = ctc.device, dtype = ctc.dtype)
+    first_moment = (positive @ t) / area.clamp(min = torch.finfo(ctc.dtype).tiny)
+    # Squared second differences relative to the peak height: noisy/oscillating curves score high
+    roughness = (ctc[..., 2:] - 2 * ctc[..., 1:-1] + ctc[..., :-2]).pow(2).sum(dim = -1) / peak.pow(2).clamp(min = torch.finfo(ctc.dtype).tiny)
+    return peak, ttp, fwhm, first_moment, roughness
+
+
+def chunked_features(ctc, chunks = None):
+    '''
+    features of the voxels chunk by chunk of rows (see PackedVolume.chunks), None for all at once
+    '''
+    if chunks is None:
+        return features(ctc)
+    return tuple(torch.cat(values) for values in zip(*[features(ctc[start : stop]) for start, stop in chunks]))
+
+
+def select(features, peak_fraction = 0.05, n_candidates = 500):
+    '''
+    Arterial candidates from the curve features of all voxels (see prescreen)
+    return: candidate voxel indices (sorted)
+    '''
+    peak, _, fwhm, first_moment, roughness = features
+    if peak.numel() == 0:
+        raise ValueError('No arterial candidates: no brain voxel to select the AIF from')
+    n_top = max(int(peak.numel() * peak_fraction), 1)
+    # kthvalue instead of a full sort: linear in the number of voxels
+    threshold = torch.kthvalue(peak.cpu(), peak.numel() - n_top + 1).values.to(peak.device)
+    top = torch.nonzero((peak >= threshold) & (peak > 0)).squeeze(-1)
+    if top.numel() == 0:
+        raise ValueError('No arterial candidates: no voxel of the CTC has a positive peak, check the signal and the '
+            'bolus arrival time, or pick the AIF voxels (--aif_voxels)')
+    # One ranking score rather than cuts on each feature: high, narrow, early and smooth curves first. Noise spikes
+    # are narrower than the artery but far rougher, and an artery can be rougher than most of the tissue around it
+    score = peak[top] / (fwhm[top].to(peak.dtype) * first_moment[top] * (1 + roughness[top])).clamp(min = torch.finfo(peak.dtype).tiny)
+    n_keep = min((top.numel() + 7) // 8, n_candidates)
+    return top[torch.topk(score, n_keep).indices].sort().values
+
+
+def prescreen(ctc, peak_fraction = 0.05, n_candidates = 500, chunks = None):
+    '''
+    Prune all voxels to a small set of arterial candidates by their curve features:
+    highest peaks (top peak_fraction), then the eighth of those (at most n_candidates) with the highest
+    peak / (FWHM * first moment * (1 + roughness))
+    ctc: (n_voxel, time)
+    chunks: row ranges the features are computed over (see PackedVolume.chunks), None for all at once
+    return: candidate voxel indices (sorted), features of all voxels
+    '''
+    voxel_features = chunked_features(ctc, chunks)
+    return select(voxel_features, peak_fraction, n_candidates), voxel_features
+
+
+def kmeans(x, k, batch_size = 256, n_iter = 100, seed = 0):
+    '''
+    Mini-batch k-means (Sculley, 2010) of the rows of x, at most as many clusters as rows
+    return: labels # (n_row), centers # (min(k, n_row), n_column)
+    '''
+    generator = torch.Generator().manual_seed(seed)
+    k = min(k, x.size(0))
+    centers = x[torch.randperm(x.size(0), generator = generator)[:k].to(x.device)].clone()
+    counts = torch.zeros(k, device = x.device, dtype = x.dtype)
+    for _ in range(n_iter):
+        batch = x[torch.randint(x.size(0), (min(batch_size, x.size(0)),), generator = generator).to(x.device)]
+        assign = torch.cdist(batch, centers).argmin(dim = 1)
+        n_assign = torch.bincount(assign, minlength = k).to(x.dtype)
+        sums = torch.zeros_like(centers).index_add_(0, assign, batch)
+        counts += n_assign
+        # Per-center learning rate: number of new samples / all samples seen by the center
+        rate = (n_assign / counts.clamp(min = 1)).unsqueeze(-1)
+        centers += rate * (sums / n_assign.clamp(min = 1).unsqueeze(-1) - centers)
+    return torch.cdist(x, centers).argmin(dim = 1), centers
 
 
+def automatic(ctc, peak_fraction = 0.05, n_candidates = 500, n_clusters = 5, chunks = None):
+    '''
+    Automatic AIF selection: candidate voxels are clustered on their peak-normalized curves,
+    the cluster with the highest mean peak / first moment (high, early bolus) gives the AIF
+    ctc: (n_voxel, time)
+    chunks: row ranges the features are computed over (see PackedVolume.chunks), None for all at once
+    return: aif # (time), chosen voxel indices # (n_chosen)
+    '''
+    candidates, voxel_features = prescreen(ctc, peak_fraction, n_candidates, chunks)
+    return cluster(ctc[candidates], candidates, voxel_features, n_clusters)
 
 
+def cluster(curves, candidates, features, n_clusters = 5):
+    '''
+    AIF from the clustered curves of the candidate voxels (see automatic)
+    curves: (n_candidate, time) of candidates; features: features of all voxels
+    return: aif # (time), chosen voxel indices # (n_chosen)
+    '''
+    peak, first_moment = features[0], features[3]
+    # Normalized by the peak rather than the area: the area of a noisy low curve is mostly noise, which scatters
+    # such curves over the clusters and into the arterial one
+    shapes = curves / curves.max(dim = -1, keepdim = True).values.clamp(min = torch.finfo(curves.dtype).tiny)
+    # Fewer candidates than clusters: one cluster per candidate
+    labels, _ = kmeans(shapes, min(n_clusters, curves.size(0)))
+    best, best_score = 0, None
+    for label in labels.unique():
+        member = labels == label
+        score = peak[candidates[member]].mean() / first_moment[candidates[member]].mean().clamp(min = 1.)
+        if best_score is None or score > best_score:
+            best, best_score = label, score
+    chosen = labels == best
+    return curves[chosen].mean(dim = 0), candidates[chosen]
 
 
+def cal(ctc, config, device, packed = None):
+    '''
+    ctc: (slice, row, column, time), or packed (n_voxel, time) with its mask.PackedVolume
+    return: aif # (time), AIF voxels # (n_voxel, 3) as [slice, row, column]
+    '''
+    print('Extracting AIF ...')
+    if packed is None:
+        packed = PackedVolume.pack(ctc)
+        ctc = packed.values
+    # Curve features and clustering are not accurate enough in less than float32 (e.g., bfloat16 CTC)
+    ctc = ctc.to(compute_dtype(config.precision))
+    if len(config.aif_voxels) > 0:
+        aif, rows = manual(ctc, packed, config.aif_voxels)
+        print('  AIF from %d manually picked voxels' % len(rows))
+    else:
+        aif, rows = automatic(ctc, config.aif_peak_fraction, config.aif_candidates, config.aif_clusters, packed.chunks())
+        print('  AIF from %d automatically selected voxels' % len(rows))
+    voxels = packed.voxels(rows)
+    print('  AIF peak at time point %d' % int(torch.argmax(aif)))
+    return aif, voxels
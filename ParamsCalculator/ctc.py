@@ -2,127 +2,446 @@ import os
 import torch
 import logging
 import numpy as np
-from scipy import signal
 import SimpleITK as sitk
 from builtins import object
+from concurrent.futures import ThreadPoolExecutor
+
+from qc import QCReport
+from writer import ImageWriter
+from precision import storage_dtype, compute_dtype, to_numpy
 
 # Concentration time curve computation
 
-def mrp_s0(signal, config, device):
+def time_average(signal, dtype = torch.float, chunks = None):
     '''
-    Calculate the MRP bolus arrival time (bat) and corresponding S0: averaged over signals before bat
-    return: s0 # (n_slice, n_row, n_column)
+    Mean signal curve over all voxels, one reduction for all time points
+    signal: (..., time)
+    chunks: row ranges of a packed signal (see PackedVolume.chunks), summed separately and then added up in order,
+            so that the mean does not depend on the voxels being split into slabs (see tiling.py); None for one reduction
+    return: (time)
     '''
-    sig_avg = torch.zeros([signal.size()[3]], device = device, dtype = torch.float, requires_grad = False)
-    for t in range(signal.size()[3]):
-        sig_avg[t] = torch.mean(signal[..., t])
-    flag = True
-    bat  = 0
-    while flag:
-        s0_avg = torch.mean(sig_avg[:bat + 1])
-        if torch.abs(s0_avg - sig_avg[bat + 1]) / s0_avg < config.mrp_s0_threshold:
-            bat += 1
-        else:
-            flag = False
-            bat -= 1
-        if bat == signal.size()[3] - 1:
-            flag = False
-            bat -= 1
-    print('  Bolus arrival time (start from 0):', bat)
-    s0 = torch.mean(signal[..., :bat], dim = 3) # time dimension == 3
+    if chunks is None:
+        return signal.reshape(-1, signal.size(-1)).mean(dim = 0, dtype = dtype)
+    return time_sums(signal, dtype, chunks).sum(dim = 0) / signal.size(0)
+
+
+def time_sums(signal, dtype = torch.float, chunks = ()):
+    '''
+    Sums of the packed signal curves over each chunk of rows # (n_chunk, time)
+    '''
+    sums = [signal[start : stop].sum(dim = 0, dtype = dtype) for start, stop in chunks]
+    return torch.stack(sums) if sums else torch.zeros(0, signal.size(-1), device = signal.device, dtype = dtype)
+
+
+def first_true(flags, default):
+    '''
+    Index of the first True along the last dimension, default where there is none (no host sync)
+    '''
+    index = flags.byte().argmax(dim = -1)
+    return torch.where(flags.any(dim = -1), index, torch.full_like(index, default))
+
+
+def mrp_bat(curves, threshold):
+    '''
+    MRP bolus arrival time of each curve: the last time point before the first one deviating from
+    the running baseline mean by a relative threshold (the one before the deviating time point is
+    also excluded), n_time - 2 if none does
+    curves: (..., time)
+    return: bat # (...), number of time points averaged for S0, -1 if the second one already deviates
+    '''
+    n_t = curves.size(-1)
+    running = curves.cumsum(dim = -1) / torch.arange(1, n_t + 1, device = curves.device, dtype = curves.dtype)
+    deviate = torch.abs(running[..., :-1] - curves[..., 1:]) / running[..., :-1] >= threshold
+    return first_true(deviate, n_t - 1) - 1
+
+
+def ctp_bat(curves, threshold):
+    '''
+    CTP bolus arrival time of each curve: the first time point rising by at least threshold * (max - min)
+    of the curve and still rising after it, n_time if none does
+    curves: (..., time)
+    return: bat # (...), number of time points averaged for S0 (bolus arrives at bat - 1)
+    '''
+    n_t = curves.size(-1)
+    step = threshold * (curves.max(dim = -1, keepdim = True).values - curves.min(dim = -1, keepdim = True).values)
+    diff = curves[..., 1:] - curves[..., :-1]
+    rising = (diff[..., :-1] >= step) & (diff[..., 1:] > 0)
+    return first_true(rising, n_t - 1) + 1
+
+
+def arrival(n_avg, config):
+    '''
+    Bolus arrival time point (start from 0) from the number of time points averaged for S0 (see mrp_bat/ctp_bat),
+    int or tensor
+    '''
+    return n_avg - 1 if config.image_type == 'CTP' else n_avg
+
+
+def mean_bat(curve, config):
+    '''
+    Bolus arrival time of the mean curve, as the number of time points averaged for S0 (see mrp_bat/ctp_bat)
+    '''
+    if config.image_type == 'CTP':
+        bat = int(ctp_bat(curve, config.ctp_s0_threshold).item())
+    else:
+        bat = int(mrp_bat(curve, config.mrp_s0_threshold).item())
+    print('  Bolus arrival time (start from 0):', arrival(bat, config))
+    return bat
+
+
+def mrp_s0(signal, config, device, chunks = None):
+    '''
+    Calculate the MRP bolus arrival time (bat) of the mean curve and corresponding S0: averaged over signals before bat
+    signal: (slice, row, column, time), or packed (n_voxel, time)
+    chunks: row ranges of the packed signal for the mean curve (see time_average)
+    return: s0 # (n_slice, n_row, n_column), or (n_voxel), bat as the number of time points averaged (see mean_bat)
+    '''
+    dtype = compute_dtype(config.precision)
+    bat = mean_bat(time_average(signal, dtype, chunks), config)
+    s0 = torch.mean(signal[..., :bat], dim = -1, dtype = dtype) # time dimension is the last one
     
     return s0, bat
 
 
-def ctp_s0(signal, config, device):
+def ctp_s0(signal, config, device, chunks = None):
     '''
-    Calculate the CTP bolus arrival time (bat) and corresponding S0: averaged over signals before bat
-    return: s0 # (n_slice, n_row, n_column)
+    Calculate the CTP bolus arrival time (bat) of the mean curve and corresponding S0: averaged over signals before bat
+    signal: (slice, row, column, time), or packed (n_voxel, time)
+    chunks: row ranges of the packed signal for the mean curve (see time_average)
+    return: s0 # (n_slice, n_row, n_column), or (n_voxel), bat as the number of time points averaged (see mean_bat)
     '''
-    sig_avg = torch.zeros([signal.size()[3]], device = device, dtype = torch.float, requires_grad = False)
-    for t in range(signal.size()[3]):
-        sig_avg[t] = torch.mean(signal[..., t])
-    threshold = config.ctp_s0_threshold * (torch.max(sig_avg) - torch.min(sig_avg))
-    flag = True
-    bat  = 1
-    while flag:
-        if sig_avg[bat] - sig_avg[bat - 1] >= threshold and sig_avg[bat + 1] > sig_avg[bat]:
-            flag = False
-        else:
-            bat += 1
-        if bat == signal.size()[3]:
-            flag = False
-    print('  Bolus arrival time (start from 0):', bat - 1)
-    s0 = torch.mean(signal[..., :bat], dim = 3) # time dimension == 3
+    dtype = compute_dtype(config.precision)
+    bat = mean_bat(time_average(signal, dtype, chunks), config)
+    s0 = torch.mean(signal[..., :bat], dim = -1, dtype = dtype) # time dimension is the last one
     
     return s0, bat
 
 
+def voxel_s0(signal, config, device):
+    '''
+    Bolus arrival time and S0 of every voxel curve at once, with the same criteria (and thresholds) as
+    mrp_s0/ctp_s0 for the mean curve, computed slab by slab within config.ctc_memory_budget
+    signal: (slice, row, column, time), or packed (n_voxel, time)
+    return: s0, bat # (n_slice, n_row, n_column), or (n_voxel); bat starts from 0 as printed by mrp_s0/ctp_s0
+    '''
+    dtype = compute_dtype(config.precision)
+    s0  = torch.empty(signal.size()[:-1], device = signal.device, dtype = dtype)
+    bat = torch.empty(signal.size()[:-1], device = signal.device, dtype = torch.long)
+    n_slab = slab_size(signal, config.ctc_memory_budget, n_temp = 4)
+    for start in range(0, signal.size(0), n_slab):
+        curves = signal[start : start + n_slab].to(dtype)
+        if config.image_type == 'CTP':
+            n_avg = ctp_bat(curves, config.ctp_s0_threshold)
+        else:
+            n_avg = mrp_bat(curves, config.mrp_s0_threshold)
+        bat[start : start + n_slab] = arrival(n_avg, config)
+        # MRP deviating right after the first time point: average over it only
+        n_avg = n_avg.clamp(min = 1)
+        total = curves.cumsum(dim = -1).gather(-1, (n_avg - 1).unsqueeze(-1)).squeeze(-1)
+        s0[start : start + n_slab] = total / n_avg
+    print('  Bolus arrival time (start from 0) per voxel: median %d, range [%d, %d]' % \
+        (bat.median().item(), bat.min().item(), bat.max().item()))
+
+    return s0, bat
+
+
+def baseline(signal, config, device, chunks = None):
+    '''
+    S0 (and bolus arrival time) used for the CTC: per voxel if config.per_voxel_bat, else from the mean curve
+    chunks: row ranges of the packed signal for the mean curve (see time_average)
+    return: s0, bat # bat: (...) per voxel, or int; bolus arrival time point (start from 0) in both modes
+    '''
+    if config.per_voxel_bat:
+        return voxel_s0(signal, config, device)
+    if config.image_type == 'CTP':
+        s0, n_avg = ctp_s0(signal, config, device, chunks)
+    elif config.image_type == 'MRP':
+        s0, n_avg = mrp_s0(signal, config, device, chunks)
+    else:
+        raise ValueError('Unknown image type: %s' % config.image_type)
+    return s0, arrival(n_avg, config)
 
-def mr2ctc(signal, config, device):
+
+def slab_size(signal, budget_mb = 0, n_temp = 2):
+    '''
+    Number of slices per slab such that the temporaries of one conversion step
+    (n_temp full-slab tensors in the signal dtype) stay within budget_mb (MB)
+    budget_mb <= 0: the whole volume in one broadcast operation
+    '''
+    if budget_mb <= 0 or signal.dim() < 2:
+        return signal.size(0)
+    slice_bytes = signal[0].numel() * signal.element_size() * n_temp
+    return int(min(max(budget_mb * 1024 ** 2 // slice_bytes, 1), signal.size(0)))
+
+
+def convert(signal, s0, fn, in_place = False, budget_mb = 0, dtype = torch.float, packed = None):
+    '''
+    Apply the voxel-wise conversion ctc = fn(signal, s0) to all time points in one broadcast
+    operation per slab of slices (size chosen from budget_mb, see slab_size)
+    signal: (..., time), converted to the dtype of s0 slab by slab; s0: (...)
+    in_place: overwrite signal with the CTC if it already has the output dtype,
+              otherwise the CTC is written slab by slab into a single output
+    packed: mask.PackedVolume of a packed signal, converted chunk by chunk of its slices (see PackedVolume.chunks)
+    return: ctc # same size as signal
+    '''
+    if in_place and signal.dtype == dtype:
+        ctc = signal
+    else:
+        ctc = torch.empty(signal.size(), device = signal.device, dtype = dtype, requires_grad = False)
+    n_slab = slab_size(signal, budget_mb)
+    if packed is not None:
+        ranges = packed.chunks(n_slab if budget_mb > 0 else 0)
+    else:
+        ranges = [(start, start + n_slab) for start in range(0, signal.size(0), n_slab)]
+    for start, stop in ranges:
+        ctc[start : stop] = fn(signal[start : stop].to(s0.dtype), s0[start : stop].unsqueeze(-1))
+    return ctc
+
+
+def mr_conversion(config):
+    '''
+    MRP conversion ctc = fn(signal, s0)
+    '''
+    return lambda sig, s0: - config.k_mr/config.TE * torch.log(sig / s0)
+
+
+def ct_conversion(config):
+    '''
+    CTP conversion ctc = fn(signal, s0)
+    '''
+    return lambda sig, s0: config.k_ct * (sig - s0)
+
+
+def mr2ctc(signal, config, device, s0 = None, packed = None, report = None):
+    '''
+    s0: precomputed S0 (see baseline), None for mrp_s0
+    packed: mask.PackedVolume of a packed signal (see convert)
+    report: qc.QCReport the CTC statistics are added to, None for none
+    '''
 
     # TODO: use mask if needed
 
-    s0, _ = mrp_s0(signal, config, device)
-    ctc = torch.zeros(signal.size(), device = device, dtype = torch.float, requires_grad = False)
-    
-    for t in range(signal.size()[3]):
-        ctc[..., t] = - config.k_mr/config.TE * torch.log(signal[..., t] / s0)
+    if s0 is None:
+        s0, _ = mrp_s0(signal, config, device)
+    ctc = convert(signal, s0, mr_conversion(config), \
+        config.ctc_in_place, config.ctc_memory_budget, storage_dtype(config.precision), packed)
 
-    # Check computed CTC: should have no NaN value
-    if not len(torch.nonzero(torch.isnan(ctc))) == 0:
-        raise ValueError('Computed CTC contains NaN value, check out!')
+    # Check computed CTC: should have no NaN (nor Inf) value, in the same pass as its QC statistics
+    (QCReport() if report is None else report).scan('ctc', ctc, packed, fail = True)
 
     return ctc
 
 
-def ct2ctc(signal, config, device):
+def ct2ctc(signal, config, device, s0 = None, packed = None, report = None):
+    '''
+    s0: precomputed S0 (see baseline), None for ctp_s0
+    packed: mask.PackedVolume of a packed signal (see convert)
+    report: qc.QCReport the CTC statistics are added to, None for none
+    '''
 
-    s0, _ = ctp_s0(signal, config, device)
-    ctc = torch.zeros(signal.size(), device = device, dtype = torch.float, requires_grad = False)
-    for t in range(signal.size()[3]):
-        ctc[..., t] = config.k_ct * (signal[..., t] - s0)
+    if s0 is None:
+        s0, _ = ctp_s0(signal, config, device)
+    ctc = convert(signal, s0, ct_conversion(config), \
+        config.ctc_in_place, config.ctc_memory_budget, storage_dtype(config.precision), packed)
 
-    # Check computed CTC: should have no NaN value
-    if not len(torch.nonzero(torch.isnan(ctc))) == 0:
-        raise ValueError('Computed CTC contains NaN value, check out!')
+    # Check computed CTC: should have no NaN (nor Inf) value, in the same pass as its QC statistics
+    (QCReport() if report is None else report).scan('ctc', ctc, packed, fail = True)
 
     return ctc
 
-def cal(raw_perf, sitk_info, config, device):
+def medfilt(ctc, kernel_size = 3, n_threads = 0, budget_mb = 0):
+    '''
+    Batched temporal median filter over all voxel curves at once,
+    same output as scipy.signal.medfilt(curve, kernel_size) per voxel (zero-padded edges)
+    ctc: (..., time)
+    n_threads: number of CPU threads working on separate slabs, 0 for torch.get_num_threads()
+    '''
+    if kernel_size % 2 == 0:
+        raise ValueError('Kernel size of median filter should be odd, got %d' % kernel_size)
+    half = kernel_size // 2
+    filtered = torch.empty_like(ctc)
+
+    def filter_slab(start, stop):
+        padded = torch.nn.functional.pad(ctc[start : stop], (half, half))
+        if kernel_size > 9:
+            filtered[start : stop] = padded.unfold(-1, kernel_size, 1).median(dim = -1).values
+            return
+        # Small kernels: odd-even transposition sort of the shifted curves, elementwise min/max only
+        n_t = ctc.size(-1)
+        window = [padded[..., i : i + n_t] for i in range(kernel_size)]
+        for i in range(kernel_size):
+            for j in range(i % 2, kernel_size - 1, 2):
+                window[j], window[j + 1] = torch.minimum(window[j], window[j + 1]), torch.maximum(window[j], window[j + 1])
+        filtered[start : stop] = window[half]
+
+    # kernel_size shifted copies of each slab are materialized while sorting
+    n_slab = slab_size(ctc, budget_mb, n_temp = kernel_size + 1)
+    if ctc.device.type == 'cpu':
+        n_threads = n_threads if n_threads > 0 else torch.get_num_threads()
+        n_slab = max(min(n_slab, -(-ctc.size(0) // n_threads)), 1)
+    else:
+        n_threads = 1
+    starts = range(0, ctc.size(0), n_slab)
+    if n_threads > 1 and len(starts) > 1:
+        with ThreadPoolExecutor(max_workers = n_threads) as pool:
+            list(pool.map(lambda start: filter_slab(start, start + n_slab), starts))
+    else:
+        for start in starts:
+            filter_slab(start, start + n_slab)
+    return filtered
+
+
+def compute(raw_perf, config, device, s0 = None, packed = None, report = None):
+    '''
+    s0: precomputed S0 (see baseline), None for computing it from raw_perf
+    packed: mask.PackedVolume of a packed raw_perf (see convert)
+    report: qc.QCReport the CTC statistics are added to, None for none
+    '''
 
     print('Calculating Concentration Time Curve ...')
+    if s0 is None:
+        s0, _ = baseline(raw_perf, config, device, packed.chunks() if packed is not None else None)
     if config.image_type == 'CTP':
-        ctc = ct2ctc(raw_perf, config, device) 
+        return ct2ctc(raw_perf, config, device, s0, packed, report)
     elif config.image_type == 'MRP':
-        ctc = mr2ctc(raw_perf, config, device)
+        return mr2ctc(raw_perf, config, device, s0, packed, report)
+    raise ValueError('Unknown image type: %s' % config.image_type)
+
+
+class StreamingCTC(object):
+    '''
+    CTC computed frame by frame while the time points of a study arrive (see streaming.py)
+
+    Preprocessed frames (slice, row, column) are buffered until the bolus arrival time of the mean curve is detected
+    from the frames so far (criteria of mrp_bat/ctp_bat), S0 is then averaged over the frames before it, and the CTC
+    of each frame is given as soon as both the frame and S0 are known. The mean curve is over the voxels differing
+    from the background in any frame so far (the brain mask of mask.cal, which may still grow).
+    Detected online, the MRP bolus arrival (running baseline mean) only depends on the frames before it, as in
+    mrp_s0; the CTP one is approximate: rises are compared with the range of the mean curve so far instead of
+    that of the whole curve, so it may be found earlier than ctp_s0 finds it.
+    background: value of the voxels outside the brain (0 for CTP, 1 for MRP, see mask.cal)
+    '''
+    def __init__(self, config, device, background = 0):
+        if config.image_type not in ['CTP', 'MRP']:
+            raise ValueError('Unknown image type: %s' % config.image_type)
+        self.config = config
+        self.device = device
+        self.background = background
+        self.dtype = compute_dtype(config.precision)
+        self.fn = ct_conversion(config) if config.image_type == 'CTP' else mr_conversion(config)
+        self.frames = [] # buffered until S0 is known
+        self.sums = [] # sum of each frame over all voxels
+        self.seen = None # voxels differing from the background in any frame so far
+        self.n_time = 0
+        self.s0 = None
+        self.bat = None # number of time points averaged for S0 (see mrp_bat/ctp_bat), once known
+        self.detected_at = None # time point at which it was detected
+
+    def mean_curve(self):
+        '''
+        Mean curve of the frames so far over the voxels seen in the brain (the others are background in all frames)
+        '''
+        n_brain = self.seen.sum()
+        outside = (self.seen.numel() - n_brain) * self.background
+        return (torch.stack(self.sums) - outside) / n_brain.clamp(min = 1)
+
+    def detect(self, final = False):
+        '''
+        Bolus arrival time of the mean curve so far, None if not found yet (final: the default of the whole curve)
+        '''
+        curve = self.mean_curve()
+        # Both criteria look at two time points after the one tested
+        if curve.size(0) < 3 and not final:
+            return None
+        if self.config.image_type == 'CTP':
+            bat = int(ctp_bat(curve, self.config.ctp_s0_threshold).item())
+            found = bat <= curve.size(0) - 2
+        else:
+            bat = int(mrp_bat(curve, self.config.mrp_s0_threshold).item())
+            found = bat <= curve.size(0) - 3
+        return bat if found or final else None
+
+    def add(self, frame):
+        '''
+        Add the next time frame # (slice, row, column)
+        return: CTC frames made available by it, [(time point, CTC frame)]: all buffered ones once S0 is known
+        '''
+        frame = frame.to(self.device)
+        outside = frame == self.background
+        self.seen = ~outside if self.seen is None else self.seen | ~outside
+        self.sums.append(frame.sum(dtype = self.dtype))
+        self.n_time += 1
+        if self.s0 is not None:
+            return [(self.n_time - 1, self.convert(frame))]
+        self.frames.append(frame)
+        bat = self.detect()
+        return [] if bat is None else self.start(bat)
+
+    def start(self, bat):
+        self.bat, self.detected_at = bat, self.n_time - 1
+        # MRP deviating right after the first time point: averaged over it only
+        n_avg = max(bat, 1)
+        self.s0 = torch.stack(self.frames[:n_avg], dim = -1).mean(dim = -1, dtype = self.dtype)
+        print('  Bolus arrival time (start from 0) found at time point %d: %d' % (self.detected_at, arrival(bat, self.config)))
+        frames, self.frames = self.frames, []
+        return [(t, self.convert(frame)) for t, frame in enumerate(frames)]
+
+    def convert(self, frame):
+        return self.fn(frame.to(self.s0.dtype), self.s0).to(storage_dtype(self.config.precision))
+
+    def finish(self):
+        '''
+        End of the study: if not found online, bolus arrival time of the whole mean curve (as mrp_s0/ctp_s0)
+        return: remaining CTC frames, as add
+        '''
+        if self.s0 is not None or not self.n_time:
+            return []
+        return self.start(self.detect(final = True))
+
+
+def save(ctc, ctc_filtered, sitk_info, writer = None, images = True):
+    '''
+    Save pre-filtered CTC as CTC.nii, filtered CTC as CTC_filtered.nii (each skipped if None),
+    and as chunked stores CTC.chunks/CTC_filtered.chunks if selected (see ImageWriter.store)
+    images: False for the chunked stores only
+    ctc, ctc_filtered are handed to the writer without a copy (see ImageWriter.write): not to be modified afterwards
+    '''
+    writer = ImageWriter() if writer is None else writer
+    for name, values, BaseName, label in [('ctc', ctc, 'CTC', 'calculated'), ('ctc_filtered', ctc_filtered, 'CTC_filtered', 'filtered  ')]:
+        if values is None:
+            continue
+        FileName = writer.write(name, to_numpy(values), os.path.join(sitk_info[3], BaseName), *sitk_info[:3], \
+            snapshot = False) if images else None
+        if FileName:
+            print('  Save %s ctc as:' % label, os.path.basename(FileName))
+        store = writer.store(name, os.path.join(sitk_info[3], BaseName), values.shape, to_numpy(values[:0]).dtype, *sitk_info[:3])
+        if store is not None:
+            save_store(store, values)
+            print('  Save %s ctc store as:' % label, os.path.basename(store.path))
+
+
+def save_store(store, values):
+    '''
+    Write a (slice, row, column, time) tensor into a chunk store slab by slab, each moved to the CPU on its own
+    '''
+    with store:
+        for start in range(0, values.size(0), store.chunks[0]):
+            store.write(start, to_numpy(values[start : start + store.chunks[0]]))
+
+
+def cal(raw_perf, sitk_info, config, device, writer = None):
+    '''
+    writer: writer.ImageWriter for CTC.nii/CTC_filtered.nii, None for synchronously writing both
+    '''
+
+    ctc = compute(raw_perf, config, device)
     
     if config.use_filter:
         print('Use filtered CTC...')
-        ctc_raw_nda = ctc.cpu()
-        ctc_raw_nda = ctc_raw_nda.numpy()
-        ctc_filtered_nda = np.zeros(ctc_raw_nda.shape)
-        for slice in range(ctc_raw_nda.shape[0]):
-            for row in range(ctc_raw_nda.shape[1]):
-                for col in range(ctc_raw_nda.shape[2]):
-                    ctc_filtered_nda[slice, row, col, :] = signal.medfilt(ctc_raw_nda[slice, row, col, :])
-        # Save pre-filtered CTC as CTC.nii, filtered CTC as CTC_filtered.nii
-        ctc_raw = sitk.GetImageFromArray(ctc_raw_nda, isVector = True)
-        ctc_raw.SetOrigin(sitk_info[0])
-        ctc_raw.SetSpacing(sitk_info[1])
-        ctc_raw.SetDirection(sitk_info[2])
-        ctcname = os.path.join(sitk_info[3], 'CTC.nii')
-        print('  Save calculated ctc as:', os.path.basename(ctcname))
-        sitk.WriteImage(ctc_raw, ctcname) 
-        
-        ctc_filtered = sitk.GetImageFromArray(ctc_filtered_nda, isVector = True)
-        ctc_filtered.SetOrigin(sitk_info[0])
-        ctc_filtered.SetSpacing(sitk_info[1])
-        ctc_filtered.SetDirection(sitk_info[2])
-        ctcname_fil = os.path.join(sitk_info[3], 'CTC_filtered.nii')
-        print('  Save filtered   ctc as:', os.path.basename(ctcname_fil))
-        sitk.WriteImage(ctc_filtered, ctcname_fil) 
-        return torch.tensor(ctc_filtered_nda, device = device, dtype = torch.float, requires_grad = False)
+        ctc_filtered = medfilt(ctc, config.filter_kernel_size, config.filter_threads, config.ctc_memory_budget)
+        save(ctc, ctc_filtered, sitk_info, writer)
+        return ctc_filtered
     else:
         print('Use non-filtered CTC...')
+        save(ctc, None, sitk_info, writer, images = False)
         return ctc
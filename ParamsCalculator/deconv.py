@@ -0,0 +1,100 @@
+import os
+import torch
+import logging
+import numpy as np
+
+from ParamsCalculator.mask import PackedVolume
+
+# Perfusion parameters (CBF, CBV, MTT, Tmax) by truncated SVD deconvolution of the CTC with the AIF
+
+
+def sampling_interval(config):
+    '''
+    Time (s) between two time points
+    '''
+    return config.TR if config.image_type == 'MRP' else config.ct_interval
+
+
+def conv_matrix(aif, dt, block_circulant = False):
+    '''
+    Discretized convolution with the AIF, ctc = A @ (CBF * R)
+    block_circulant: zero-pad to twice the length and wrap around (cSVD), making the deconvolution
+                     insensitive to a delay of the tissue curves behind the AIF
+    return: A # (nT, nT), or (2 * nT, 2 * nT) if block_circulant
+    '''
+    n_t = aif.size(0)
+    if block_circulant:
+        n_t = 2 * n_t
+        aif = torch.cat([aif, torch.zeros_like(aif)])
+    lag = torch.arange(n_t, device = aif.device).view(-1, 1) - torch.arange(n_t, device = aif.device).view(1, -1)
+    if block_circulant:
+        return dt * aif[lag % n_t]
+    return dt * torch.where(lag >= 0, aif[lag.clamp(min = 0)], torch.zeros_like(aif[0]))
+
+
+def truncated_pinv(A, threshold = 0.2):
+    '''
+    Pseudo-inverse of A, with singular values below threshold * max(singular value) truncated
+    '''
+    U, S, Vh = torch.linalg.svd(A.double())
+    S_inv = torch.where(S >= threshold * S.max(), 1. / S, torch.zeros_like(S))
+    return ((Vh.t() * S_inv) @ U.t()).to(A.dtype)
+
+
+def deconvolve(ctc, aif, dt, threshold = 0.2, block_circulant = False, budget_mb = 0, packed = None):
+    '''
+    Deconvolve all voxel curves at once, the truncated pseudo-inverse is computed a single time
+    ctc: (n_voxel, time); aif: (time)
+    packed: mask.PackedVolume of ctc, deconvolved chunk by chunk of its slices (see PackedVolume.chunks), None for chunks of rows
+    return: cbf (ml/100g/min), cbv (ml/100g), mtt (s), tmax (s) # each (n_voxel)
+    With block_circulant, the residue function is periodic over 2 * nT: a peak in its second half (index >= nT) is
+    a tissue curve leading the AIF, its Tmax is then negative, (index - 2 * nT) * dt
+    '''
+    n_t = ctc.size(-1)
+    A = conv_matrix(aif, dt, block_circulant)
+    pinv_t = truncated_pinv(A, threshold).t().contiguous()
+    aif_area = aif.sum() * dt
+
+    # Curves are converted to the AIF dtype (at least float32) chunk by chunk
+    cbf  = torch.empty(ctc.size(0), device = ctc.device, dtype = aif.dtype)
+    cbv  = torch.empty_like(cbf)
+    tmax = torch.empty_like(cbf)
+    # Residue functions (n_voxel x n_row of pinv) are only kept for one chunk of voxels at a time
+    if budget_mb > 0:
+        n_chunk = max(int(budget_mb * 1024 ** 2 // (pinv_t.size(1) * aif.element_size() * 2)), 1)
+    else:
+        n_chunk = 0
+    if packed is not None:
+        ranges = packed.chunks(n_chunk)
+    else:
+        n_chunk = n_chunk if n_chunk > 0 else max(ctc.size(0), 1)
+        ranges = [(start, start + n_chunk) for start in range(0, ctc.size(0), n_chunk)]
+    for start, stop in ranges:
+        curves = ctc[start : stop].to(aif.dtype)
+        residue = (curves @ pinv_t[:n_t]) # zero-padded part of block-circulant curves contributes nothing
+        peak, peak_t = residue.max(dim = -1)
+        if block_circulant:
+            peak_t = torch.where(peak_t >= n_t, peak_t - 2 * n_t, peak_t)
+        cbf[start : stop]  = peak
+        tmax[start : stop] = peak_t.to(aif.dtype) * dt
+        cbv[start : stop]  = curves.sum(dim = -1) * dt / aif_area
+    mtt = torch.where(cbf > 0, cbv / cbf.clamp(min = torch.finfo(cbf.dtype).tiny), torch.zeros_like(cbv))
+    return cbf * 6000., cbv * 100., mtt, tmax
+
+
+def cal(ctc, aif, config, device, packed = None):
+    '''
+    Perfusion parameter maps of all brain voxels (others set to 0)
+    ctc: packed (n_voxel, time) with its mask.PackedVolume,
+         or (slice, row, column, time), of which voxels with non-zero CTC are deconvolved
+    aif: (time)
+    return: {'CBF': cbf, 'CBV': cbv, 'MTT': mtt, 'Tmax': tmax} # each (slice, row, column)
+    '''
+    print('Calculating perfusion parameters by %s deconvolution ...' % ('block-circulant SVD' if config.block_circulant else 'SVD'))
+    if packed is None:
+        packed = PackedVolume.pack(ctc, (ctc != 0).any(dim = -1))
+        ctc = packed.values
+    params = deconvolve(ctc, aif, sampling_interval(config), config.svd_threshold, config.block_circulant, config.ctc_memory_budget, packed)
+    maps = {name: packed.unpack(values) for name, values in zip(['CBF', 'CBV', 'MTT', 'Tmax'], params)}
+    print('  Deconvolved %d voxels' % ctc.size(0))
+    return maps
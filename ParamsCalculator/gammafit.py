@@ -0,0 +1,176 @@
+import torch
+
+from precision import compute_dtype
+from ParamsCalculator.ctc import first_true
+from ParamsCalculator.deconv import sampling_interval
+
+# Gamma-variate fitting of all voxel curves at once by batched Levenberg-Marquardt,
+# c(t) = peak * s^alpha * exp(alpha * (1 - s)), s = (t - t0) / tmax for t > t0, else 0 (tmax: time of the peak after t0)
+
+PARAMS = ['peak', 't0', 'alpha', 'tmax']
+
+# Bounds of alpha, and of tmax in units of the sampling interval, keeping the fits within sensible shapes
+ALPHA_RANGE = (0.1, 50.)
+TMAX_MIN = 0.1
+
+
+def gamma_variate(params, t):
+    '''
+    params: (n, 4) as PARAMS; t: (time)
+    return: curves # (n, time), and the terms shared with the jacobian
+    '''
+    peak, t0, alpha, tmax = [p.unsqueeze(-1) for p in params.unbind(-1)]
+    s = (t - t0) / tmax
+    inside = s > 0
+    s = s.clamp(min = torch.finfo(params.dtype).tiny)
+    log = torch.log(s) + 1. - s # <= 0, so exp(alpha * log) never overflows
+    shape = torch.exp(alpha * log) * inside
+    return peak * shape, (shape, s, log, alpha, tmax)
+
+
+def jacobian(curves, terms):
+    '''
+    Derivatives of the curves with respect to PARAMS # (n, time, 4)
+    '''
+    shape, s, log, alpha, tmax = terms
+    common = curves * alpha * (1. / s - 1.) / tmax
+    return torch.stack([shape, - common, curves * log, - common * s], dim = -1)
+
+
+def fit_window(curves, tail = 0.3):
+    '''
+    Time points fitted: up to the first one after the peak where the curve falls below tail * peak,
+    leaving out the recirculation # (n, time) bool
+    '''
+    peak, ttp = curves.max(dim = -1, keepdim = True)
+    t = torch.arange(curves.size(-1), device = curves.device)
+    end = first_true((curves < tail * peak) & (t > ttp), curves.size(-1))
+    return t < end.unsqueeze(-1) + 1
+
+
+def initialize(curves, dt, bat = 0):
+    '''
+    Initial parameters: t0 at the bolus arrival time, peak and its time from the curve, alpha = 3
+    bat: bolus arrival time point(s) from 0 (see ctc.baseline), int or (n)
+    '''
+    peak, ttp = curves.max(dim = -1)
+    t0 = (bat.to(curves.dtype) if torch.is_tensor(bat) else torch.full_like(peak, float(bat))) * dt
+    t0 = torch.minimum(t0, ttp.to(curves.dtype) * dt - dt)
+    tmax = (ttp.to(curves.dtype) * dt - t0).clamp(min = dt)
+    return torch.stack([peak, t0, torch.full_like(peak, 3.), tmax], dim = -1)
+
+
+def bounds(dt, n_t, dtype, device):
+    '''
+    Lower and upper bounds of PARAMS # (4), (4)
+    '''
+    lower = torch.tensor([0., - n_t * dt, ALPHA_RANGE[0], TMAX_MIN * dt], dtype = dtype, device = device)
+    upper = torch.tensor([float('inf'), n_t * dt, ALPHA_RANGE[1], n_t * dt], dtype = dtype, device = device)
+    return lower, upper
+
+
+def levenberg_marquardt(curves, params, weights, dt, iterations = 50, tolerance = 1e-4):
+    '''
+    Batched Levenberg-Marquardt: every voxel has its own damping and stops on its own once converged
+    (relative decrease of the cost or relative change of all parameters <= tolerance, or no decrease possible),
+    only active voxels are computed
+    curves: (n, time); params: (n, 4) initial; weights: (n, time) 0/1 fitted time points
+    return: params # (n, 4), cost # (n) sum of squared residuals, converged # (n) bool, iterations # (n)
+    '''
+    n, n_t = curves.size()
+    t = torch.arange(n_t, device = curves.device, dtype = curves.dtype) * dt
+    model, _ = gamma_variate(params, t)
+    cost = (((model - curves) * weights) ** 2).sum(dim = -1)
+    damping = torch.full_like(cost, 1e-3)
+    converged = torch.zeros(n, dtype = torch.bool, device = curves.device)
+    n_iter = torch.zeros(n, dtype = torch.int32, device = curves.device)
+    # Curves without a positive peak have nothing to fit
+    active = torch.nonzero(curves.max(dim = -1).values > 0).squeeze(-1)
+    eye = torch.eye(4, device = curves.device, dtype = curves.dtype)
+    lower, upper = bounds(dt, n_t, curves.dtype, curves.device)
+
+    for _ in range(iterations):
+        if active.numel() == 0:
+            break
+        p, y, w = params[active], curves[active], weights[active]
+        model, terms = gamma_variate(p, t)
+        J = jacobian(model, terms) * w.unsqueeze(-1)
+        grad = (J * ((model - y) * w).unsqueeze(-1)).sum(dim = 1)
+        # Parameters at a bound which descent would push further out are held fixed (projected LM)
+        fixed = ((p <= lower) & (grad > 0)) | ((p >= upper) & (grad < 0))
+        J = J * ~fixed.unsqueeze(1)
+        grad = grad * ~fixed
+        JTJ = J.transpose(1, 2) @ J
+        damped = JTJ + damping[active].view(-1, 1, 1) * (JTJ * eye + 1e-12 * eye)
+        step = torch.linalg.solve(damped, - grad.unsqueeze(-1)).squeeze(-1)
+        trial = torch.maximum(torch.minimum(p + torch.nan_to_num(step), upper), lower)
+        model, _ = gamma_variate(trial, t)
+        trial_cost = (((model - y) * w) ** 2).sum(dim = -1)
+
+        better = trial_cost < cost[active]
+        decrease = cost[active] - trial_cost
+        params[active] = torch.where(better.unsqueeze(-1), trial, p)
+        moved = (trial - p).abs() > tolerance * (p.abs() + tolerance)
+        done = (better & ((decrease <= tolerance * cost[active]) | ~moved.any(dim = -1))) | (damping[active] > 1e10)
+        cost[active] = torch.where(better, trial_cost, cost[active])
+        damping[active] = torch.where(better, damping[active] / 10., damping[active] * 10.)
+        n_iter[active] += 1
+        converged[active] = done
+        active = active[~done]
+    return params, cost, converged, n_iter
+
+
+def fit(curves, dt, bat = 0, iterations = 50, tolerance = 1e-4, tail = 0.3, dtype = torch.float, chunks = None):
+    '''
+    Gamma-variate fits of all curves, chunk by chunk of voxels
+    curves: (n_voxel, time); bat: bolus arrival time point(s) from 0 (see ctc.baseline), int or (n_voxel)
+    chunks: row ranges (see PackedVolume.chunks), None for all at once
+    return: params # (n_voxel, 4) as PARAMS, rmse # (n_voxel) over the fitted time points, converged # (n_voxel) bool,
+            iterations # (n_voxel)
+    '''
+    n_voxel, n_t = curves.size()
+    params = torch.zeros(n_voxel, 4, device = curves.device, dtype = dtype)
+    rmse = torch.zeros(n_voxel, device = curves.device, dtype = dtype)
+    converged = torch.zeros(n_voxel, dtype = torch.bool, device = curves.device)
+    n_iter = torch.zeros(n_voxel, dtype = torch.int32, device = curves.device)
+    for start, stop in (chunks if chunks is not None else [(0, n_voxel)]):
+        y = curves[start : stop].to(dtype)
+        weights = fit_window(y, tail).to(dtype)
+        chunk_bat = bat[start : stop] if torch.is_tensor(bat) else bat
+        p, cost, converged[start : stop], n_iter[start : stop] = \
+            levenberg_marquardt(y, initialize(y, dt, chunk_bat), weights, dt, iterations, tolerance)
+        params[start : stop] = p
+        rmse[start : stop] = torch.sqrt(cost / weights.sum(dim = -1).clamp(min = 1))
+    return params, rmse, converged, n_iter
+
+
+def curves(params, n_t, dt):
+    '''
+    Fitted (recirculation-free) curves # (n, time)
+    '''
+    return gamma_variate(params, torch.arange(n_t, device = params.device, dtype = params.dtype) * dt)[0]
+
+
+def cal(ctc, bat, config, device, packed):
+    '''
+    Gamma-variate fits of all brain voxels (others set to 0)
+    ctc: packed (n_voxel, time) with its mask.PackedVolume; bat: bolus arrival time point from 0 (see ctc.baseline),
+         global or per voxel (n_voxel)
+    return: {'GV_peak', 'GV_t0' (s), 'GV_alpha', 'GV_tmax' (s), 'GV_rmse', 'GV_converged'} # each (slice, row, column)
+    '''
+    print('Fitting gamma-variates by batched Levenberg-Marquardt ...')
+    dtype = compute_dtype(config.precision)
+    n_t = ctc.size(-1)
+    # Per-voxel tensors of one LM iteration: curves, model, weights and the (time, 4) jacobian, a few times over
+    if config.ctc_memory_budget > 0:
+        n_chunk = max(int(config.ctc_memory_budget * 1024 ** 2 // (n_t * 12 * torch.finfo(dtype).bits // 8)), 1)
+    else:
+        n_chunk = 0
+    params, rmse, converged, n_iter = fit(ctc, sampling_interval(config), bat, config.gamma_fit_iterations, \
+        config.gamma_fit_tolerance, config.gamma_fit_tail, dtype, packed.chunks(n_chunk))
+    print('  Converged %d of %d voxels, %.1f iterations on average' % \
+        (int(converged.sum()), ctc.size(0), n_iter.double().mean().item() if n_iter.numel() else 0.))
+    maps = {'GV_' + name: packed.unpack(values) for name, values in zip(PARAMS, params.unbind(-1))}
+    maps['GV_rmse'] = packed.unpack(rmse)
+    maps['GV_converged'] = packed.unpack(converged.to(torch.uint8))
+    return maps
@@ -4,14 +4,91 @@ import logging
 import numpy as np
 from builtins import object
 
+from mask import brain_region
+
 # Brain mask computation
 
 
-def cal(raw_perf, device):
+class PackedVolume(object):
+    '''
+    Voxel curves inside a brain mask, packed into a dense tensor
+    values: (n_voxel, ...), rows ordered as the voxels in the (slice, row, column) grid
+    index: flat indices of the voxels in the grid # (n_voxel)
+    shape: grid size [n_slice, n_row, n_column]
+    '''
+    def __init__(self, values, index, shape):
+        self.values = values
+        self.index  = index
+        self.shape  = list(shape)
 
-    print('Masking raw data ...')
+    @classmethod
+    def pack(cls, volume, mask = None):
+        '''
+        volume: (slice, row, column, ...); mask: (slice, row, column) boolean, None for all voxels
+        '''
+        shape = list(volume.shape[:3])
+        if mask is None:
+            index = torch.arange(int(np.prod(shape)), device = volume.device)
+            return cls(volume.reshape(-1, *volume.shape[3:]), index, shape)
+        return cls(volume[mask], torch.nonzero(mask.flatten()).squeeze(-1), shape)
 
-    a
+    @classmethod
+    def layout(cls, mask):
+        '''
+        Voxel layout of mask only (no values), for scattering packed results back to the grid
+        '''
+        return cls(None, torch.nonzero(mask.flatten()).squeeze(-1), mask.shape)
 
-    return mask
+    def unpack(self, values = None, fill = 0):
+        '''
+        Scatter values (n_voxel, ...) back to a (slice, row, column, ...) volume, voxels outside the mask set as fill
+        '''
+        values = self.values if values is None else values
+        volume = torch.full([int(np.prod(self.shape))] + list(values.shape[1:]), fill, device = values.device, dtype = values.dtype)
+        volume[self.index.to(values.device)] = values
+        return volume.view(*self.shape, *values.shape[1:])
+
+    def chunks(self, n_chunk = 0):
+        '''
+        Row ranges [start, stop) covering the voxels slice by slice, each slice split into pieces of at most
+        n_chunk rows (0 for whole slices); computations done chunk by chunk then give the same results
+        whether the volume is processed at once or in slabs of slices (see tiling.py)
+        '''
+        per_slice = torch.bincount(self.index // (self.shape[1] * self.shape[2]), minlength = self.shape[0]).tolist()
+        ranges, start = [], 0
+        for n in per_slice:
+            step = n_chunk if n_chunk > 0 else max(n, 1)
+            ranges += [(begin, min(begin + step, start + n)) for begin in range(start, start + n, step)]
+            start += n
+        return ranges
+
+    def rows(self, voxels):
+        '''
+        Rows of voxels given as [slice, row, column] (n, 3); -1 for voxels outside the mask
+        '''
+        voxels = torch.as_tensor(voxels, device = self.index.device).view(-1, 3)
+        flat = (voxels[:, 0] * self.shape[1] + voxels[:, 1]) * self.shape[2] + voxels[:, 2]
+        row = torch.searchsorted(self.index, flat)
+        found = (row < len(self.index)) & (self.index[row.clamp(max = len(self.index) - 1)] == flat)
+        return torch.where(found, row, torch.full_like(row, -1))
+
+    def voxels(self, rows):
+        '''
+        [slice, row, column] of rows # (n, 3)
+        '''
+        flat = self.index[torch.as_tensor(rows, device = self.index.device)]
+        return torch.stack([flat // (self.shape[1] * self.shape[2]), (flat // self.shape[2]) % self.shape[1], flat % self.shape[2]], dim = -1)
 
+
+def cal(raw_perf, config, device):
+    '''
+    Brain mask of the preprocessed signal, computed once as a 3D boolean (slice, row, column):
+    voxels equal to the background (0 after masking for CTP, 1 after the <=0 -> 1 correction for MRP)
+    at all time points are excluded
+    '''
+
+    print('Masking raw data ...')
+    mask = brain_region(raw_perf, device, background = 0 if config.image_type == 'CTP' else 1)
+    print('  Brain voxels: %d of %d' % (int(mask.sum()), mask.numel()))
+
+    return mask
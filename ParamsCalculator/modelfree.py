@@ -0,0 +1,51 @@
+import torch
+
+from precision import compute_dtype
+from ParamsCalculator.deconv import sampling_interval
+
+# Model-free (summary) parameter maps of the CTC: time to peak, peak enhancement, area under curve,
+# first-moment transit time; no AIF or deconvolution needed
+
+MAPS = ['TTP', 'PE', 'AUC', 'FMTT']
+
+# Voxels per chunk, small enough for a chunk to stay in cache while all maps are reduced from it (one read of the CTC)
+CHUNK_VOXELS = 4096
+
+
+def summarize(ctc, dt, bat = 0, dtype = torch.float, chunks = None):
+    '''
+    All model-free maps in one pass over the CTC, chunk by chunk of voxels
+    ctc: (n_voxel, time); bat: bolus arrival time point(s) from 0 (see ctc.baseline), int or (n_voxel)
+    chunks: row ranges (see PackedVolume.chunks), None for chunks of CHUNK_VOXELS rows
+    return: ttp (s), peak enhancement, auc, first-moment transit time (s, from the bolus arrival) # each (n_voxel)
+    '''
+    n_voxel, n_t = ctc.size()
+    # Area and first moment of all voxels of a chunk from one matrix product: curve @ [1, t]
+    weights = torch.stack([torch.ones(n_t, dtype = dtype, device = ctc.device), \
+        torch.arange(n_t, dtype = dtype, device = ctc.device) * dt], dim = -1) * dt
+    ttp  = torch.empty(n_voxel, device = ctc.device, dtype = dtype)
+    peak = torch.empty_like(ttp)
+    moments = torch.empty(n_voxel, 2, device = ctc.device, dtype = dtype)
+    if chunks is None:
+        chunks = [(start, start + CHUNK_VOXELS) for start in range(0, n_voxel, CHUNK_VOXELS)]
+    for start, stop in chunks:
+        curves = ctc[start : stop].to(dtype)
+        values, index = curves.max(dim = -1)
+        peak[start : stop] = values
+        ttp[start : stop]  = index.to(dtype) * dt
+        torch.matmul(curves, weights, out = moments[start : stop])
+    auc = moments[:, 0]
+    arrival = (bat.to(dtype) if torch.is_tensor(bat) else float(bat)) * dt
+    fmtt = torch.where(auc > 0, moments[:, 1] / auc.clamp(min = torch.finfo(dtype).tiny) - arrival, torch.zeros_like(auc))
+    return ttp, peak, auc, fmtt.clamp(min = 0)
+
+
+def cal(ctc, bat, config, device, packed):
+    '''
+    Model-free parameter maps of all brain voxels (others set to 0)
+    ctc: packed (n_voxel, time) with its mask.PackedVolume; bat: bolus arrival time point, global or per voxel (n_voxel)
+    return: {'TTP': ttp, 'PE': peak, 'AUC': auc, 'FMTT': fmtt} # each (slice, row, column)
+    '''
+    print('Calculating model-free parameters (TTP, PE, AUC, FMTT) ...')
+    params = summarize(ctc, sampling_interval(config), bat, compute_dtype(config.precision), packed.chunks(CHUNK_VOXELS))
+    return {name: packed.unpack(values) for name, values in zip(MAPS, params)}
@@ -0,0 +1,354 @@
+import json
+import time
+import torch
+import torch.nn.functional as F
+
+# Rigid inter-frame motion correction: all time frames registered at once to a reference frame by batched
+# Levenberg-Marquardt (coarse to fine in-plane resolutions) on the normalized cross-correlation (NCC) over the brain
+# voxels of the reference, then the whole signal resampled in one pass.
+#
+# Frame t is moved by a rotation R_t (angles about the column/row/slice axes) about the center of the volume and
+# a translation s_t (mm): the registered frame at p (mm, from the center) is the frame sampled at R_t p + s_t.
+# The cost is fixed by motion_points x motion_iterations x motion_levels per frame (not by the image size), only
+# the final resampling goes over all voxels, and only for the frames which moved beyond STILL.
+
+# Coarsest in-plane size (voxels) of a level of the pyramid
+MIN_SIZE = 8
+
+# Relative decrease of the cost (2 - 2 NCC) below which the registration of a frame is converged
+TOLERANCE = 1e-4
+
+# Weight of the squared motion (mm^2) in the cost, relative to the largest curvature of the mismatch of the frame at the
+# start of each level: keeps at rest the directions the images hardly constrain (e.g., along near uniform slices,
+# where interpolating the noise alone would improve the NCC), negligible in the others
+PRIOR = 1e-3
+
+# Voxels x frames interpolated at once when resampling, bounding the memory of the sampling grid and the frame buffer
+RESAMPLE_CHUNK = 2 ** 22
+
+# Largest displacement (fraction of the smallest voxel size) anywhere in the volume below which a frame is kept as is
+# rather than resampled: interpolating it would blur it more than it moved
+STILL = 0.05
+
+
+def rotation(angles, derivatives = False):
+    '''
+    Rotation matrices of angles (n, 3) about the x (column), y (row) and z (slice) axes, R = Rz Ry Rx # (n, 3, 3),
+    and their derivatives with respect to each angle # (n, 3, 3, 3) if asked
+    '''
+    cos, sin = torch.cos(angles), torch.sin(angles)
+    one, zero = torch.ones_like(angles[:, 0]), torch.zeros_like(angles[:, 0])
+    rx = torch.stack([one, zero, zero, zero, cos[:, 0], -sin[:, 0], zero, sin[:, 0], cos[:, 0]], dim = -1).view(-1, 3, 3)
+    ry = torch.stack([cos[:, 1], zero, sin[:, 1], zero, one, zero, -sin[:, 1], zero, cos[:, 1]], dim = -1).view(-1, 3, 3)
+    rz = torch.stack([cos[:, 2], -sin[:, 2], zero, sin[:, 2], cos[:, 2], zero, zero, zero, one], dim = -1).view(-1, 3, 3)
+    if not derivatives:
+        return rz @ ry @ rx
+    drx = torch.stack([zero, zero, zero, zero, -sin[:, 0], -cos[:, 0], zero, cos[:, 0], -sin[:, 0]], dim = -1).view(-1, 3, 3)
+    dry = torch.stack([-sin[:, 1], zero, cos[:, 1], zero, zero, zero, -cos[:, 1], zero, -sin[:, 1]], dim = -1).view(-1, 3, 3)
+    drz = torch.stack([-sin[:, 2], -cos[:, 2], zero, cos[:, 2], -sin[:, 2], zero, zero, zero, zero], dim = -1).view(-1, 3, 3)
+    return rz @ ry @ rx, torch.stack([rz @ ry @ drx, rz @ dry @ rx, drz @ ry @ rx], dim = 1)
+
+
+def transform(points, angles, shifts):
+    '''
+    Points (n, 3) (mm, x y z from the center of the volume) moved by the rigid transform of each frame # (frame, n, 3)
+    '''
+    return torch.einsum('tij,nj->tni', rotation(angles), points) + shifts.unsqueeze(1)
+
+
+def extent(size, spacing):
+    '''
+    Size (mm) of the volume # (3) x y z; size: [n_slice, n_row, n_column]
+    '''
+    return torch.tensor([size[2] * spacing[0], size[1] * spacing[1], size[0] * spacing[2]], dtype = torch.float64)
+
+
+def centers(mask, factor, spacing, full):
+    '''
+    Positions (mm, x y z from the center of the full volume) of the voxels of mask (slice, row, column),
+    a grid downsampled in-plane by factor # (n, 3)
+    full: size (mm) of the full volume, see extent
+    '''
+    index = torch.nonzero(mask).double().flip(-1) # x y z
+    scale = torch.tensor([factor * spacing[0], factor * spacing[1], spacing[2]], dtype = torch.float64)
+    return (index + 0.5) * scale - full / 2
+
+
+def sample(frames, points, factor, spacing, full):
+    '''
+    Frames (frame, 1, slice, row, column), downsampled in-plane by factor, interpolated at points (frame, ..., 3)
+    (mm, as centers) # (frame, ...)
+    '''
+    # align_corners = False: [-1, 1] spans the voxels of the grid, from the same corner as the full volume
+    # (a downsampled grid leaves out the last rows/columns when the size is not a multiple of factor)
+    size = extent(frames.shape[2:], [factor * spacing[0], factor * spacing[1], spacing[2]]).to(points.device, points.dtype)
+    grid = (2 * (points + (full / 2).to(points.device, points.dtype)) / size - 1).to(frames.dtype)
+    grid = grid.view(grid.size(0), 1, 1, -1, 3) if grid.dim() == 3 else grid
+    values = F.grid_sample(frames, grid, mode = 'bilinear', padding_mode = 'border', align_corners = False)
+    return values.view(frames.size(0), *points.shape[1:-1])
+
+
+def normalized(values):
+    '''
+    Values (..., n) minus their mean, of unit norm
+    '''
+    centered = values - values.mean(dim = -1, keepdim = True)
+    return centered / centered.norm(dim = -1, keepdim = True).clamp(min = torch.finfo(values.dtype).tiny)
+
+
+def residuals(level, points, reference, params, factor, spacing, full, jacobian = False):
+    '''
+    Normalized values of each frame at the moved points minus the normalized reference values, whose sum of squares
+    is 2 - 2 NCC # (frame, n), and their jacobian with respect to the params (frame, n, 6) if asked
+    level: frames (frame, 1, slice, row, column) downsampled in-plane by factor; points: (n, 3) mm (see centers)
+    reference: normalized values of the reference frame (n); params: angles (rad) and shifts (mm) # (frame, 6)
+    '''
+    moved = transform(points, params[:, :3], params[:, 3:])
+    if not jacobian:
+        with torch.no_grad():
+            return normalized(sample(level, moved, factor, spacing, full).double()) - reference
+    # Image gradients (mm^-1) at the moved points, from the backward pass of the interpolation
+    moved.requires_grad_(True)
+    values = sample(level, moved, factor, spacing, full)
+    gradient, = torch.autograd.grad(values.sum(), moved)
+    values = values.detach().double()
+    _, derivatives = rotation(params[:, :3], derivatives = True)
+    arcs = (derivatives.view(-1, 9, 3) @ points.t()).view(-1, 3, 3, points.size(0)) # d moved / d angle # (frame, angle, 3, n)
+    J = torch.cat([(arcs * gradient.transpose(1, 2).unsqueeze(1)).sum(dim = 2).transpose(1, 2), gradient], dim = -1)
+    # Through the normalization: mean removed, then projected out of the direction of the values
+    centered = values - values.mean(dim = -1, keepdim = True)
+    norm = centered.norm(dim = -1, keepdim = True).clamp(min = torch.finfo(values.dtype).tiny)
+    unit = centered / norm
+    J = J - J.mean(dim = 1, keepdim = True)
+    J = (J - unit.unsqueeze(-1) * (unit.unsqueeze(1) @ J)) / norm.unsqueeze(-1)
+    return unit - reference, J
+
+
+def levenberg_marquardt(level, points, reference, params, factor, spacing, full, active, iterations = 10, max_step = 1.):
+    '''
+    Batched Levenberg-Marquardt (as gammafit.levenberg_marquardt): every frame has its own damping and stops on its own
+    once converged (relative decrease of its cost <= TOLERANCE, or no decrease possible)
+    The cost of a frame is 2 - 2 NCC plus a PRIOR weight of its squared motion, rotations taken as the arc (mm) they
+    move the edge of the volume.
+    params: (frame, 6) initial; active: (frame) bool, frames registered
+    max_step: largest move (mm) of the shifts, and of the rotations at the edge of the volume, in one step
+    return: params # (frame, 6), cost # (frame) 2 - 2 NCC
+    '''
+    radius = float(full[:2].max()) / 2
+    scale = torch.tensor([1 / radius] * 3 + [1.] * 3, dtype = params.dtype, device = params.device)
+
+    def evaluate(params):
+        e, J = residuals(level, points, reference, params, factor, spacing, full, jacobian = True)
+        return e, J * scale, (e ** 2).sum(dim = -1)
+
+    e, J, mismatch = evaluate(params)
+    weight = PRIOR * (J ** 2).sum(dim = 1).amax(dim = -1)
+    penalty = lambda params: weight * ((params / scale) ** 2).sum(dim = -1)
+    cost = mismatch + penalty(params)
+    damping = torch.full_like(cost, 1e-3)
+    for _ in range(iterations):
+        if not active.any():
+            break
+        JTJ = J.transpose(1, 2) @ J + torch.diag_embed(weight.unsqueeze(-1).expand(-1, 6))
+        grad = (J * e.unsqueeze(-1)).sum(dim = 1) + weight.unsqueeze(-1) * params / scale
+        damped = JTJ + damping.view(-1, 1, 1) * JTJ * torch.eye(6, dtype = JTJ.dtype, device = JTJ.device)
+        step = torch.nan_to_num(torch.linalg.solve(damped, - grad.unsqueeze(-1)).squeeze(-1)) * active.unsqueeze(-1)
+        # Within the range the linearization of the interpolated images holds
+        size = step.abs().amax(dim = -1)
+        trial = params + step * scale * (max_step / size.clamp(min = max_step)).unsqueeze(-1)
+        trial_e, trial_J, trial_mismatch = evaluate(trial)
+        trial_cost = trial_mismatch + penalty(trial)
+
+        better = (trial_cost < cost) & active
+        done = (better & (cost - trial_cost <= TOLERANCE * cost)) | (damping > 1e10)
+        params = torch.where(better.unsqueeze(-1), trial, params)
+        e = torch.where(better.unsqueeze(-1), trial_e, e)
+        J = torch.where(better.view(-1, 1, 1), trial_J, J)
+        mismatch = torch.where(better, trial_mismatch, mismatch)
+        cost = torch.where(better, trial_cost, cost)
+        damping = torch.where(better, damping / 10., torch.where(active, damping * 10., damping))
+        active = active & ~done
+    return params, mismatch
+
+
+def downsample(frames, factor):
+    '''
+    Frames (frame, 1, slice, row, column) averaged over blocks of factor x factor voxels in-plane, as avg_pool3d (rows and
+    columns beyond the last whole block left out) # contiguous (frame, 1, slice, row / factor, column / factor)
+    The blocks are summed in the (slice, row, column, time) layout of the signal frames is a view of (see estimate),
+    time points contiguous, rather than gathered frame by frame
+    '''
+    n_r, n_c = frames.size(3) // factor * factor, frames.size(4) // factor * factor
+    signal = frames[:, 0].permute(1, 2, 3, 0)
+    level = None
+    for i in range(factor):
+        for j in range(factor):
+            block = signal[:, i : n_r : factor, j : n_c : factor]
+            level = block.clone() if level is None else level.add_(block)
+    return level.div_(factor ** 2).permute(3, 0, 1, 2).unsqueeze(1).contiguous()
+
+
+def pyramid(frames, levels):
+    '''
+    Frames downsampled in-plane by 2^(levels - 1), ..., 2, 1 (coarse to fine): [(factor, frames)];
+    slices are few and thick compared to the in-plane voxels in perfusion studies, so never downsampled
+    '''
+    pyramid = []
+    for level in reversed(range(levels)):
+        factor = 2 ** level
+        if factor > 1 and min(frames.shape[3:]) // factor < MIN_SIZE:
+            continue
+        pyramid.append((factor, downsample(frames, factor) if factor > 1 else frames))
+    return pyramid
+
+
+def background(config):
+    '''
+    Value of the voxels outside the brain in the preprocessed signal (see mask.cal), left out of the similarity
+    '''
+    return 0 if config.image_type == 'CTP' else 1
+
+
+def estimate(signal, spacing, config, device, background = 0):
+    '''
+    Rigid transforms of all time frames to the reference frame config.motion_reference
+    signal: (slice, row, column, time); spacing: x y z (mm), None for 1 mm voxels
+    background: value of the voxels outside the brain (left out of the similarity), None for none
+    return: {'angles' (frame, 3) rad, 'shifts' (frame, 3) mm, 'ncc' (frame, 2) before/after, 'displacement' (frame) mean mm
+             over the brain, 'reference', 'seconds'}
+    '''
+    print('Estimating inter-frame motion ...')
+    start = time.time()
+    spacing = [float(v) for v in (spacing if spacing is not None else (1., 1., 1.))]
+    n_t = signal.size(-1)
+    reference = config.motion_reference % n_t
+    full = extent(signal.shape[:3], spacing)
+    # (frame, 1, slice, row, column) view of the signal: points are sampled where they are, floating point signals are
+    # not copied (integer ones are converted once, grid_sample interpolates floating point values only)
+    frames = signal.to(device).permute(3, 0, 1, 2).unsqueeze(1)
+    frames = frames if frames.is_floating_point() else frames.float()
+    frame_mask = (signal[..., reference] != background).unsqueeze(0).unsqueeze(0).float().to(device) if background is not None else None
+
+    params = torch.zeros(n_t, 6, dtype = torch.float64, device = device)
+    active = torch.ones(n_t, dtype = torch.bool, device = device)
+    active[reference] = False
+    for factor, level in pyramid(frames, max(config.motion_levels, 1)):
+        if frame_mask is not None:
+            mask = F.avg_pool3d(frame_mask, (1, factor, factor))[0, 0] > 0.5 if factor > 1 else frame_mask[0, 0] > 0.5
+        else:
+            mask = torch.ones(level.shape[2:], dtype = torch.bool, device = device)
+        points, values = centers(mask.cpu(), factor, spacing, full).to(device), level[reference, 0][mask]
+        if config.motion_points > 0 and points.size(0) > config.motion_points:
+            keep = torch.linspace(0, points.size(0) - 1, config.motion_points, device = device).round().long()
+            points, values = points[keep], values[keep]
+        values = normalized(values.double())
+        # Steps of at most a voxel of the level
+        params, cost = levenberg_marquardt(level, points, values, params, factor, spacing, full, active, config.motion_iterations, \
+            factor * min(spacing[:2]))
+        print('  Level 1/%d: %d brain points, NCC %.4f' % (factor, points.size(0), float(1 - cost.mean() / 2)))
+
+    # Similarity and mean displacement over the brain points of the finest level
+    angles, shifts = params[:, :3], params[:, 3:]
+    before = 1 - (residuals(level, points, values, torch.zeros_like(params), factor, spacing, full) ** 2).sum(dim = -1) / 2
+    after = 1 - cost / 2
+    displacement = (transform(points, angles, shifts) - points).norm(dim = -1).mean(dim = -1)
+    motion = {'angles': angles.cpu(), 'shifts': shifts.cpu(), 'ncc': torch.stack([before, after], dim = -1).cpu(), \
+        'displacement': displacement.cpu(), 'reference': reference, 'seconds': time.time() - start}
+    print('  Mean displacement %.3f mm (max %.3f mm, frame %d), NCC %.4f -> %.4f' % (float(motion['displacement'].mean()), \
+        float(motion['displacement'].max()), int(motion['displacement'].argmax()), float(before.mean()), float(after.mean())))
+    return motion
+
+
+def moving(motion, size, spacing, tolerance = STILL):
+    '''
+    Frames whose largest displacement in the volume (at one of its corners, the transforms being rigid) is at least
+    tolerance times the smallest voxel size, the reference frame left out # (frame) bool
+    size: [n_slice, n_row, n_column]; spacing: x y z (mm)
+    '''
+    half = extent(size, spacing) / 2
+    corners = torch.tensor([[x, y, z] for x in [-1, 1] for y in [-1, 1] for z in [-1, 1]], dtype = torch.float64) * half
+    displacement = (transform(corners, motion['angles'].double(), motion['shifts'].double()) - corners).norm(dim = -1).amax(dim = -1)
+    moved = displacement >= tolerance * min(spacing)
+    moved[motion['reference']] = False
+    return moved
+
+
+def resample(signal, motion, spacing, background = None):
+    '''
+    Signal (slice, row, column, time) with the frames moved by their transforms (see estimate), interpolated in the signal
+    dtype batch by batch of frames (float32 for integer signals, rounded back to their type, and for bfloat16 ones, whose
+    sampling coordinates would be off by a fraction of a voxel); the reference frame and those which hardly moved
+    (see moving) are kept as is
+    background: value of the voxels outside the brain, kept so in all frames where the reference frame is (the
+                moved brain edge would otherwise blur into them, and they need no interpolation), None for none
+    '''
+    print('Resampling the motion corrected signal ...')
+    spacing = [float(v) for v in (spacing if spacing is not None else (1., 1., 1.))]
+    dtype = signal.dtype if signal.is_floating_point() and signal.dtype != torch.bfloat16 else torch.float32
+    n_t, reference = signal.size(-1), motion['reference']
+    inside = signal[..., reference] != background if background is not None else torch.ones(signal.shape[:3], dtype = torch.bool)
+    inside = inside.to(signal.device)
+    rows = inside.view(-1).nonzero()[:, 0]
+
+    # Frames not resampled are copied as they are, voxels outside the brain of the reference set to the background
+    registered = signal.clone(memory_format = torch.contiguous_format)
+    if background is not None:
+        registered.view(-1, n_t)[~inside.view(-1)] = background
+    frames = moving(motion, signal.shape[:3], spacing).nonzero()[:, 0].tolist()
+    print('  %d of %d frames resampled (moved by at least %g voxel)' % (len(frames), n_t, STILL))
+    if not frames:
+        return registered
+
+    # Voxel centers are at x / (size / 2) in the [-1, 1] coordinates of grid_sample (align_corners = False)
+    half = extent(signal.shape[:3], spacing) / 2
+    points = (centers(inside.cpu(), 1, spacing, 2 * half) / half).to(signal.device, dtype) # (n, 3)
+    matrix = (rotation(motion['angles'].double()) * half / half.unsqueeze(-1)).to(signal.device, dtype)
+    offset = (motion['shifts'].double() / half).to(signal.device, dtype)
+    # One buffer of a batch of frames (frame, 1, slice, row, column), filled for each batch in turn; a batch is a run
+    # of consecutive frames, read and written as a slice of the time axis of the signal
+    batch = max(RESAMPLE_CHUNK // max(inside.numel(), 1), 1)
+    runs = []
+    for t in frames:
+        if runs and runs[-1][1] == t and t - runs[-1][0] < batch:
+            runs[-1][1] = t + 1
+        else:
+            runs.append([t, t + 1])
+    buffer = torch.empty(max(stop - start for start, stop in runs), 1, *signal.shape[:3], dtype = dtype, device = signal.device)
+    for start, stop in runs:
+        n = stop - start
+        buffer[:n, 0].copy_(signal[..., start : stop].permute(3, 0, 1, 2))
+        grid = torch.baddbmm(offset[start : stop].unsqueeze(1), points.expand(n, -1, -1), matrix[start : stop].transpose(1, 2))
+        values = F.grid_sample(buffer[:n], grid.unsqueeze(1).unsqueeze(1), mode = 'bilinear', padding_mode = 'border', \
+            align_corners = False).view(n, -1)
+        if not signal.is_floating_point():
+            info = torch.iinfo(signal.dtype)
+            values = values.round_().clamp_(info.min, info.max)
+        registered.view(-1, n_t)[:, start : stop].index_copy_(0, rows, values.t().to(signal.dtype).contiguous())
+    return registered
+
+
+def correct(signal, spacing, config, device, background = 0):
+    '''
+    Motion corrected signal (see estimate and resample), and the motion estimated
+    '''
+    motion = estimate(signal, spacing, config, device, background)
+    return resample(signal, motion, spacing, background), motion
+
+
+def report(motion):
+    '''
+    Per-frame transforms as json: rotations (degrees), shifts (mm), mean displacement over the brain (mm) and NCC
+    with the reference before/after correction
+    '''
+    degrees = torch.rad2deg(motion['angles'])
+    return {'reference': motion['reference'], 'seconds': round(motion['seconds'], 3), \
+        'convention': 'registered frame at p (mm, x y z from the volume center) = frame at R p + shift, R = Rz Ry Rx', \
+        'frames': [{'rotation_deg': [round(v, 4) for v in degrees[t].tolist()], 'shift_mm': [round(v, 4) for v in motion['shifts'][t].tolist()], \
+            'displacement_mm': round(float(motion['displacement'][t]), 4), 'ncc': [round(v, 5) for v in motion['ncc'][t].tolist()]} \
+            for t in range(motion['angles'].size(0))]}
+
+
+def save(motion, FileName):
+    with open(FileName, 'w') as f:
+        json.dump(report(motion), f, indent = 1)
+    return FileName
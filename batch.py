@@ -0,0 +1,191 @@
+import os
+import sys
+import json
+import glob
+import time
+import traceback
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from config import get_parser
+
+'''
+Batch calculation over many studies
+
+Studies are given as a directory (searched recursively for 4D images matching --pattern),
+a text file (one image path per line, optionally followed by a tab and its save folder, by default
+<dirname>/<basename without extension>),
+or a manifest (.json) written by a previous batch, which is then resumed.
+Per-study status ('pending'/'done'/'failed') and timing are kept in the manifest,
+so an interrupted batch does not redo finished studies.
+
+Example:
+    python batch.py --studies /path/to/studies --workers 4
+'''
+
+# Basenames (without extension) of images written by the calculator itself, never studies
+OUTPUT_SUFFIXES = ['_resized', '_masked', '_normalized', '_corrected']
+OUTPUT_NAMES    = ['CTC', 'CTC_filtered']
+
+
+def parse_batch_config(args = None):
+
+    parser = get_parser("Batch CTP/MRP Colormaps Calculation")
+    parser.add_argument('--studies', type = str, required = True, help = 'Directory, list file or manifest (.json) of studies')
+    parser.add_argument('--pattern', type = str, default = '*.nii', help = 'File name pattern of studies in a directory')
+    parser.add_argument('--manifest', type = str, default = None, help = 'Manifest path, default: <studies>/manifest.json')
+    parser.add_argument('--workers', type = int, default = 1, help = 'Number of worker processes')
+    parser.add_argument('--threads_per_worker', type = int, default = 0, help = 'Torch intra-op threads per worker, 0 for cpu_count // workers')
+    parser.add_argument('--retry_failed', type = bool, default = False, help = 'Whether rerun studies failed in a previous batch')
+
+    return parser.parse_args(args)
+
+
+def strip_ext(FileName):
+    for ext in ['.nii.gz', '.nii', '.mha', '.mhd', '.nrrd']:
+        if FileName.endswith(ext):
+            return FileName[:-len(ext)]
+    return os.path.splitext(FileName)[0]
+
+
+def is_study(FileName):
+    '''
+    Whether FileName is a 4D (time series) image not written by the calculator, checked from its header only
+    '''
+    import SimpleITK as sitk
+
+    name = os.path.basename(strip_ext(FileName))
+    if name in OUTPUT_NAMES or any(name.endswith(suffix) for suffix in OUTPUT_SUFFIXES):
+        return False
+    reader = sitk.ImageFileReader()
+    reader.SetFileName(FileName)
+    try:
+        reader.ReadImageInformation()
+    except RuntimeError:
+        return False
+    return reader.GetDimension() == 4 or reader.GetNumberOfComponents() > 1
+
+
+def study_folder(FileName):
+    '''
+    Default save folder of a study: <dirname>/<basename without extension>, so that studies of one folder
+    (calculated at the same time by several workers) never write the same result files
+    '''
+    return strip_ext(FileName)
+
+
+def find_studies(studies, pattern = '*.nii'):
+    '''
+    return: {FileName: SaveFolder}, absolute image paths
+    '''
+    if os.path.isdir(studies):
+        files = sorted(glob.glob(os.path.join(os.path.abspath(studies), '**', pattern), recursive = True))
+        return {FileName: study_folder(FileName) for FileName in files if is_study(FileName)}
+    found = {}
+    with open(studies) as f:
+        for line in f:
+            if not line.strip() or line.startswith('#'):
+                continue
+            items = line.rstrip('\n').split('\t')
+            FileName = os.path.abspath(items[0].strip())
+            found[FileName] = items[1].strip() if len(items) > 1 else study_folder(FileName)
+    return found
+
+
+class Manifest(object):
+    '''
+    Per-study status and timing, saved (atomically) as json after every change
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.studies = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                self.studies = json.load(f)['studies']
+
+    def add(self, FileName, SaveFolder):
+        if FileName not in self.studies:
+            self.studies[FileName] = {'save_folder': SaveFolder, 'status': 'pending'}
+
+    def todo(self, retry_failed = False):
+        status = ['pending'] + (['failed'] if retry_failed else [])
+        return [FileName for FileName, study in self.studies.items() if study['status'] in status]
+
+    def update(self, FileName, **entries):
+        self.studies[FileName].update(entries)
+        self.save()
+
+    def save(self):
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'studies': self.studies}, f, indent = 2)
+        os.replace(tmp, self.path)
+
+
+def init_worker(n_threads):
+    # Set before torch (and its BLAS) is imported by the worker, to avoid oversubscribing the machine
+    for var in ['OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS']:
+        os.environ[var] = str(n_threads)
+    import torch
+    torch.set_num_threads(n_threads)
+
+
+def run_study(FileName, SaveFolder, config):
+    import torch
+    from main import run
+    from utils import get_logger
+
+    started = time.strftime('%Y-%m-%d %H:%M:%S')
+    start = time.time()
+    logger = get_logger('Perfusion Parameters Calculation [%s]' % os.path.basename(FileName))
+    device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+    os.makedirs(SaveFolder, exist_ok = True)
+    run(FileName, SaveFolder, config, device, logger)
+    return started, time.time() - start
+
+
+def main():
+
+    config = parse_batch_config()
+    if config.manifest is None:
+        config.manifest = os.path.join(config.studies if os.path.isdir(config.studies) else os.path.dirname(config.studies), 'manifest.json')
+
+    manifest = Manifest(config.studies if config.studies.endswith('.json') else config.manifest)
+    if not config.studies.endswith('.json'):
+        for FileName, SaveFolder in find_studies(config.studies, config.pattern).items():
+            manifest.add(FileName, SaveFolder)
+    manifest.save()
+    todo = manifest.todo(config.retry_failed)
+    print('Batch: %d studies, %d to run, manifest: %s' % (len(manifest.studies), len(todo), manifest.path))
+
+    n_workers = max(min(config.workers, len(todo)), 1)
+    n_threads = config.threads_per_worker if config.threads_per_worker > 0 else max(os.cpu_count() // n_workers, 1)
+    print('  %d worker(s) x %d thread(s)' % (n_workers, n_threads))
+
+    # spawn: workers do not inherit torch/CUDA state of the parent
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers = n_workers, mp_context = context, initializer = init_worker, initargs = (n_threads,)) as pool:
+        futures = {}
+        for FileName in todo:
+            futures[pool.submit(run_study, FileName, manifest.studies[FileName]['save_folder'], config)] = FileName
+        for future in as_completed(futures):
+            FileName = futures[future]
+            finished = time.strftime('%Y-%m-%d %H:%M:%S')
+            try:
+                started, seconds = future.result()
+                manifest.update(FileName, status = 'done', started = started, finished = finished, seconds = round(seconds, 3), error = None)
+                print('  Done   (%.1f s): %s' % (seconds, FileName))
+            except Exception as e:
+                error = ''.join(traceback.format_exception_only(type(e), e)).strip()
+                manifest.update(FileName, status = 'failed', finished = finished, error = error)
+                print('  Failed: %s\n    %s' % (FileName, error))
+
+    status = [study['status'] for study in manifest.studies.values()]
+    print('Batch finished: %d done, %d failed' % (status.count('done'), status.count('failed')))
+    return 1 if 'failed' in status else 0
+
+
+########################################################################################################################
+
+if __name__ == '__main__':
+    sys.exit(main())
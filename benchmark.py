@@ -0,0 +1,212 @@
+import os
+import sys
+import copy
+import json
+import time
+import shutil
+import platform
+import tempfile
+import resource
+import contextlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+from config import get_parser
+
+'''
+Stage-by-stage benchmark on synthetic phantoms (see phantom.py), no patient data needed
+
+Each case (read_signal, ctc.cal without/with filtering, the calculator end to end) runs in a fresh process
+for every image type and size, so that its peak RSS is not hidden by earlier cases; the fastest of --repeat runs
+is kept. With --scaling_workers, the calculator is also run end to end sharded over each number of worker processes
+(one thread each, see sharding.py), reporting its speedup and parallel efficiency against the first number.
+Results (wall time, voxels/s, peak RSS) are saved as json, and compared against a previous one (--baseline):
+the benchmark fails (exit code 1) if any case is slower, or its own memory (peak RSS over the peak before the case,
+i.e., without the imports and the setup) larger, beyond --tolerance.
+
+Example:
+    python benchmark.py --sizes 8x128x128x40 16x256x256x40 --output baseline.json
+    python benchmark.py --sizes 8x128x128x40 16x256x256x40 --baseline baseline.json --output current.json
+    python benchmark.py --sizes 32x512x512x40 --cases --scaling_workers 1 2 4 8 16 32 --output scaling.json
+'''
+
+CASES = ['read_signal', 'ctc', 'ctc_filtered', 'motion', 'end_to_end']
+
+
+def parse_benchmark_config(args = None):
+
+    parser = get_parser("Benchmark of CTP/MRP Colormaps Calculation")
+    parser.add_argument('--sizes', type = str, nargs = '+', default = ['8x128x128x40', '16x256x256x40'], \
+        help = 'Phantom sizes as <slices>x<rows>x<columns>x<time points>')
+    parser.add_argument('--image_types', type = str, nargs = '+', default = ['CTP', 'MRP'], help = 'Image types of phantoms: CTP/MRP')
+    parser.add_argument('--cases', type = str, nargs = '*', default = CASES, help = 'Benchmark cases: %s' % '/'.join(CASES))
+    parser.add_argument('--repeat', type = int, default = 3, help = 'Runs of each case, the fastest is kept')
+    parser.add_argument('--threads', type = int, default = 0, help = 'Torch intra-op threads, 0 for the torch default')
+    parser.add_argument('--scaling_workers', type = int, nargs = '*', default = [], help = 'Numbers of worker processes of the sharded \
+        end-to-end scaling cases, e.g., 1 2 4 8 16 32 (empty for none)')
+    parser.add_argument('--workdir', type = str, default = '', help = 'Directory of phantoms and outputs, empty for a temporary one')
+    parser.add_argument('--output', type = str, default = 'benchmark.json', help = 'Results (json)')
+    parser.add_argument('--baseline', type = str, default = '', help = 'Previous results (json) to compare against')
+    parser.add_argument('--tolerance', type = float, default = 0.2, help = 'Allowed relative increase of time/peak RSS of the case itself over the baseline')
+
+    return parser.parse_args(args)
+
+
+def parse_size(size):
+    n_s, n_r, n_c, n_t = [int(n) for n in size.lower().split('x')]
+    return (n_s, n_r, n_c), n_t
+
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+
+def run_case(case, FileName, SaveFolder, config, repeat = 3, threads = 0):
+    '''
+    Run one case repeat times in this (fresh) process
+    return: {'seconds': fastest wall time, 'peak_rss_mb': process peak RSS, 'setup_rss_mb': peak RSS before the case}
+    '''
+    seconds = []
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        import torch
+        import main
+        import ParamsCalculator.ctc as ctc
+        from utils import get_logger
+        from writer import ImageWriter
+        from precision import storage_dtype
+        from signal_reader import read_signal
+
+        if threads > 0:
+            torch.set_num_threads(threads)
+        device = torch.device('cpu')
+        # Intermediate images are not written, except by the end-to-end case (as configured)
+        writer = ImageWriter(intermediates = [])
+        read = lambda: read_signal(FileName, config.image_type, ToTensor = True, Mask = config.mask, Writer = writer, \
+            Precision = config.precision, PercentileError = config.percentile_error)
+
+        if case == 'read_signal':
+            setup_rss = peak_rss_mb()
+            fn = read
+        elif case in ['ctc', 'ctc_filtered']:
+            signal, origin, spacing, direction = read()
+            if signal.is_floating_point():
+                signal = signal.to(storage_dtype(config.precision))
+            config.use_filter = case == 'ctc_filtered'
+            setup_rss = peak_rss_mb()
+            fn = lambda: ctc.cal(signal, [origin, spacing, direction, SaveFolder], config, device, writer)
+        elif case == 'motion':
+            import ParamsCalculator.motion as motion
+            signal, origin, spacing, direction = read()
+            if signal.is_floating_point():
+                signal = signal.to(storage_dtype(config.precision))
+            setup_rss = peak_rss_mb()
+            fn = lambda: motion.correct(signal, spacing, config, device, motion.background(config))
+        elif case == 'end_to_end':
+            logger = get_logger('Benchmark')
+            setup_rss = peak_rss_mb()
+            fn = lambda: main.run(FileName, SaveFolder, config, device, logger)
+        else:
+            raise ValueError('Unknown benchmark case: %s (choose from %s)' % (case, ', '.join(CASES)))
+        for _ in range(repeat):
+            start = time.perf_counter()
+            fn()
+            seconds.append(time.perf_counter() - start)
+    return {'seconds': min(seconds), 'peak_rss_mb': peak_rss_mb(), 'setup_rss_mb': setup_rss}
+
+
+def case_rss_mb(result):
+    '''
+    Peak RSS (MB) of the case itself: the process peak over the one before the case (imports, phantom reading)
+    '''
+    return result['peak_rss_mb'] - result['setup_rss_mb']
+
+
+def compare(results, baseline, tolerance = 0.2):
+    '''
+    Time and memory of the case itself (see case_rss_mb) against the baseline
+    return: regressions as (name, metric, baseline value, current value)
+    '''
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        for metric, value in [('seconds', lambda result: result['seconds']), ('case_rss_mb', case_rss_mb)]:
+            before, after = value(baseline[name]), value(result)
+            if after > before * (1. + tolerance):
+                regressions.append((name, metric, before, after))
+    return regressions
+
+
+def main():
+
+    from phantom import phantom, save
+
+    config = parse_benchmark_config()
+    config.cache_dir = '' # stage results are never reused across runs
+    workdir = config.workdir if config.workdir else tempfile.mkdtemp(prefix = 'perfusion_benchmark_')
+    os.makedirs(workdir, exist_ok = True)
+
+    import torch
+    machine = {'platform': platform.platform(), 'processor': platform.processor(), 'cpu_count': os.cpu_count(), \
+        'python': platform.python_version(), 'torch': torch.__version__, 'threads': config.threads if config.threads > 0 else torch.get_num_threads()}
+    results = {}
+    context = multiprocessing.get_context('spawn')
+    try:
+        for image_type in config.image_types:
+            for size in config.sizes:
+                shape, n_t = parse_size(size)
+                FileName = os.path.join(workdir, '%s_%s.nii' % (image_type, size))
+                if not os.path.exists(FileName):
+                    save(phantom(shape, n_t, image_type, config.TR if image_type == 'MRP' else config.ct_interval)[0], FileName)
+                SaveFolder = os.path.join(workdir, '%s_%s' % (image_type, size))
+                os.makedirs(SaveFolder, exist_ok = True)
+                case_config = copy.copy(config)
+                case_config.image_type = image_type
+                case_config.mask = [[], [], []] if image_type == 'CTP' else [0] # whole phantom
+                n_voxel = shape[0] * shape[1] * shape[2]
+                cases = [(case, case, case_config) for case in config.cases]
+                for n_workers in config.scaling_workers:
+                    sharded_config = copy.copy(case_config)
+                    sharded_config.shard_workers = n_workers
+                    sharded_config.shard_threads = config.shard_threads if config.shard_threads > 0 else 1
+                    cases.append(('sharded_%d' % n_workers, 'end_to_end', sharded_config))
+                reference = None
+                for case_name, case, case_config in cases:
+                    with ProcessPoolExecutor(max_workers = 1, mp_context = context) as pool:
+                        result = pool.submit(run_case, case, FileName, SaveFolder, case_config, config.repeat, config.threads).result()
+                    result['voxels_per_s'] = n_voxel / result['seconds']
+                    name = '%s/%s/%s' % (image_type, size, case_name)
+                    results[name] = result
+                    print('%-32s %8.3f s %12.0f voxels/s  peak RSS %8.1f MB (case +%.1f MB)' % \
+                        (name, result['seconds'], result['voxels_per_s'], result['peak_rss_mb'], case_rss_mb(result)))
+                    if case_name.startswith('sharded_'):
+                        # Speedup and parallel efficiency against the first number of workers
+                        n_workers = case_config.shard_workers
+                        reference = (result['seconds'], n_workers) if reference is None else reference
+                        result['speedup'] = reference[0] / result['seconds']
+                        result['efficiency'] = result['speedup'] * reference[1] / n_workers
+                        print('%-32s speedup %6.2f x, efficiency %5.1f%% (vs %d worker(s))' % \
+                            ('', result['speedup'], result['efficiency'] * 100, reference[1]))
+    finally:
+        if not config.workdir:
+            shutil.rmtree(workdir, ignore_errors = True)
+
+    with open(config.output, 'w') as f:
+        json.dump({'machine': machine, 'repeat': config.repeat, 'results': results}, f, indent = 2)
+    print('Save benchmark results as:', config.output)
+
+    if config.baseline:
+        with open(config.baseline) as f:
+            baseline = json.load(f)['results']
+        regressions = compare(results, baseline, config.tolerance)
+        for name, metric, before, after in regressions:
+            print('  Regression: %s %s %.3f -> %.3f' % (name, metric, before, after))
+        print('Compared against %s: %d regression(s) beyond %.0f%%' % (config.baseline, len(regressions), config.tolerance * 100))
+        return 1 if regressions else 0
+    return 0
+
+
+########################################################################################################################
+
+if __name__ == '__main__':
+    sys.exit(main())
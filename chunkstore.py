@@ -0,0 +1,176 @@
+import os
+import json
+import zlib
+import itertools
+import numpy as np
+
+'''
+Chunked, compressed on-disk store of 4D arrays (slice, row, column, time) for intermediates (CTC, normalized signal),
+written slab by slab of slices and queried by voxel/ROI time curves or time frames reading only the chunks needed
+
+A store is a directory: meta.json (shape, dtype, chunk shape, compression level and attributes, e.g., the image
+geometry), data.bin (the zlib-compressed chunks one after another, as written) and index.npy (offset and size
+of each chunk in data.bin, in C order of the chunk grid).
+
+Example:
+    store = ChunkStore.open('results/CTC.chunks')
+    curve = store.curve(4, 120, 96)              # (time)
+    roi   = store[4, 100:110, 90:100, :]         # (row, column, time)
+    frame = store.frame(12)                      # (slice, row, column)
+'''
+
+# One slice, 64 x 64 voxels and one time point per chunk: a voxel curve is n_time small chunks,
+# a time frame one chunk per 64 x 64 block of each slice
+CHUNKS = (1, 64, 64, 1)
+
+
+class ChunkStore(object):
+    '''
+    Open with ChunkStore.create (writing) or ChunkStore.open (reading)
+    '''
+    def __init__(self, path, meta, index, mode = 'r'):
+        self.path = path
+        self.meta = meta
+        self.shape = tuple(meta['shape'])
+        self.dtype = np.dtype(meta['dtype'])
+        self.chunks = tuple(meta['chunks'])
+        self.attrs = meta.get('attrs', {})
+        self.grid = tuple(-(-n // c) for n, c in zip(self.shape, self.chunks))
+        self.index = index
+        self.mode = mode
+        self.fd = os.open(os.path.join(path, 'data.bin'), os.O_RDONLY if mode == 'r' else os.O_WRONLY | os.O_CREAT | os.O_TRUNC)
+        self.offset = 0
+        self.written = 0 # slices written
+        self.pending = [] # slabs written but not yet forming whole chunks of slices
+
+    @classmethod
+    def create(cls, path, shape, dtype, chunks = CHUNKS, level = 1, attrs = None):
+        '''
+        New (empty) store at path, replacing any previous one
+        '''
+        os.makedirs(path, exist_ok = True)
+        shape = [int(n) for n in shape]
+        chunks = [max(min(int(c), n), 1) for c, n in zip(chunks, shape)]
+        meta = {'shape': shape, 'dtype': np.dtype(dtype).str, 'chunks': chunks, 'compression': 'zlib', 'level': int(level), \
+            'attrs': attrs or {}}
+        n_chunks = int(np.prod([-(-n // c) for n, c in zip(shape, chunks)]))
+        return cls(path, meta, np.full((n_chunks, 2), -1, dtype = np.int64), 'w')
+
+    @classmethod
+    def open(cls, path):
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        return cls(path, meta, np.load(os.path.join(path, 'index.npy')), 'r')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+        return False
+
+    def chunk_id(self, key):
+        return int(np.ravel_multi_index(key, self.grid))
+
+    def write(self, start, slab):
+        '''
+        Write slab (n, row, column, time) as slices [start, start + n); slabs are written in order of slices,
+        chunks are compressed once all their slices are written
+        '''
+        if self.mode != 'w':
+            raise ValueError('Store opened for reading: %s' % self.path)
+        if start != self.written:
+            raise ValueError('Slabs should be written in order of slices: slice %d written, expected %d' % (start, self.written))
+        self.pending.append(np.asarray(slab, dtype = self.dtype))
+        self.written += len(slab)
+        n_slice = self.chunks[0]
+        pending = np.concatenate(self.pending) if len(self.pending) > 1 else self.pending[0]
+        first = self.written - len(pending)
+        n_done = len(pending) if self.written == self.shape[0] else len(pending) // n_slice * n_slice
+        for begin in range(0, n_done, n_slice):
+            self.write_chunks((first + begin) // n_slice, pending[begin : begin + n_slice])
+        self.pending = [pending[n_done:]] if n_done < len(pending) else []
+
+    def write_chunks(self, s, slab):
+        '''
+        Compress and append all chunks of the s-th chunk of slices
+        '''
+        for key in itertools.product([s], *[range(n) for n in self.grid[1:]]):
+            block = slab[(slice(None),) + tuple(slice(k * c, (k + 1) * c) for k, c in zip(key[1:], self.chunks[1:]))]
+            data = zlib.compress(np.ascontiguousarray(block).tobytes(), self.meta['level'])
+            os.write(self.fd, data)
+            self.index[self.chunk_id(key)] = [self.offset, len(data)]
+            self.offset += len(data)
+
+    def close(self):
+        if self.fd is None:
+            return
+        if self.mode == 'w':
+            if self.written != self.shape[0]:
+                raise ValueError('Store closed with %d of %d slices written: %s' % (self.written, self.shape[0], self.path))
+            os.close(self.fd)
+            np.save(os.path.join(self.path, 'index.npy'), self.index)
+            tmp = os.path.join(self.path, '.meta.json')
+            with open(tmp, 'w') as f:
+                json.dump(self.meta, f, indent = 2)
+            os.replace(tmp, os.path.join(self.path, 'meta.json'))
+        else:
+            os.close(self.fd)
+        self.fd = None
+
+    def read_chunk(self, key):
+        shape = [min(c, n - k * c) for k, c, n in zip(key, self.chunks, self.shape)]
+        offset, size = self.index[self.chunk_id(key)]
+        if offset < 0:
+            return np.zeros(shape, dtype = self.dtype)
+        return np.frombuffer(zlib.decompress(os.pread(self.fd, int(size), int(offset))), dtype = self.dtype).reshape(shape)
+
+    def __getitem__(self, key):
+        '''
+        Region given by ints and slices (step 1) of (slice, row, column, time), reading only the chunks it covers;
+        dimensions indexed by ints are dropped as by numpy
+        '''
+        key = key if isinstance(key, tuple) else (key,)
+        key = key + (slice(None),) * (4 - len(key))
+        ranges, squeeze = [], []
+        for dim, (k, n) in enumerate(zip(key, self.shape)):
+            if isinstance(k, slice):
+                start, stop, step = k.indices(n)
+                if step != 1:
+                    raise ValueError('Only slices of step 1 are supported, got %s' % k)
+                ranges.append((start, max(stop, start)))
+            else:
+                k = int(k) + (n if int(k) < 0 else 0)
+                if not 0 <= k < n:
+                    raise IndexError('Index %d out of range of size %d' % (k, n))
+                ranges.append((k, k + 1))
+                squeeze.append(dim)
+        out = np.empty([stop - start for start, stop in ranges], dtype = self.dtype)
+        chunk_ranges = [range(start // c, -(-stop // c)) for (start, stop), c in zip(ranges, self.chunks)]
+        for chunk in itertools.product(*chunk_ranges):
+            block = self.read_chunk(chunk)
+            src, dst = [], []
+            for k, c, (start, stop) in zip(chunk, self.chunks, ranges):
+                begin, end = max(start, k * c), min(stop, (k + 1) * c)
+                src.append(slice(begin - k * c, end - k * c))
+                dst.append(slice(begin - start, end - start))
+            out[tuple(dst)] = block[tuple(src)]
+        return out.squeeze(axis = tuple(squeeze)) if squeeze else out
+
+    def curve(self, s, r, c):
+        '''
+        Time curve of voxel [s, r, c] # (time)
+        '''
+        return self[s, r, c, :]
+
+    def roi(self, slices, rows, columns):
+        '''
+        Time curves of the voxels of a box, each given as [min, max) # (slice, row, column, time)
+        '''
+        return self[slice(*slices), slice(*rows), slice(*columns), :]
+
+    def frame(self, t):
+        '''
+        Time frame t # (slice, row, column)
+        '''
+        return self[:, :, :, t]
@@ -4,9 +4,9 @@ class Config:
     def __init__(self, **entries):
         self.__dict__.update(entries)
 
-def parse_config():
+def get_parser(description = "CTP Colormaps Calculation"):
 
-    parser = argparse.ArgumentParser(description = "CTP Colormaps Calculation")
+    parser = argparse.ArgumentParser(description = description)
     
     parser.add_argument('--image_type', type = str, default = 'CTP', help = 'Image type: CTP/MRP')
 
@@ -18,15 +18,98 @@ def parse_config():
     parser.add_argument('--TR', type = float, default = 1.55, help = 'Constant TR (s) for MRP')
     # Usually, need filter for MRP, no need for CTP
     parser.add_argument('--use_filter', type = bool, default = False, help = 'Whether use low-pass filtering for CTC')
+    parser.add_argument('--filter_kernel_size', type = int, default = 3, help = 'Kernel size (odd) of the temporal median filter for CTC')
+    parser.add_argument('--filter_threads', type = int, default = 0, help = 'CPU threads for the temporal median filter, 0 for all torch threads')
     parser.add_argument('--mrp_s0_threshold', type = float, default = 0.05, help = 'Threshold for finding MRP bolus arrival time ')
     parser.add_argument('--ctp_s0_threshold', type = float, default = 0.05, help = 'Threshold for finding CTP bolus arrival time ')
+    parser.add_argument('--per_voxel_bat', type = bool, default = False, help = 'Whether use the bolus arrival time and S0 of each voxel, \
+        instead of those of the mean curve, and save BAT/S0 maps')
+    parser.add_argument('--percentile_error', type = float, default = 1e-4, help = 'Error bound of the CTP clipping percentiles relative to \
+        the signal range (histogram bin width), exact for 8/16-bit integer signals')
+    # CTC conversion: whole volume in one broadcast, or slab by slab within a memory budget
+    parser.add_argument('--ctc_in_place', type = bool, default = False, help = 'Whether overwrite the (float32) raw signal with its CTC')
+    parser.add_argument('--precision', type = str, default = 'float32', help = 'Precision of the signal and CTC: float64/float32/bfloat16, \
+        reductions are accumulated in at least float32, integer MRP signals are kept as stored until the CTC is computed')
+    parser.add_argument('--accuracy_report', type = bool, default = False, help = 'Whether also compute a float64 reference of the study \
+        and save the errors of the chosen precision against it (accuracy.json)')
+    parser.add_argument('--ctc_memory_budget', type = float, default = 0, help = 'Memory budget (MB) for CTC temporaries, 0 for no slab splitting')
+    parser.add_argument('--tile_memory_budget', type = float, default = 0, help = 'Memory budget (MB) of a tile of slices processed at once, \
+        the study being streamed tile by tile from the image file (no cache or intermediate images), 0 for the whole study at once')
+    parser.add_argument('--shard_workers', type = int, default = 0, help = 'Worker processes sharding the study by slices on the CPU \
+        (signal and CTC in shared memory), 0 for a single process')
+    parser.add_argument('--shard_threads', type = int, default = 0, help = 'Torch/BLAS threads of each shard worker, 0 for cpu_count // shard_workers')
 
+    ################## Motion Correction Settings ##################
+    parser.add_argument('--motion_correction', type = bool, default = False, help = 'Whether rigidly register all time frames to a reference \
+        frame (batched multi-resolution NCC optimization over the brain) and resample the signal before the CTC, transforms saved in --motion_report')
+    parser.add_argument('--motion_reference', type = int, default = 0, help = 'Time frame all frames are registered to (negative from the end)')
+    parser.add_argument('--motion_levels', type = int, default = 3, help = 'Resolution levels of the registration, in-plane downsampled by 2^(levels - 1), ..., 2, 1')
+    parser.add_argument('--motion_iterations', type = int, default = 8, help = 'Levenberg-Marquardt iterations of the registration per resolution level')
+    parser.add_argument('--motion_points', type = int, default = 2048, help = 'Brain voxels (evenly subsampled) of the similarity per level, \
+        bounding the registration cost whatever the image size, 0 for all')
+    parser.add_argument('--motion_report', type = str, default = 'motion.json', help = 'Per-frame transforms (json) of the motion correction, \
+        saved in the save folder')
+
+    ################## Deconvolution Settings ##################
+    parser.add_argument('--aif_voxels', type = int, nargs = '*', default = [], help = 'Manually picked AIF voxels, as flattened slice row column triplets, \
+        empty for automatic AIF selection')
+    parser.add_argument('--aif_peak_fraction', type = float, default = 0.05, help = 'Fraction of voxels with the highest peaks screened as AIF candidates')
+    parser.add_argument('--aif_candidates', type = int, default = 500, help = 'Maximum number of AIF candidate voxels to be clustered')
+    parser.add_argument('--aif_clusters', type = int, default = 5, help = 'Number of k-means clusters of AIF candidates')
+    parser.add_argument('--ct_interval', type = float, default = 1.0, help = 'Time (s) between two time points for CTP')
+    parser.add_argument('--svd_threshold', type = float, default = 0.2, help = 'Relative singular value threshold for truncated SVD deconvolution')
+    parser.add_argument('--block_circulant', type = bool, default = False, help = 'Whether use block-circulant (delay-insensitive) SVD deconvolution, \
+        Tmax is then negative for tissue leading the AIF')
+
+    parser.add_argument('--model_free', type = bool, default = False, help = 'Whether also save model-free maps from the CTC: time to peak (TTP), \
+        peak enhancement (PE), area under curve (AUC) and first-moment transit time after the bolus arrival (FMTT)')
+    parser.add_argument('--gamma_fit', type = bool, default = False, help = 'Whether fit gamma-variates to the CTC of all brain voxels \
+        (batched Levenberg-Marquardt from the bolus arrival time) and save parameter (GV_peak/t0/alpha/tmax), residual and convergence maps')
+    parser.add_argument('--gamma_fit_iterations', type = int, default = 50, help = 'Maximum Levenberg-Marquardt iterations of the gamma-variate fits')
+    parser.add_argument('--gamma_fit_tolerance', type = float, default = 1e-4, help = 'Relative cost decrease (or parameter change) below which a gamma-variate fit is converged')
+    parser.add_argument('--gamma_fit_tail', type = float, default = 0.3, help = 'Fraction of the peak below which the curve after its peak \
+        is left out of the gamma-variate fit (recirculation)')
+
+    ################## Output Settings ##################
+    parser.add_argument('--save_intermediates', type = str, default = 'resized,masked,normalized,corrected,ctc,ctc_filtered', \
+        help = "Comma-separated intermediate outputs to save (resized/masked/normalized/corrected/ctc/ctc_filtered), 'none' for none")
+    parser.add_argument('--output_ext', type = str, default = '.nii', help = 'Extension of saved images: .nii/.nii.gz')
+    parser.add_argument('--compression_level', type = int, default = -1, help = 'Compression level for .nii.gz, -1 for ITK default')
+    parser.add_argument('--writer_threads', type = int, default = 2, help = 'Background threads for writing images, 0 for synchronous writing')
+    parser.add_argument('--writer_queue_size', type = int, default = 4, help = 'Maximum number of images pending in the writer queue')
+    parser.add_argument('--writer_queue_memory', type = float, default = 0, help = 'Maximum memory (MB) of the images pending in the writer queue, \
+        0 for no limit but --writer_queue_size; counted within --tile_memory_budget')
+    parser.add_argument('--chunk_store', type = str, default = '', help = "Comma-separated 4D intermediate outputs also saved as chunked \
+        compressed stores (<name>.chunks, see chunkstore.py) for fast voxel/ROI curve and time frame reads (ctc/ctc_filtered/normalized/corrected)")
+    parser.add_argument('--chunk_shape', type = int, nargs = 4, default = [1, 64, 64, 1], help = 'Chunk shape (slice, row, column, time) of the stores')
+    parser.add_argument('--chunk_compression', type = int, default = 1, help = 'zlib compression level (0-9) of the stores')
+
+    parser.add_argument('--cache_dir', type = str, default = '', help = 'Directory caching stage results across runs, empty for no caching \
+        (the reading is not cached while any of resized/masked/normalized/corrected is saved, see --save_intermediates)')
+    parser.add_argument('--cache_size', type = float, default = 20.0, help = 'Maximum cache size (GB), least recently used results are evicted')
+
+    parser.add_argument('--qc_report', type = str, default = 'qc_report.json', help = 'QC report (json) of the signal and CTC \
+        (NaN/Inf counts, min/max/mean per slice and frame, non-positive and saturated values), saved in the save folder, empty for none')
+    parser.add_argument('--qc_saturation', type = float, default = 0, help = 'Signal value counted as saturated from, \
+        0 for the maximum of integer signal types')
+
+    ################## Instrumentation Settings ##################
+    parser.add_argument('--instrument', type = bool, default = False, help = 'Whether record per-stage wall/CPU time, peak memory and throughput')
+    parser.add_argument('--run_report', type = str, default = 'run_report.json', help = 'Run report (json) of the stage metrics, saved in the save folder')
+    parser.add_argument('--tensorboard_dir', type = str, default = '', help = 'Directory of TensorBoard logs of the stage metrics, empty for none')
+
+    parser.add_argument('--dicom_threads', type = int, default = 0, help = 'Threads reading a DICOM series (input directory), 0 for min(32, cpu_count + 4)')
     parser.add_argument('--to_tensor', type = bool, default = True, help = 'Whether need to convert to torch.tensor')
     parser.add_argument('--mask', type = list, default = [[], [0,489], [60,501]], help = "Used as BackGround Code for MRP, \
         while BrainMask -300 for CTP (UNC)") 
         # default: 0 for MRP, [[], [0,489], [60,501]] for CTP (UNC)
 
-    args = parser.parse_args()
+    return parser
+
+
+def parse_config(args = None):
+
+    args = get_parser().parse_args(args)
 
     return args
 
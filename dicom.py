@@ -0,0 +1,304 @@
+import os
+import sys
+import json
+import hashlib
+import argparse
+import numpy as np
+import SimpleITK as sitk
+from concurrent.futures import ThreadPoolExecutor
+
+'''
+Parallel reading of a 4D perfusion DICOM series straight into a (slice, row, column, time) array
+
+Headers of all files are read by a thread pool, the files of the series are grouped into slices by their
+position along the slice normal and ordered in time within each slice (temporal position, trigger time,
+acquisition time, acquisition/instance number), then the pixel data are read by the thread pool directly
+into one preallocated array; no NIfTI is written on the way.
+
+DicomIndex keeps a persistent index of a DICOM archive (SeriesInstanceUID -> sorted files), updated by
+revisiting only the directories whose mtime changed.
+
+Example:
+    python dicom.py --index /path/to/archive
+'''
+
+SERIES_UID = '0020|000e'
+# Tags ordering the files of one slice in time, the first one present (and varying) is used
+TEMPORAL_TAGS = [('0020|0100', 'temporal position'), ('0020|9128', 'temporal position index'), ('0018|1060', 'trigger time'), \
+    ('0008|0032', 'acquisition time'), ('0020|0012', 'acquisition number'), ('0020|0013', 'instance number')]
+
+
+def dicom_threads(threads = 0):
+    return threads if threads > 0 else min(32, (os.cpu_count() or 1) + 4)
+
+
+def seconds(value):
+    '''
+    DICOM time (HHMMSS.FFFFFF) as seconds of the day
+    '''
+    value = value.strip()
+    return int(value[0:2] or 0) * 3600 + int(value[2:4] or 0) * 60 + float(value[4:] or 0)
+
+
+def read_header(FileName):
+    '''
+    return: {'file', 'series', 'origin', 'spacing', 'direction', 'size', 'pixel_id', tags of TEMPORAL_TAGS}, None if not a DICOM image
+    '''
+    reader = sitk.ImageFileReader()
+    reader.SetImageIO('GDCMImageIO')
+    reader.SetFileName(FileName)
+    try:
+        reader.ReadImageInformation()
+    except RuntimeError:
+        return None
+    header = {'file': FileName, 'series': reader.GetMetaData(SERIES_UID).strip() if reader.HasMetaDataKey(SERIES_UID) else '', \
+        'origin': reader.GetOrigin(), 'spacing': reader.GetSpacing(), 'direction': reader.GetDirection(), \
+        'size': reader.GetSize(), 'pixel_id': reader.GetPixelID()}
+    for tag, _ in TEMPORAL_TAGS:
+        if reader.HasMetaDataKey(tag) and reader.GetMetaData(tag).strip():
+            value = reader.GetMetaData(tag).strip()
+            try:
+                header[tag] = seconds(value) if tag == '0008|0032' else float(value)
+            except ValueError:
+                pass
+    return header
+
+
+class DicomSeries(object):
+    '''
+    4D perfusion DICOM series in a directory (searched recursively)
+
+    series_uid: SeriesInstanceUID to read, None for the series with the most files
+    files: files of the series (e.g., from an index of the directory), None for scanning the directory
+    threads: reading threads, 0 for min(32, cpu_count + 4)
+    '''
+    def __init__(self, directory, series_uid = None, files = None, threads = 0):
+        self.directory = directory
+        self.threads = dicom_threads(threads)
+        if files is None:
+            files = sorted(os.path.join(dirpath, name) for dirpath, _, names in os.walk(directory) for name in names)
+        with ThreadPoolExecutor(max_workers = self.threads, thread_name_prefix = 'DicomReader') as pool:
+            headers = [header for header in pool.map(read_header, files) if header is not None]
+        if not headers:
+            raise ValueError('No DICOM image found in: %s' % directory)
+
+        series = {}
+        for header in headers:
+            series.setdefault(header['series'], []).append(header)
+        if series_uid is None:
+            series_uid = max(series, key = lambda uid: len(series[uid]))
+            if len(series) > 1:
+                print('  %d DICOM series found, reading the largest one: %s' % (len(series), series_uid))
+        elif series_uid not in series:
+            raise ValueError('DICOM series %s not found in: %s' % (series_uid, directory))
+        self.series_uid = series_uid
+        self.group(series[series_uid])
+
+    def group(self, headers):
+        '''
+        Group headers into slices (sorted along the slice normal) of time frames (sorted in time)
+        '''
+        first = headers[0]
+        if any(header['size'][:2] != first['size'][:2] for header in headers):
+            raise ValueError('DICOM series %s has images of different sizes' % self.series_uid)
+        direction = np.array(first['direction']).reshape(3, 3)
+        normal = direction[:, 2]
+        # Slice positions along the normal, rounded so that the same position read from different files matches
+        positions = np.round([np.dot(normal, header['origin']) for header in headers], 3)
+        slices = {}
+        for position, header in zip(positions, headers):
+            slices.setdefault(position, []).append(header)
+        positions = sorted(slices)
+
+        n_t = len(slices[positions[0]])
+        for position in positions:
+            if len(slices[position]) != n_t:
+                raise ValueError('DICOM series %s: %d time frames at slice position %.3f, %d at %.3f' % \
+                    (self.series_uid, len(slices[position]), position, n_t, positions[0]))
+        # Temporal order: first tag which is present in all files and varies within a slice
+        self.temporal_tag = None
+        for tag, name in TEMPORAL_TAGS:
+            if all(tag in header for header in headers) and len(set(header[tag] for header in slices[positions[0]])) == n_t:
+                self.temporal_tag = tag
+                print('  Time frames ordered by %s' % name)
+                break
+        if self.temporal_tag is None and n_t > 1:
+            raise ValueError('DICOM series %s: no tag orders the %d time frames of each slice' % (self.series_uid, n_t))
+        key = (lambda header: (header[self.temporal_tag], header['file'])) if self.temporal_tag else (lambda header: header['file'])
+        # self.files[s][t]: file of slice s at time frame t
+        self.files = [[header['file'] for header in sorted(slices[position], key = key)] for position in positions]
+
+        # Acquisition time (s) of each frame, relative to the first one (mean over slices), None if unknown
+        self.times = None
+        if all('0008|0032' in header for header in headers):
+            times = np.array([[header['0008|0032'] for header in sorted(slices[position], key = key)] for position in positions])
+            self.times = (times.mean(axis = 0) - times.mean(axis = 0)[0]).tolist()
+
+        # Geometry of the (slice, row, column) grid: origin of the first slice, slice spacing from the positions
+        self.origin    = tuple(float(o) for o in slices[positions[0]][0]['origin'])
+        gaps = np.diff(positions)
+        slice_spacing = float(np.mean(gaps)) if len(gaps) else float(first['spacing'][2])
+        if len(gaps) and np.ptp(gaps) > 1e-2 * max(slice_spacing, 1e-6):
+            print('  Warning: irregular slice spacing from %.3f to %.3f, mean %.3f used' % (gaps.min(), gaps.max(), slice_spacing))
+        self.spacing   = (float(first['spacing'][0]), float(first['spacing'][1]), slice_spacing)
+        self.direction = tuple(float(d) for d in direction.ravel())
+        self.shape = (len(positions), int(first['size'][1]), int(first['size'][0]), n_t)
+        # Rescaled pixel types may differ between files (e.g., MR rescale slopes), which are then read as float32
+        pixel_ids = set(header['pixel_id'] for header in headers)
+        self.dtype = sitk.GetArrayViewFromImage(sitk.Image([1, 1], pixel_ids.pop())).dtype if len(pixel_ids) == 1 else np.dtype(np.float32)
+
+    def read(self):
+        '''
+        return: array of size (slice, row, column, time), a view of a (time, slice, row, column) array filled frame by frame
+        '''
+        n_s, n_r, n_c, n_t = self.shape
+        array = np.empty((n_t, n_s, n_r, n_c), dtype = self.dtype)
+
+        def read_file(index):
+            s, t = index
+            image = sitk.ReadImage(self.files[s][t], imageIO = 'GDCMImageIO')
+            array[t, s] = sitk.GetArrayViewFromImage(image).reshape(n_r, n_c)
+
+        with ThreadPoolExecutor(max_workers = self.threads, thread_name_prefix = 'DicomReader') as pool:
+            list(pool.map(read_file, [(s, t) for s in range(n_s) for t in range(n_t)]))
+        return array.transpose(1, 2, 3, 0)
+
+    def to_image(self):
+        '''
+        Series as a SimpleITK vector image, time points as components (layout read by signal_reader.py),
+        a scalar image if only one time frame
+        '''
+        array = self.read()
+        image = sitk.GetImageFromArray(np.ascontiguousarray(array), isVector = True) if self.shape[3] > 1 else sitk.GetImageFromArray(array[..., 0])
+        image.SetOrigin(self.origin)
+        image.SetSpacing(self.spacing)
+        image.SetDirection(self.direction)
+        return image
+
+
+def header_record(FileName):
+    '''
+    Index record of a file: [series, position along the slice normal, instance number], [None] * 3 if not a DICOM image
+    '''
+    header = read_header(FileName)
+    if header is None:
+        return [None, None, None]
+    position = float(np.dot(np.array(header['direction']).reshape(3, 3)[:, 2], header['origin']))
+    return [header['series'], position, header.get('0020|0013')]
+
+
+def default_index_name(root):
+    return os.path.join(os.path.expanduser('~'), '.cache', 'perfusion', \
+        'dicom_index_%s.json' % hashlib.sha1(os.path.abspath(root).encode()).hexdigest()[:16])
+
+
+class DicomIndex(object):
+    '''
+    Persistent index of the DICOM files under root, only headers are read
+
+    IndexName: local file keeping the index (json), None for ~/.cache/perfusion/dicom_index_<hash of root>.json
+    threads: threads scanning directories (os.scandir) and reading headers, 0 for min(32, cpu_count + 4)
+
+    On update, directories are scanned level by level in parallel; a directory whose mtime is unchanged is taken
+    from the index as it is (its subdirectories are still visited), in a changed one only the headers of new
+    or modified (size/mtime) files are read. Files rewritten in place in an unchanged directory are not noticed.
+    '''
+    VERSION = 1
+
+    def __init__(self, root, IndexName = None, threads = 0):
+        self.root = os.path.abspath(root)
+        self.IndexName = default_index_name(root) if IndexName is None else IndexName
+        self.threads = dicom_threads(threads)
+        # {directory relative to root: {'mtime_ns', 'files': {name: [size, mtime_ns, series, position, instance]}, 'subdirs'}}
+        self.directories = {}
+        if os.path.exists(self.IndexName):
+            with open(self.IndexName) as f:
+                index = json.load(f)
+            if index.get('version') == self.VERSION and index.get('root') == self.root:
+                self.directories = index['directories']
+
+    def scan_directory(self, directory):
+        '''
+        return: (directory, entry (None if gone), number of headers read)
+        '''
+        path = os.path.join(self.root, directory)
+        known = self.directories.get(directory)
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except FileNotFoundError:
+            return directory, None, 0
+        if known is not None and known['mtime_ns'] == mtime:
+            return directory, known, 0
+        old = known['files'] if known is not None else {}
+        files, subdirs, n_read = {}, [], 0
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks = False):
+                    subdirs.append(entry.name)
+                elif entry.is_file():
+                    stat = entry.stat()
+                    record = old.get(entry.name)
+                    if record is None or record[0] != stat.st_size or record[1] != stat.st_mtime_ns:
+                        record = [stat.st_size, stat.st_mtime_ns] + header_record(entry.path)
+                        n_read += 1
+                    files[entry.name] = record
+        return directory, {'mtime_ns': mtime, 'files': files, 'subdirs': sorted(subdirs)}, n_read
+
+    def update(self):
+        '''
+        Rescan the archive (changed directories only) and save the index
+        '''
+        directories, frontier, n_read, n_scanned = {}, ['.'], 0, 0
+        with ThreadPoolExecutor(max_workers = self.threads, thread_name_prefix = 'DicomIndex') as pool:
+            while frontier:
+                level, frontier = frontier, []
+                for directory, entry, n in pool.map(self.scan_directory, level):
+                    if entry is None:
+                        continue
+                    n_scanned += entry is not self.directories.get(directory)
+                    n_read += n
+                    directories[directory] = entry
+                    frontier += [os.path.normpath(os.path.join(directory, name)) for name in entry['subdirs']]
+        self.directories = directories
+        self.save()
+        print('  Indexed %d directories (%d rescanned, %d headers read): %s' % (len(directories), n_scanned, n_read, self.root))
+        return self
+
+    def save(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self.IndexName)), exist_ok = True)
+        temp = self.IndexName + '.tmp'
+        with open(temp, 'w') as f:
+            json.dump({'version': self.VERSION, 'root': self.root, 'directories': self.directories}, f)
+        os.replace(temp, self.IndexName)
+
+    def series(self):
+        '''
+        return: {SeriesInstanceUID: files (absolute paths) sorted by slice position, instance number and name}
+        '''
+        series = {}
+        for directory, entry in self.directories.items():
+            for name, (_, _, uid, position, instance) in entry['files'].items():
+                if uid is not None:
+                    key = (position, instance if instance is not None else 0., name)
+                    series.setdefault(uid, []).append((key, os.path.normpath(os.path.join(self.root, directory, name))))
+        return {uid: [FileName for _, FileName in sorted(files)] for uid, files in series.items()}
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description = 'Index of the DICOM series in an archive')
+    parser.add_argument('--index', type = str, required = True, help = 'Root directory of the archive')
+    parser.add_argument('--index_file', type = str, default = None, help = 'Index file (json), default under ~/.cache/perfusion')
+    parser.add_argument('--threads', type = int, default = 0, help = 'Scanning threads, 0 for min(32, cpu_count + 4)')
+    config = parser.parse_args()
+
+    index = DicomIndex(config.index, config.index_file, config.threads).update()
+    for uid, files in sorted(index.series().items()):
+        print('%s: %d files in %s' % (uid, len(files), os.path.dirname(os.path.commonprefix(files))))
+    print('Save index as:', index.IndexName)
+
+
+########################################################################################################################
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,221 @@
+import json
+import time
+import resource
+import threading
+
+'''
+Per-stage instrumentation: wall time, CPU time, peak memory increase and voxels processed
+
+Stages are timed by `with recorder.stage(name) as stage: ...; stage.voxels = n`, metrics are logged, kept for a
+json run report and optionally written to TensorBoard. A disabled recorder hands out one shared no-op stage,
+so that instrumented code costs nothing measurable when instrumentation is off. The peak memory of a stage is its
+own: the resident set size is sampled while stages are open (see PeakSampler) and the CUDA peak is reset per stage.
+'''
+
+
+# Interval (s) between two samples of the resident set size while stages are open
+RSS_INTERVAL = 0.005
+
+
+def max_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+
+def rss_mb():
+    '''
+    Current resident set size (MB) of the process, its peak so far where /proc is not available
+    '''
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize() / 1024. ** 2
+    except (OSError, ValueError, IndexError):
+        return max_rss_mb()
+
+
+class PeakSampler(object):
+    '''
+    Peak resident set size of each open (possibly nested) stage, sampled every interval by a background thread
+    while any stage is open: the ru_maxrss high-water mark of the process cannot tell the peak of a stage once
+    an earlier stage went higher
+    '''
+    def __init__(self, interval = RSS_INTERVAL):
+        self.interval = interval
+        self.stages = []
+        self.lock = threading.Lock()
+        self.active = threading.Event()
+        self.thread = None
+
+    def enter(self, stage):
+        stage.rss = stage.peak_rss = rss_mb()
+        with self.lock:
+            self.stages.append(stage)
+            self.active.set()
+            if self.thread is None:
+                self.thread = threading.Thread(target = self.run, name = 'rss-sampler', daemon = True)
+                self.thread.start()
+
+    def exit(self, stage):
+        self.sample()
+        with self.lock:
+            self.stages.remove(stage)
+            if not self.stages:
+                self.active.clear()
+
+    def open(self):
+        with self.lock:
+            return list(self.stages)
+
+    def sample(self):
+        rss = rss_mb()
+        with self.lock:
+            for stage in self.stages:
+                stage.peak_rss = max(stage.peak_rss, rss)
+
+    def run(self):
+        while True:
+            self.active.wait()
+            time.sleep(self.interval)
+            self.sample()
+
+
+def count_voxels(values):
+    '''
+    Number of voxels of the first array-like found in values (one level deep): curves are
+    (slice, row, column, time) or packed (n_voxel, time), volumes (slice, row, column)
+    '''
+    for value in values:
+        if isinstance(value, (tuple, list)):
+            value = next((v for v in value if hasattr(v, 'shape')), None)
+        if hasattr(value, 'shape') and len(value.shape) >= 2:
+            n = 1
+            for size in (value.shape if len(value.shape) == 3 else value.shape[:-1]):
+                n *= int(size)
+            return n
+    return 0
+
+
+class NullStage(object):
+    '''
+    Stage of a disabled recorder: records nothing
+    '''
+    voxels = 0
+    cached = False
+    discard = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+NULL_STAGE = NullStage()
+
+
+class Stage(object):
+
+    def __init__(self, recorder, name, voxels = 0):
+        self.recorder = recorder
+        self.name = name
+        self.voxels = voxels
+        self.cached = False
+        self.discard = False # set when the stage turns out not to be worth a record (e.g., cache miss)
+
+    def __enter__(self):
+        if self.recorder.cuda:
+            import torch
+            torch.cuda.synchronize()
+            # The CUDA peak is reset per stage: the peak so far is kept by the enclosing stages first
+            self.recorder.fold_cuda_peak(torch.cuda.max_memory_allocated())
+            self.cuda_base = self.cuda_peak = torch.cuda.memory_allocated()
+            torch.cuda.reset_peak_memory_stats()
+        self.recorder.sampler.enter(self)
+        self.cpu = time.process_time()
+        self.wall = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, *args):
+        if self.recorder.cuda:
+            import torch
+            torch.cuda.synchronize() # kernels of the stage are done before it is timed
+        self.recorder.sampler.exit(self)
+        if self.recorder.cuda:
+            self.cuda_peak = max(self.cuda_peak, torch.cuda.max_memory_allocated())
+            self.recorder.fold_cuda_peak(self.cuda_peak)
+        if self.discard:
+            return False
+        wall = time.perf_counter() - self.wall
+        record = {'stage': self.name, 'wall_s': wall, 'cpu_s': time.process_time() - self.cpu, \
+            'peak_rss_mb': self.peak_rss, 'peak_rss_increase_mb': self.peak_rss - self.rss, 'voxels': int(self.voxels), \
+            'voxels_per_s': self.voxels / wall if wall > 0 else 0., 'cached': self.cached, 'failed': exc_type is not None}
+        if self.recorder.cuda:
+            record['cuda_peak_mb'] = (self.cuda_peak - self.cuda_base) / 1024. ** 2
+        self.recorder.add(record)
+        return False
+
+
+class Recorder(object):
+    '''
+    enabled: whether stages are recorded at all
+    logger: logger of the stage metrics, None for no logging
+    tensorboard_dir: directory of TensorBoard event files, empty for none (tensorboardX is only imported then)
+    cuda: whether also track the peak CUDA memory of stages (synchronizing at stage boundaries)
+    '''
+    def __init__(self, enabled = False, logger = None, tensorboard_dir = '', cuda = False):
+        self.enabled = enabled
+        self.logger = logger
+        self.cuda = enabled and cuda
+        self.records = []
+        self.sampler = PeakSampler() if enabled else None
+        self.started = time.perf_counter()
+        self.tensorboard = None
+        if enabled and tensorboard_dir:
+            from tensorboardX import SummaryWriter
+            self.tensorboard = SummaryWriter(tensorboard_dir)
+
+    @classmethod
+    def from_config(cls, config, logger = None, device = None):
+        return cls(config.instrument, logger, config.tensorboard_dir, device is not None and device.type == 'cuda')
+
+    def stage(self, name, voxels = 0):
+        return Stage(self, name, voxels) if self.enabled else NULL_STAGE
+
+    def fold_cuda_peak(self, peak):
+        '''
+        Peak CUDA memory allocated (bytes) within the open stages, kept by each of them
+        '''
+        for stage in self.sampler.open():
+            stage.cuda_peak = max(stage.cuda_peak, peak)
+
+    def add(self, record):
+        self.records.append(record)
+        if self.logger is not None:
+            self.logger.info('Stage %s: %s in %.3f s (cpu %.3f s), peak RSS of the stage +%.1f MB, %d voxels (%.0f voxels/s)' % \
+                (record['stage'], 'loaded from cache' if record['cached'] else 'computed', record['wall_s'], record['cpu_s'], \
+                record['peak_rss_increase_mb'], record['voxels'], record['voxels_per_s']))
+        if self.tensorboard is not None:
+            step = sum(r['stage'] == record['stage'] for r in self.records) - 1 # repeated stages (e.g., over studies)
+            for key in ['wall_s', 'cpu_s', 'peak_rss_mb', 'peak_rss_increase_mb', 'voxels_per_s', 'cuda_peak_mb']:
+                if key in record:
+                    self.tensorboard.add_scalar('%s/%s' % (record['stage'], key), record[key], step)
+
+    def report(self, **entries):
+        report = dict(entries)
+        report.update({'wall_s': time.perf_counter() - self.started, 'cpu_s': time.process_time(), \
+            'peak_rss_mb': max_rss_mb(), 'stages': self.records})
+        return report
+
+    def save(self, ReportName, **entries):
+        '''
+        Save the run report (json), with extra entries (e.g., the input file); nothing if disabled
+        '''
+        if not self.enabled:
+            return None
+        with open(ReportName, 'w') as f:
+            json.dump(self.report(**entries), f, indent = 2, default = str)
+        return ReportName
+
+    def close(self):
+        if self.tensorboard is not None:
+            self.tensorboard.close()
+            self.tensorboard = None
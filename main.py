@@ -1,12 +1,11 @@
 import os, time
 import torch
-import numpy as np
-import SimpleITK as sitk
-import torch.optim as optim
 
 import paths
 from utils import get_logger
-from signal_reader import read_signal
+from writer import ImageWriter
+from pipeline import StageCache
+from instrument import Recorder
 from main_calculator import MainCalculator
 from config import parse_config
 
@@ -16,6 +15,40 @@ def datestr():
 print(datestr())
 
 
+def run(FileName, SaveFolder, config, device, logger):
+    '''
+    Compute perfusion parameters of one study: FileName (4D perfusion image), results saved under SaveFolder
+    '''
+    # Intermediate outputs are written in the background, overlapping with computation
+    writer = ImageWriter.from_config(config)
+
+    # Results of unchanged stages are loaded from the cache, if any
+    cache = StageCache(config.cache_dir, config.cache_size) if config.cache_dir else None
+
+    # Per-stage metrics (if config.instrument), saved as a run report
+    recorder = Recorder.from_config(config, logger, device)
+
+    # Read and preprocess (brain-region extraction, low-pass filtering) raw signal (size: (slice, row, column, time))
+    # when needed, then calculate perfusino parameters
+    # For MRP, convert raw signal <= 0 to = 1
+    # CPU: shards of slices over worker processes; large studies: tile by tile of slices within config.tile_memory_budget
+    # (imported only when used: a one-shot run pays no import it does not need)
+    if config.shard_workers > 0 and device.type == 'cpu':
+        from sharding import ShardedCalculator as Calculator
+    elif config.tile_memory_budget > 0:
+        from tiling import TiledCalculator as Calculator
+    else:
+        Calculator = MainCalculator
+    calculator = Calculator.from_file(FileName, config, SaveFolder, device, logger, writer, cache, recorder)
+    calculator.run()
+    with recorder.stage('write_wait'):
+        writer.close()
+    ReportName = recorder.save(os.path.join(SaveFolder, config.run_report), input = FileName, config = vars(config))
+    if ReportName:
+        print('Save run report as:', os.path.basename(ReportName))
+    recorder.close()
+
+
 def main():
 
     logger = get_logger("Perfusion Parameters Calculation")
@@ -24,14 +57,7 @@ def main():
     
     device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
 
-    # Read and preprocess (brain-region extraction, low-pass filtering) raw signal (size: (slice, row, column, time))
-    # For MRP, convert raw signal <= 0 to = 1
-    RawPerfImg, origin, spacing, direction = \
-        read_signal(paths.FileName, config.image_type, ToTensor = config.to_tensor, Mask = config.mask) 
-
-    # Calculate perfusino parameters
-    calculator = MainCalculator(RawPerfImg, origin, spacing, direction, config, paths.SaveFolder, device)
-    calculator.run()
+    run(paths.FileName, paths.SaveFolder, config, device, logger)
 
 
 ########################################################################################################################
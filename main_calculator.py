@@ -1,56 +1,342 @@
 import os
+import copy
+import json
 import torch
 import logging
 import numpy as np
 import SimpleITK as sitk
-from tensorboardX import SummaryWriter
 
 import utils
+import precision
+from writer import ImageWriter, READ_INTERMEDIATES
+from instrument import Recorder
+from qc import QCReport, QCError
+from signal_reader import read_signal
+from pipeline import Pipeline, Stage, file_hash, tensor_hash
 import ParamsCalculator.ctc as ctc
 import ParamsCalculator.mask as mask
+import ParamsCalculator.motion as motion
 import ParamsCalculator.aif as aif
+import ParamsCalculator.deconv as deconv
+import ParamsCalculator.modelfree as modelfree
+import ParamsCalculator.gammafit as gammafit
+from ParamsCalculator.mask import PackedVolume
+
+# Config fields each stage depends on (cache keys), fields only tuning speed/memory are left out
+READ_KEYS = ['image_type', 'mask', 'precision', 'percentile_error']
+MOTION_KEYS = ['image_type', 'motion_reference', 'motion_levels', 'motion_iterations', 'motion_points']
+MASK_KEYS = ['image_type']
+BAT_KEYS  = ['image_type', 'mrp_s0_threshold', 'ctp_s0_threshold', 'per_voxel_bat', 'precision']
+CTC_KEYS  = ['image_type', 'k_ct', 'k_mr', 'TE']
+FILTER_KEYS = ['filter_kernel_size']
+AIF_KEYS    = ['aif_voxels', 'aif_peak_fraction', 'aif_candidates', 'aif_clusters']
+DECONV_KEYS = ['image_type', 'TR', 'ct_interval', 'svd_threshold', 'block_circulant']
+MODELFREE_KEYS = ['image_type', 'TR', 'ct_interval', 'precision']
+GAMMAFIT_KEYS  = ['image_type', 'TR', 'ct_interval', 'precision', 'gamma_fit_iterations', 'gamma_fit_tolerance', 'gamma_fit_tail']
 
 
 class MainCalculator:
     """Main calculator.
     Args:
-    raw_perf: numpy array or torch tensor of size (slice, row, column, time)
+    raw_perf: numpy array or torch tensor of size (slice, row, column, time),
+              or a function of the calculator (using its config, writer and recorder) returning
+              (raw_perf, origin, spacing, direction), which is only called when needed
     save_path: path/to/save/folder
     device: device currently working on
     logger: info logger
+    writer: writer.ImageWriter for saving images, None for synchronous writing
+    cache: pipeline.StageCache for stage results, None for no caching
+    input_key: content hash of the input (e.g., pipeline.file_hash of the image file), computed from raw_perf if not given
+    recorder: instrument.Recorder of the stage metrics, None for no instrumentation
     """
-    def __init__(self, raw_perf, origin, spacing, direction, config, save_path, device, logger = None):
+    def __init__(self, raw_perf, origin, spacing, direction, config, save_path, device, logger = None, writer = None, \
+        cache = None, input_key = None, recorder = None):
         if logger is None:
             self.logger = utils.get_logger('MainCalculator', level = logging.DEBUG)
         else:
             self.logger = logger
 
-        self.logger.info(f"Sending the raw perfusion image to '{device}'")
-        self.raw_perf = raw_perf.to(device)
-        
         self.config    = config
-        self.sitkinfo  = [origin, spacing, direction, save_path]
+        self.writer    = ImageWriter() if writer is None else writer
+        self.recorder  = Recorder() if recorder is None else recorder
+        self.qc        = QCReport.from_config(config)
+        self.save_path = save_path
         self.device    = device
-        self.nS        = self.raw_perf.size(0)
-        self.nR        = self.raw_perf.size(1)
-        self.nC        = self.raw_perf.size(2)
-        self.nT        = self.raw_perf.size(3)
-        self.size      = [self.nS, self.nR, self.nC, self.nT]
+        # Kept for recomputing the study in another precision (accuracy report)
+        self.source    = (raw_perf, origin, spacing, direction)
+        self.input_key = input_key
+
+        # Stages of the calculation, each only computed when its result is needed and not cached
+        self.pipeline = Pipeline(config, device, cache, self.logger, self.recorder)
+        # The intermediate images of the reading are only written when it runs: it is then not cached, but run each time
+        self.read_outputs = callable(raw_perf) and any(self.saved(name) for name in READ_INTERMEDIATES)
+        if callable(raw_perf):
+            self.pipeline.add(Stage('read', lambda: raw_perf(self), config_keys = READ_KEYS, inputs = input_key, \
+                cache = not self.read_outputs))
+        else:
+            if cache is not None and input_key is None:
+                input_key = self.input_key = tensor_hash(torch.as_tensor(raw_perf))
+            self.pipeline.put('read', (raw_perf, origin, spacing, direction), input_key)
+        self.pipeline.add(Stage('signal', self.send_signal, deps = ['read'], cache = False))
+        self.pipeline.add(Stage('geometry', lambda read: tuple(read[1:]), deps = ['read']))
+        # Size of the signal (slice, row, column, time), kept once the signal itself is released (see pack_signal)
+        self.pipeline.add(Stage('shape', lambda read: list(read[0].shape), deps = ['read']))
+        # Motion correction: rigid transforms of all frames to the reference one, then the signal resampled once
+        self.pipeline.add(Stage('motion', self.cal_motion, deps = ['signal', 'geometry'], config_keys = MOTION_KEYS))
+        self.pipeline.add(Stage('registered', self.register_signal, deps = ['signal', 'motion', 'geometry'], cache = False))
+        SIGNAL = 'registered' if config.motion_correction else 'signal'
+        # Brain mask computed once, later stages only work on the brain voxels packed as (n_voxel, time)
+        self.pipeline.add(Stage('mask', self.cal_mask, deps = [SIGNAL], config_keys = MASK_KEYS))
+        self.pipeline.add(Stage('layout', PackedVolume.layout, deps = ['mask'], cache = False))
+        self.pipeline.add(Stage('packed', self.pack_signal, deps = [SIGNAL, 'mask'], cache = False))
+        self.pipeline.add(Stage('baseline', self.cal_baseline, deps = ['packed', 'layout'], config_keys = BAT_KEYS, version = 2))
+        self.pipeline.add(Stage('ctc', self.cal_ctc, deps = ['packed', 'baseline', 'layout'], config_keys = CTC_KEYS))
+        self.pipeline.add(Stage('ctc_filtered', self.cal_ctc_filtered, deps = ['ctc', 'layout'], config_keys = FILTER_KEYS))
+        # CTC used by all later stages
+        CTC = 'ctc_filtered' if config.use_filter else 'ctc'
+        self.pipeline.add(Stage('model_free', self.cal_model_free, deps = [CTC, 'baseline', 'layout'], config_keys = MODELFREE_KEYS))
+        self.pipeline.add(Stage('gamma_fit', self.cal_gamma_fit, deps = [CTC, 'baseline', 'layout'], config_keys = GAMMAFIT_KEYS))
+        self.pipeline.add(Stage('aif', self.cal_aif, deps = [CTC, 'layout'], config_keys = AIF_KEYS))
+        self.pipeline.add(Stage('deconv', self.cal_deconv, deps = [CTC, 'aif', 'layout'], config_keys = DECONV_KEYS))
+
+    @classmethod
+    def from_file(cls, FileName, config, save_path, device, logger = None, writer = None, cache = None, recorder = None):
+        '''
+        Calculator reading its raw perfusion image from FileName (image file or DICOM series directory)
+        only if the needed results are not cached
+        '''
+        def read(calculator):
+            config = calculator.config
+            return read_signal(FileName, config.image_type, ToTensor = True, Mask = config.mask, Writer = calculator.writer, \
+                Precision = config.precision, PercentileError = config.percentile_error, Recorder = calculator.recorder, \
+                DicomThreads = config.dicom_threads, QC = calculator.qc)
+        input_key = file_hash(FileName, cache) if cache is not None else None
+        return cls(read, None, None, None, config, save_path, device, logger, writer, cache, input_key, recorder)
+
+    @property
+    def raw_perf(self):
+        return self.pipeline.get('signal')
+
+    @property
+    def sitkinfo(self):
+        return list(self.pipeline.get('geometry')) + [self.save_path]
+
+    @property
+    def size(self):
+        return list(self.pipeline.get('shape'))
+
+    @property
+    def nS(self):
+        return self.size[0]
+
+    @property
+    def nR(self):
+        return self.size[1]
+
+    @property
+    def nC(self):
+        return self.size[2]
+
+    @property
+    def nT(self):
+        return self.size[3]
 
 
     def run(self):
-        self.main_cal()
+        try:
+            self.main_cal()
+        except QCError as e:
+            self.qc.error = str(e)
+            raise
+        finally:
+            self.save_qc_report()
+
+
+    def send_signal(self, read):
+        self.logger.info(f"Sending the raw perfusion image to '{self.device}'")
+        signal = torch.as_tensor(read[0])
+        # Integer (raw) signals stay compact until converted to CTC
+        if signal.is_floating_point():
+            signal = signal.to(precision.storage_dtype(self.config.precision))
+        return signal.to(self.device)
+
+    def cal_motion(self, raw_perf, geometry):
+        return motion.estimate(raw_perf, geometry[1], self.config, self.device, motion.background(self.config))
+
+    def register_signal(self, raw_perf, Motion, geometry):
+        return motion.resample(raw_perf, Motion, geometry[1], motion.background(self.config))
+
+    def cal_mask(self, raw_perf):
+        return mask.cal(raw_perf, self.config, self.device)
+
+    def pack_signal(self, raw_perf, Mask):
+        packed = PackedVolume.pack(raw_perf, Mask).values
+        # The full grid is no longer needed once packed (geometry and size taken before the image is dropped)
+        self.pipeline.get('geometry')
+        self.pipeline.get('shape')
+        self.pipeline.release('read')
+        self.pipeline.release('signal')
+        self.pipeline.release('registered')
+        return packed
+
+    def cal_baseline(self, packed, layout):
+        return ctc.baseline(packed, self.config, self.device, layout.chunks()) # (s0, bat)
+
+    def cal_ctc(self, packed, baseline, layout):
+        return ctc.compute(packed, self.config, self.device, baseline[0], layout, self.qc) # dtype = torch.float
+
+    def cal_ctc_filtered(self, CTC, layout):
+        filtered = ctc.medfilt(CTC, self.config.filter_kernel_size, self.config.filter_threads, self.config.ctc_memory_budget)
+        self.qc.scan('ctc_filtered', filtered, layout)
+        return filtered
+
+
+    def cal_model_free(self, CTC, baseline, layout):
+        return modelfree.cal(CTC, baseline[1], self.config, self.device, layout)
+
+    def cal_gamma_fit(self, CTC, baseline, layout):
+        return gammafit.cal(CTC, baseline[1], self.config, self.device, layout)
+
+    def cal_aif(self, CTC, layout):
+        return aif.cal(CTC, self.config, self.device, layout)
+
+    def cal_deconv(self, CTC, AIF, layout):
+        return deconv.cal(CTC, AIF[0], self.config, self.device, layout)
+
+    def save_motion(self, Motion):
+        FileName = motion.save(Motion, os.path.join(self.save_path, self.config.motion_report))
+        print('  Save motion transforms as:', os.path.basename(FileName))
+
+    def save_aif(self, AIF):
+        FileName = os.path.join(self.save_path, 'AIF.json')
+        with open(FileName, 'w') as f:
+            json.dump({'aif': AIF[0].tolist(), 'voxels': AIF[1].tolist()}, f)
+        print('  Save AIF curve and voxels as:', os.path.basename(FileName))
+
+    def accuracy_report(self):
+        '''
+        Errors of the results in the configured precision against a float64 reference computed from the same study
+        '''
+        config = copy.copy(self.config)
+        config.precision, config.accuracy_report = 'float64', False
+        reference = MainCalculator(*self.source, config, self.save_path, self.device, self.logger, \
+            ImageWriter(intermediates = []), self.pipeline.cache, self.input_key).pipeline
+        CTC = 'ctc_filtered' if self.config.use_filter else 'ctc'
+
+        report = {'precision': self.config.precision, 'reference': 'float64'}
+        layout, reference_layout = self.pipeline.get('layout'), reference.get('layout')
+        report['mask_voxels'] = [int(layout.index.numel()), int(reference_layout.index.numel())]
+        # Curves are only comparable voxel by voxel on the same brain mask
+        same_mask = torch.equal(layout.index.cpu(), reference_layout.index.cpu())
+        report['ctc'] = precision.errors(self.pipeline.get(CTC), reference.get(CTC)) if same_mask else None
+
+        bat, reference_bat = self.pipeline.get('baseline')[1], reference.get('baseline')[1]
+        if torch.is_tensor(bat):
+            report['bat_agreement'] = (bat == reference_bat).double().mean().item() if same_mask else None
+        else:
+            report['bat_agreement'] = float(bat == reference_bat)
+
+        AIF, reference_AIF = self.pipeline.get('aif'), reference.get('aif')
+        report['aif'] = precision.errors(AIF[0], reference_AIF[0])
+        report['aif_voxels_equal'] = bool(torch.equal(AIF[1].cpu(), reference_AIF[1].cpu()))
+
+        # Parameter maps compared on the reference brain mask
+        brain = reference.get('mask').cpu()
+        maps, reference_maps = self.pipeline.get('deconv'), reference.get('deconv')
+        report['maps'] = {name: precision.errors(maps[name].cpu()[brain], reference_maps[name].cpu()[brain]) for name in maps}
+        return report
+
+    def save_accuracy_report(self):
+        print('Computing float64 reference for the accuracy report ...')
+        report = self.accuracy_report()
+        FileName = os.path.join(self.save_path, 'accuracy.json')
+        with open(FileName, 'w') as f:
+            json.dump(report, f, indent = 2)
+        for name, errors in report['maps'].items():
+            print('  %-4s relative L2 error (%s vs float64): %.2e' % (name, report['precision'], errors['relative_l2']))
+        print('  Save accuracy report as:', os.path.basename(FileName))
+
+    def save_qc_report(self):
+        '''
+        QC statistics of the stages computed in this run (see qc.py)
+        '''
+        if not self.config.qc_report or not self.qc.stages:
+            return
+        FileName = self.qc.save(os.path.join(self.save_path, self.config.qc_report), image_type = self.config.image_type)
+        print('Save QC report as:', os.path.basename(FileName))
+
+    def saved(self, name):
+        '''
+        Whether the intermediate output is saved, as an image or a chunked store
+        '''
+        return self.writer.enabled(name) or self.writer.stored(name)
+
+    def save_maps(self, maps):
+        # Maps are final (never modified once computed): written without a copy
+        origin, spacing, direction, save_path = self.sitkinfo
+        for name, values in maps.items():
+            FileName = self.writer.write(None, precision.to_numpy(values), os.path.join(save_path, name), origin, spacing, direction, \
+                snapshot = False)
+            print('  Save %-4s map as:' % name, os.path.basename(FileName))
 
 
     def main_cal(self):
 
-        # Implement when need to exclude the scalp and zones from the image adjacent to the outside of the brain
-        #Mask = mask.cal(self.raw_perf, self.device) 
+        # Selected intermediate images of the reading, written even if all later stages are cached
+        if self.read_outputs:
+            self.pipeline.get('read')
+
+        # Brain voxels, results are only scattered back to the (slice, row, column) grid when saved
+        layout = self.pipeline.get('layout')
+
+        # Per-frame rigid transforms of the motion correction
+        if self.config.motion_correction:
+            Motion = self.pipeline.get('motion')
+            with self.recorder.stage('save_motion'):
+                self.save_motion(Motion)
 
-        # Compute and save absolute CTC
-        CTC = ctc.cal(self.raw_perf, self.sitkinfo, self.config, self.device) # dtype = torch.float
+        # Per-voxel bolus arrival time (time point, start from 0) and S0
+        if self.config.per_voxel_bat:
+            s0, bat = self.pipeline.get('baseline')
+            with self.recorder.stage('save_baseline'):
+                self.save_maps({'BAT': layout.unpack(bat.int()), 'S0': layout.unpack(s0)})
+
+        # Compute and save absolute CTC (saving only hands the images over to the writer, see ImageWriter)
+        if self.config.use_filter:
+            print('Use filtered CTC...')
+            CTC = self.pipeline.get('ctc_filtered')
+            with self.recorder.stage('save_ctc'):
+                ctc.save(layout.unpack(self.pipeline.get('ctc')) if self.saved('ctc') else None, \
+                    layout.unpack(CTC) if self.saved('ctc_filtered') else None, self.sitkinfo, self.writer)
+        else:
+            print('Use non-filtered CTC...')
+            CTC = self.pipeline.get('ctc')
+            if self.writer.stored('ctc'):
+                with self.recorder.stage('save_ctc'):
+                    ctc.save(layout.unpack(CTC), None, self.sitkinfo, self.writer, images = False)
+
+        # Model-free maps: TTP, PE, AUC, FMTT (no AIF needed)
+        if self.config.model_free:
+            maps = self.pipeline.get('model_free')
+            with self.recorder.stage('save_model_free'):
+                self.save_maps(maps)
+
+        # Gamma-variate fits (recirculation left out): parameter, residual and convergence maps
+        if self.config.gamma_fit:
+            maps = self.pipeline.get('gamma_fit')
+            with self.recorder.stage('save_gamma_fit'):
+                self.save_maps(maps)
 
         # Clustering: obtain AIF, exclude out arteries
-        #AIF = aif.cal(CTC, self.config)
+        AIF = self.pipeline.get('aif')
+        with self.recorder.stage('save_aif'):
+            self.save_aif(AIF)
+
+        # Deconvolution: CBF, CBV, MTT, Tmax
+        maps = self.pipeline.get('deconv')
+        with self.recorder.stage('save_maps'):
+            self.save_maps(maps)
 
-         
\ No newline at end of file
+        if self.config.accuracy_report:
+            with self.recorder.stage('accuracy_report'):
+                self.save_accuracy_report()
@@ -4,9 +4,12 @@ import SimpleITK as sitk
 
 
 def brain_region(RawPerf, device, background = 0):
-	
-	mask = torch.zeros(RawPerf.size(), device = device)
-	mask = torch.where(RawPerf != background, RawPerf, mask)
+	'''
+	3D boolean mask (slice, row, column) of voxels differing from background at any time point
+	'''
+	mask = torch.empty(RawPerf.shape[:3], device = device, dtype = torch.bool)
+	for s in range(RawPerf.size(0)):
+		mask[s] = (RawPerf[s] != background).any(dim = -1)
 
 	return mask
 
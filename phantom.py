@@ -0,0 +1,152 @@
+import os
+import sys
+import argparse
+import numpy as np
+import SimpleITK as sitk
+
+'''
+Synthetic 4D perfusion phantoms (CTP/MRP) with known ground truth
+
+A gamma-variate arterial input function (AIF) feeds three tissue classes (two hemispheres and a delayed,
+hypo-perfused lesion) through an exponential residue function, ctc = CBF * (AIF (x) exp(-t / MTT)) (t - delay),
+plus an artery carrying the AIF itself; the curves are converted to stored signals (HU for CTP, MR signal for MRP)
+with Gaussian noise, as int16 images in the layout read by signal_reader.py.
+
+Example:
+    python phantom.py --shape 16 256 256 --frames 40 --image_type CTP --out phantom_ctp.nii --truth True
+'''
+
+# Tissue classes: (CBF (ml/100g/min), MTT (s), delay (s))
+TISSUES = {1: (60., 4., 0.), 2: (25., 5., 0.), 3: (10., 8., 3.)}
+BACKGROUND, ARTERY = 0, 4
+
+# Baseline signal (HU for CTP, MR signal for MRP) of background, tissue and artery
+BASELINE = {'CTP': (-1000., 35., 40.), 'MRP': (0., 1000., 800.)}
+NOISE    = {'CTP': 5., 'MRP': 10.}
+
+
+def gamma_variate(t, t0 = 3., alpha = 3., beta = 1.5, peak = 1.):
+    '''
+    Gamma-variate bolus curve starting at t0, scaled to the given peak height
+    '''
+    s = np.clip(t - t0, 0., None)
+    curve = s ** alpha * np.exp(- s / beta)
+    return peak * curve / max(curve.max(), np.finfo(np.float64).tiny)
+
+
+def tissue_curve(aif, dt, cbf, mtt, delay):
+    '''
+    Tissue CTC of the indicator-dilution model: (cbf / 6000) * dt * (AIF (x) exp(-t / mtt)), delayed by delay (s)
+    '''
+    t = np.arange(len(aif)) * dt
+    residue = np.exp(- t / mtt)
+    curve = cbf / 6000. * dt * np.convolve(aif, residue)[:len(aif)]
+    return np.interp(t - delay, t, curve, left = 0.)
+
+
+def labels(shape):
+    '''
+    Tissue class of each voxel (slice, row, column): elliptic head split into hemispheres, a lesion disk in one,
+    and a small artery near the front
+    '''
+    n_r, n_c = shape[1:]
+    r, c = np.meshgrid(np.arange(n_r) - (n_r - 1) / 2., np.arange(n_c) - (n_c - 1) / 2., indexing = 'ij')
+    head = (r / (0.45 * n_r)) ** 2 + (c / (0.4 * n_c)) ** 2 <= 1.
+    plane = np.where(head, np.where(c >= 0, 1, 2), BACKGROUND)
+    plane[head & ((r - 0.1 * n_r) ** 2 + (c + 0.2 * n_c) ** 2 <= (0.12 * min(n_r, n_c)) ** 2)] = 3
+    plane[(r + 0.3 * n_r) ** 2 + c ** 2 <= max(0.02 * min(n_r, n_c), 1.) ** 2] = ARTERY
+    return np.broadcast_to(plane, shape)
+
+
+def phantom(shape, n_frames, image_type = 'CTP', dt = 1.0, noise = None, seed = 0, k = 1.0, TE = 0.025):
+    '''
+    shape: (slice, row, column); dt: time (s) between frames
+    noise: std of the Gaussian noise in stored signal units, None for the default of image_type
+    k, TE: k_ct for CTP (ctc = k * (S - S0)), k_mr and TE for MRP (ctc = - k / TE * log(S / S0))
+    return: signal # (slice, row, column, time) int16, truth # {'AIF', 'CBF', 'CBV', 'MTT', 'delay'}
+    '''
+    if image_type not in BASELINE:
+        raise ValueError('Unknown image type: %s' % image_type)
+    noise = NOISE[image_type] if noise is None else noise
+    t = np.arange(n_frames) * dt
+    aif = gamma_variate(t, peak = 300.)
+
+    # CTC and baseline signal of each class
+    curves = np.zeros((ARTERY + 1, n_frames))
+    curves[ARTERY] = aif
+    for label, (cbf, mtt, delay) in TISSUES.items():
+        curves[label] = tissue_curve(aif, dt, cbf, mtt, delay)
+    background, tissue, artery = BASELINE[image_type]
+    s0 = np.array([background] + [tissue] * len(TISSUES) + [artery])
+    if image_type == 'CTP':
+        clean = s0[:, None] + curves / k
+    else:
+        clean = s0[:, None] * np.exp(- curves * TE / k)
+    clean[BACKGROUND] = background # no contrast outside the head
+
+    # Generated slice by slice, the noise-free curves are only kept per class
+    label = labels(shape)
+    rng = np.random.default_rng(seed)
+    signal = np.empty(tuple(shape) + (n_frames,), dtype = np.int16)
+    for s in range(shape[0]):
+        slab = clean[label[s]] + rng.normal(0., noise, label[s].shape + (n_frames,))
+        if image_type == 'MRP':
+            slab[label[s] == BACKGROUND] = 0.
+        signal[s] = np.clip(np.rint(slab), -32768, 32767)
+
+    truth = {'AIF': aif}
+    for name, index in [('CBF', 0), ('MTT', 1), ('delay', 2)]:
+        values = np.zeros(ARTERY + 1, dtype = np.float32)
+        for cls, params in TISSUES.items():
+            values[cls] = params[index]
+        truth[name] = values[label]
+    truth['CBV'] = truth['CBF'] * truth['MTT'] / 60. # ml/100g
+    return signal, truth
+
+
+def save(signal, FileName, spacing = (0.5, 0.5, 5.0)):
+    '''
+    Save signal (slice, row, column, time) as a vector image, time points as components
+    '''
+    img = sitk.GetImageFromArray(signal, isVector = True)
+    img.SetSpacing(spacing)
+    sitk.WriteImage(img, FileName)
+    return FileName
+
+
+def save_truth(truth, FileName, spacing = (0.5, 0.5, 5.0)):
+    '''
+    Save the ground truth maps next to the phantom as <name>_truth_<map>.nii, the AIF as <name>_truth_AIF.txt
+    '''
+    base = FileName[:-7] if FileName.endswith('.nii.gz') else os.path.splitext(FileName)[0]
+    np.savetxt(base + '_truth_AIF.txt', truth['AIF'])
+    for name in ['CBF', 'CBV', 'MTT', 'delay']:
+        img = sitk.GetImageFromArray(np.ascontiguousarray(truth[name]))
+        img.SetSpacing(spacing)
+        sitk.WriteImage(img, '%s_truth_%s.nii' % (base, name))
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description = 'Synthetic CTP/MRP phantom')
+    parser.add_argument('--shape', type = int, nargs = 3, default = [16, 256, 256], help = 'Number of slices, rows and columns')
+    parser.add_argument('--frames', type = int, default = 40, help = 'Number of time points')
+    parser.add_argument('--image_type', type = str, default = 'CTP', help = 'Image type: CTP/MRP')
+    parser.add_argument('--dt', type = float, default = None, help = 'Time (s) between time points, default 1.0 for CTP and 1.55 for MRP')
+    parser.add_argument('--noise', type = float, default = None, help = 'Noise std in stored signal units, default 5 (HU) for CTP, 10 for MRP')
+    parser.add_argument('--seed', type = int, default = 0, help = 'Seed of the noise')
+    parser.add_argument('--out', type = str, required = True, help = 'Output image file (.nii/.nii.gz)')
+    parser.add_argument('--truth', type = bool, default = False, help = 'Whether save the ground truth maps and AIF next to the image')
+    config = parser.parse_args()
+
+    dt = config.dt if config.dt is not None else (1.0 if config.image_type == 'CTP' else 1.55)
+    signal, truth = phantom(config.shape, config.frames, config.image_type, dt, config.noise, config.seed)
+    print('Save %s phantom of size %s as: %s' % (config.image_type, signal.shape, save(signal, config.out)))
+    if config.truth:
+        save_truth(truth, config.out)
+
+
+########################################################################################################################
+
+if __name__ == '__main__':
+    sys.exit(main())
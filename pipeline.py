@@ -0,0 +1,203 @@
+import os
+import json
+import time
+import hashlib
+import torch
+import numpy as np
+
+from instrument import Recorder, count_voxels
+
+'''
+Stage-level dependency graph of the calculation, with on-disk caching of stage results
+
+The cache key of a stage combines the keys of the stages it depends on (down to the hash of the
+input file) with the values of only those config fields the stage depends on, so changing e.g.
+use_filter only reruns the stages downstream of it, others are loaded from the cache or skipped.
+'''
+
+
+def file_hash(FileName, cache = None, chunk_mb = 16):
+    '''
+    sha256 of the file content (of all files, with their relative paths, for a directory such as a DICOM series),
+    remembered in cache (if given) by path/size/mtime to avoid rehashing
+    '''
+    if os.path.isdir(FileName):
+        files = sorted(os.path.join(dirpath, name) for dirpath, _, names in os.walk(FileName) for name in names)
+    else:
+        files = [FileName]
+    known = None
+    if cache is not None:
+        stamps = []
+        for name in files:
+            stat = os.stat(name)
+            stamps.append('%s:%d:%d' % (os.path.abspath(name), stat.st_size, stat.st_mtime_ns))
+        known = os.path.join(cache.root, 'hash', hashlib.sha1('\n'.join(stamps).encode()).hexdigest())
+        if os.path.exists(known):
+            with open(known) as f:
+                return f.read().strip()
+    sha = hashlib.sha256()
+    for name in files:
+        if name != FileName:
+            sha.update(os.path.relpath(name, FileName).encode())
+        with open(name, 'rb') as f:
+            for chunk in iter(lambda: f.read(chunk_mb * 1024 ** 2), b''):
+                sha.update(chunk)
+    digest = sha.hexdigest()
+    if known is not None:
+        os.makedirs(os.path.dirname(known), exist_ok = True)
+        with open(known, 'w') as f:
+            f.write(digest)
+    return digest
+
+
+def tensor_hash(tensor):
+    tensor = tensor.detach()
+    # bfloat16, which numpy has not, hashed by its bits
+    tensor = tensor.view(torch.int16) if tensor.dtype == torch.bfloat16 else tensor
+    return hashlib.sha256(np.ascontiguousarray(tensor.cpu().numpy()).view(np.uint8)).hexdigest()
+
+
+class Stage(object):
+    '''
+    One stage of the calculation: value = fn(*values of deps)
+    config_keys: config fields the result depends on (fields only tuning speed/memory should not be listed)
+    inputs: extra key material of a source stage, e.g., the hash of the input file
+    cache: whether results are cached on disk (cheap stages of large results should not)
+    version: bump when fn changes its results
+    '''
+    def __init__(self, name, fn, deps = (), config_keys = (), inputs = None, cache = True, version = 1):
+        self.name = name
+        self.fn = fn
+        self.deps = list(deps)
+        self.config_keys = list(config_keys)
+        self.inputs = inputs
+        self.cache = cache
+        self.version = version
+
+
+class StageCache(object):
+    '''
+    On-disk cache of stage results (saved by torch.save as <root>/<key>.pt),
+    least recently used results are evicted beyond max_gb
+    '''
+    def __init__(self, root, max_gb = 20.):
+        self.root = root
+        self.max_bytes = max_gb * 1024 ** 3
+        os.makedirs(root, exist_ok = True)
+
+    def path(self, key):
+        return os.path.join(self.root, '%s.pt' % key)
+
+    def load(self, key, device):
+        '''
+        return: (hit, value)
+        '''
+        try:
+            value = torch.load(self.path(key), map_location = device, weights_only = False)
+            os.utime(self.path(key)) # mark as recently used
+            return True, value
+        except (FileNotFoundError, EOFError, RuntimeError):
+            return False, None
+
+    def save(self, key, value):
+        tmp = '%s.%d.tmp' % (self.path(key), os.getpid())
+        torch.save(value, tmp)
+        os.replace(tmp, self.path(key))
+        self.evict(keep = self.path(key))
+
+    def evict(self, keep = None):
+        entries = []
+        for entry in os.scandir(self.root):
+            if entry.name.endswith('.pt'):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+
+class Pipeline(object):
+    '''
+    Lazily evaluated DAG of stages: get(name) computes only the stages whose results are neither
+    already in memory nor in the cache
+    recorder: instrument.Recorder of the stage metrics (time excludes computing the dependencies), None for none
+    '''
+    def __init__(self, config, device, cache = None, logger = None, recorder = None):
+        self.config = config
+        self.device = device
+        self.cache  = cache
+        self.logger = logger
+        self.recorder = Recorder() if recorder is None else recorder
+        self.stages = {}
+        self.values = {}
+        self.keys   = {}
+
+    def add(self, stage):
+        self.stages[stage.name] = stage
+        self.keys.pop(stage.name, None)
+        self.values.pop(stage.name, None)
+
+    def put(self, name, value, key = None):
+        '''
+        Provide the value of a source stage directly, key: content hash of value (None: not cacheable)
+        '''
+        self.add(Stage(name, None, cache = False))
+        self.values[name] = value
+        self.keys[name] = key
+
+    def key(self, name):
+        if name not in self.keys:
+            stage = self.stages[name]
+            deps = [self.key(dep) for dep in stage.deps]
+            if stage.fn is None or None in deps:
+                self.keys[name] = None
+            else:
+                material = {'stage': name, 'version': stage.version, 'inputs': stage.inputs, 'deps': deps, \
+                    'config': {k: getattr(self.config, k) for k in stage.config_keys}}
+                self.keys[name] = hashlib.sha256(json.dumps(material, sort_keys = True, default = str).encode()).hexdigest()
+        return self.keys[name]
+
+    def get(self, name):
+        if name in self.values:
+            return self.values[name]
+        stage = self.stages[name]
+        key = self.key(name) if self.cache is not None and stage.cache else None
+        if key is not None:
+            with self.recorder.stage(name) as record:
+                hit, value = self.cache.load(key, self.device)
+                record.cached, record.discard = True, not hit
+                record.voxels = count_voxels([value]) if hit else 0
+            if hit:
+                if not self.recorder.enabled:
+                    self.log('Stage %s: loaded from cache' % name)
+                self.values[name] = value
+                return value
+        inputs = [self.get(dep) for dep in stage.deps]
+        start = time.time()
+        with self.recorder.stage(name) as record:
+            value = stage.fn(*inputs)
+            record.voxels = count_voxels(inputs if inputs else [value])
+        if not self.recorder.enabled:
+            self.log('Stage %s: computed in %.2f s' % (name, time.time() - start))
+        if key is not None:
+            self.cache.save(key, value)
+        self.values[name] = value
+        return value
+
+    def release(self, name):
+        self.values.pop(name, None)
+
+    def log(self, message):
+        if self.logger is not None:
+            self.logger.info(message)
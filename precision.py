@@ -0,0 +1,65 @@
+import torch
+import numpy as np
+
+'''
+Numeric precision policy of the calculation
+
+The raw signal is kept in its stored (compact, e.g. int16) type as long as no arithmetic is done on it,
+the signal/CTC tensors are then stored in the chosen precision, while reductions (S0, AIF, deconvolution)
+are never accumulated in less than float32.
+'''
+
+PRECISIONS = ['float64', 'float32', 'bfloat16']
+
+# Integer types of stored raw signals which are kept as they are (also supported by torch.from_numpy)
+RAW_DTYPES = [np.int8, np.uint8, np.int16, np.int32]
+
+
+def check(precision):
+    if precision not in PRECISIONS:
+        raise ValueError('Unknown precision: %s (choose from %s)' % (precision, ', '.join(PRECISIONS)))
+    return precision
+
+
+def storage_dtype(precision):
+    '''
+    torch dtype of the (float) signal and CTC tensors
+    '''
+    return getattr(torch, check(precision))
+
+
+def compute_dtype(precision):
+    '''
+    torch dtype in which reductions are accumulated: at least float32
+    '''
+    return torch.float64 if check(precision) == 'float64' else torch.float32
+
+
+def numpy_dtype(precision):
+    '''
+    numpy dtype of float arrays on reading (numpy has no bfloat16: converted once sent as tensor)
+    '''
+    return np.float64 if check(precision) == 'float64' else np.float32
+
+
+def to_numpy(values):
+    '''
+    Tensor as a numpy array on the CPU for writing (images, chunked stores): bfloat16, which numpy has not, as float32
+    '''
+    return (values.float() if values.dtype == torch.bfloat16 else values).cpu().numpy()
+
+
+def errors(values, reference):
+    '''
+    Errors of values against the reference, both computed in float64
+    return: {max_abs, mean_abs, relative_l2, max_abs_reference}
+    '''
+    values = torch.as_tensor(values).double().flatten().cpu()
+    reference = torch.as_tensor(reference).double().flatten().cpu()
+    if reference.numel() == 0:
+        return {'max_abs': 0., 'mean_abs': 0., 'relative_l2': 0., 'max_abs_reference': 0.}
+    diff = (values - reference).abs()
+    norm = reference.norm().item()
+    return {'max_abs': diff.max().item(), 'mean_abs': diff.mean().item(), \
+        'relative_l2': (diff.norm().item() / norm) if norm > 0 else diff.norm().item(), \
+        'max_abs_reference': reference.abs().max().item()}
@@ -1,12 +1,13 @@
 import os
+import functools
 import numpy as np
 import SimpleITK as sitk
-import matplotlib.pyplot as plt
-from dipy.core.onetime import auto_attr
+from dicom import DicomSeries, DicomIndex
 # %matplotlib inline  # remove annotation symbol when works in Jupyter Notebook
 
 '''
 Transform DICOM files to NifTi files if needed
+(not needed by main.py, which reads a DICOM series directory directly, see dicom.py)
 '''
 
 # Scan through a directory
@@ -39,6 +40,22 @@ class ScanFile(object):
                     files_list.append(os.path.join(dirpath,special_file))                     
         return files_list    
     
+    def scan_series(self, IndexName = None, threads = 0):
+        '''
+        DICOM series under the directory from its persistent index (see dicom.DicomIndex), only directories
+        changed since the last scan are revisited, files filtered by prefix/postfix as in scan_files
+        IndexName: index file, None for the default one under ~/.cache/perfusion
+        return: {SeriesInstanceUID: sorted list of files}
+        '''
+        series = {}
+        for uid, files in DicomIndex(self.directory, IndexName, threads).update().series().items():
+            names = [os.path.basename(f) for f in files]
+            files = [f for f, name in zip(files, names) if (name.endswith(self.postfix) if self.postfix else \
+                (name.startswith(self.prefix) if self.prefix else True))]
+            if files:
+                series[uid] = files
+        return series
+
     def direct_sub(self): 
         # Get direct sub-directories of origin directory
         direct_sub = [name for name in os.listdir(self.directory) 
@@ -57,24 +74,24 @@ class LoadImage(object):
     '''
     Load Image(s) via SimpleITK, images could be .nii, .nii,gz, .mha, .dcm, ...
     '''
-    def __init__(self, filename, isDICOM = False):
+    def __init__(self, filename, isDICOM = False, threads = 0):
         '''
         filename: /path/to/file(s)
+        threads: threads reading a DICOM series, 0 for min(32, cpu_count + 4)
         '''
         self.filename = filename
         self.isDICOM  = isDICOM
+        self.threads  = threads
     
-    @auto_attr
+    @functools.cached_property
     def read_image(self):
         '''
         Read in images
         '''
         if self.isDICOM:
             print("Reading Dicom directory:", os.path.basename(self.filename))
-            reader = sitk.ImageSeriesReader()
-            dicom_names = reader.GetGDCMSeriesFileNames(self.filename)
-            reader.SetFileNames(dicom_names)
-            image = reader.Execute()
+            # Files read in parallel and grouped into time frames (4D perfusion series as a vector image)
+            image = DicomSeries(self.filename, threads = self.threads).to_image()
         else:
             print('File name: %s\n' % os.path.basename(self.filename))
             image = sitk.ReadImage(self.filename)
@@ -115,7 +132,8 @@ class LoadImage(object):
         '''
         if not n_slices > 0:
             raise NotImplementedError('Input # of slices (%d) should be positive' % n_slices)
-        
+        import matplotlib.pyplot as plt # only for display, not imported by the calculation
+
         img, array = self.read_image
             
         cmap = 'Greys'
@@ -0,0 +1,213 @@
+import json
+import torch
+import numpy as np
+
+'''
+Quality control of the signal and the CTC
+
+One fused pass per stage, slice by slice, gives NaN/Inf counts, min/max/mean per slice and per time frame and
+the number of non-positive (MRP: converted to 1) and saturated values, without any index tensor of the whole
+volume; non-finite CTC values fail the calculation right away, with their voxel locations. The statistics of
+all stages of a study are saved as one json report (see MainCalculator).
+'''
+
+# Offending values located (slice, row, column, time) per kind, in failures and in the report
+MAX_LOCATIONS = 10
+
+# Counted per slice
+COUNTS = ['nan', 'inf', 'non_positive', 'saturated']
+
+
+class QCError(ValueError):
+    pass
+
+
+def finite_or_none(values):
+    return [float(v) if np.isfinite(v) else None for v in values]
+
+
+class QCStats(object):
+    '''
+    QC statistics of a (slice, row, column, time) array, per slice and per time frame
+    first_slice: index of the first slice in the whole study (tiles of slices)
+    '''
+    def __init__(self, n_slice, n_time, first_slice = 0, dtype = None):
+        self.first_slice = first_slice
+        self.dtype = dtype
+        self.slices = {name: np.zeros(n_slice, dtype = np.int64) for name in COUNTS + ['values']}
+        self.slices.update(min = np.full(n_slice, np.inf), max = np.full(n_slice, -np.inf), sum = np.zeros(n_slice))
+        self.frames = {'min': np.full(n_time, np.inf), 'max': np.full(n_time, -np.inf), 'sum': np.zeros(n_time), \
+            'values': np.zeros(n_time, dtype = np.int64)}
+        self.locations = {name: [] for name in ['nan', 'inf', 'saturated']}
+
+    def add(self, s, slab, voxel, saturation = None, non_positive = False):
+        '''
+        Statistics of slab (n_voxel, time), the voxels of slice s
+        voxel: function giving the [slice, row, column] of rows of the slab
+        non_positive: whether to count the values <= 0
+        '''
+        values = slab if slab.is_floating_point() and slab.dtype != torch.bfloat16 else slab.float()
+        n_time = values.size(-1)
+        # A finite sum of the slab means all its values are finite: the masked statistics are only made otherwise
+        if bool(torch.isfinite(values.sum())):
+            flags = {}
+            summary = torch.cat([values.amin(dim = 0).double(), values.amax(dim = 0).double(), values.sum(dim = 0).double()])
+            frame_min, frame_max, frame_sum = summary.cpu().numpy().reshape(3, n_time)
+            frame_values = np.full(n_time, values.size(0), dtype = np.int64)
+            counts = dict.fromkeys(COUNTS, 0)
+        else:
+            finite = torch.isfinite(values)
+            flags = {'nan': torch.isnan(values)}
+            flags['inf'] = ~(finite | flags['nan'])
+            low  = torch.where(finite, values, torch.full_like(values, float('inf')))
+            high = torch.where(finite, values, torch.full_like(values, -float('inf')))
+            clean = torch.where(finite, values, torch.zeros_like(values))
+            # One transfer (and host sync) per slice
+            summary = torch.cat([low.amin(dim = 0).double(), high.amax(dim = 0).double(), clean.sum(dim = 0, dtype = torch.float64), \
+                finite.sum(dim = 0).double(), torch.stack([flags['nan'].sum(), flags['inf'].sum()]).double()]).cpu().numpy()
+            frame_min, frame_max, frame_sum, frame_values = summary[:4 * n_time].reshape(4, n_time)
+            frame_values = frame_values.astype(np.int64)
+            counts = dict(dict.fromkeys(COUNTS, 0), nan = int(summary[-2]), inf = int(summary[-1]))
+        # Values <= 0 and saturated values are only counted in slices reaching them
+        if non_positive and frame_min.min() <= 0:
+            counts['non_positive'] = int((values <= 0).sum())
+        if saturation is not None and frame_max.max() >= saturation:
+            flags['saturated'] = values >= saturation
+            counts['saturated'] = int(flags['saturated'].sum())
+        self.frames['min'] = np.minimum(self.frames['min'], frame_min)
+        self.frames['max'] = np.maximum(self.frames['max'], frame_max)
+        self.frames['sum'] += frame_sum
+        self.frames['values'] += frame_values
+        self.slices['min'][s] = frame_min.min()
+        self.slices['max'][s] = frame_max.max()
+        self.slices['sum'][s] = frame_sum.sum()
+        self.slices['values'][s] = int(frame_values.sum())
+        for name, count in counts.items():
+            self.slices[name][s] = count
+            if name in self.locations and count > 0 and len(self.locations[name]) < MAX_LOCATIONS:
+                where = torch.nonzero(flags[name])[: MAX_LOCATIONS - len(self.locations[name])].cpu()
+                self.locations[name] += [[int(v) for v in voxel(row)] + [int(t)] for row, t in where.tolist()]
+
+    def extend(self, other):
+        '''
+        Statistics of the slices following these (next tile)
+        '''
+        for name in self.slices:
+            self.slices[name] = np.concatenate([self.slices[name], other.slices[name]])
+        self.frames['min'] = np.minimum(self.frames['min'], other.frames['min'])
+        self.frames['max'] = np.maximum(self.frames['max'], other.frames['max'])
+        for name in ['sum', 'values']:
+            self.frames[name] = self.frames[name] + other.frames[name]
+        for name, locations in other.locations.items():
+            self.locations[name] = (self.locations[name] + locations)[:MAX_LOCATIONS]
+        return self
+
+    def total(self, name):
+        return int(self.slices[name].sum())
+
+    def check(self, name):
+        '''
+        Raise QCError if any value is not finite, with the first offending locations
+        '''
+        n_nan, n_inf = self.total('nan'), self.total('inf')
+        if n_nan or n_inf:
+            raise QCError('Computed %s contains %d NaN and %d Inf values, check out! (slice, row, column, time): NaN at %s, Inf at %s' % \
+                (name, n_nan, n_inf, self.locations['nan'], self.locations['inf']))
+
+    def to_dict(self):
+        n_values = self.slices['values'].sum()
+        with np.errstate(invalid = 'ignore', divide = 'ignore'):
+            slice_mean = self.slices['sum'] / self.slices['values']
+            frame_mean = self.frames['sum'] / self.frames['values']
+        return {'dtype': self.dtype, 'slices': [self.first_slice, self.first_slice + len(self.slices['min'])], \
+            'total': dict({'min': finite_or_none([self.slices['min'].min()])[0], 'max': finite_or_none([self.slices['max'].max()])[0], \
+                'mean': float(self.slices['sum'].sum() / n_values) if n_values else None}, **{name: self.total(name) for name in COUNTS}), \
+            'per_slice': dict({'min': finite_or_none(self.slices['min']), 'max': finite_or_none(self.slices['max']), \
+                'mean': finite_or_none(slice_mean)}, **{name: self.slices[name].tolist() for name in COUNTS}), \
+            'per_frame': {'min': finite_or_none(self.frames['min']), 'max': finite_or_none(self.frames['max']), \
+                'mean': finite_or_none(frame_mean)}, \
+            'locations': self.locations}
+
+
+def scan(values, layout = None, first_slice = 0, saturation = None, non_positive = False):
+    '''
+    QC statistics of values in one pass, slice by slice
+    values: (slice, row, column, time) numpy array or tensor, or packed (n_voxel, time) with its mask.PackedVolume layout
+    saturation: values counted as saturated from, None for none
+    non_positive: whether to count the values <= 0
+    return: QCStats
+    '''
+    values = torch.as_tensor(values)
+    n_time = values.size(-1)
+    if layout is None:
+        n_slice, n_column = values.size(0), values.size(2)
+        slabs = ((s, values[s].reshape(-1, n_time), lambda row, s = s: [s + first_slice, row // n_column, row % n_column]) \
+            for s in range(n_slice))
+    else:
+        n_slice = layout.shape[0]
+        per_slice = torch.bincount(layout.index // (layout.shape[1] * layout.shape[2]), minlength = n_slice).tolist()
+        starts = np.cumsum([0] + per_slice).tolist()
+        def voxel(row, start):
+            s, r, c = layout.voxels([start + row])[0].tolist()
+            return [s + first_slice, r, c]
+        slabs = ((s, values[starts[s] : starts[s + 1]], lambda row, start = starts[s]: voxel(row, start)) for s in range(n_slice))
+    stats = QCStats(n_slice, n_time, first_slice, str(values.dtype).replace('torch.', ''))
+    for s, slab, voxel_of in slabs:
+        if slab.numel():
+            stats.add(s, slab, voxel_of, saturation, non_positive)
+    return stats
+
+
+class QCReport(object):
+    '''
+    QC statistics of the stages of a study, by stage name
+    first_slice: index of the first slice scanned in the whole study (tiles of slices)
+    saturation: signal value counted as saturated from, 0 for the maximum of integer signal types
+    '''
+    def __init__(self, first_slice = 0, saturation = 0):
+        self.first_slice = first_slice
+        self.saturation = saturation
+        self.stages = {}
+        self.error = None
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(saturation = config.qc_saturation)
+
+    def signal_saturation(self, dtype):
+        if self.saturation > 0:
+            return self.saturation
+        dtype = np.dtype(dtype)
+        return int(np.iinfo(dtype).max) if dtype.kind in 'iu' else None
+
+    def scan(self, name, values, layout = None, signal = False, fail = False, non_positive = False):
+        '''
+        Scan values (see scan) as stage name, added to its statistics (tile after tile)
+        signal: whether values is a (raw) signal, checked for saturation
+        non_positive: whether to count the values <= 0
+        fail: raise QCError on any non-finite value
+        return: QCStats of values
+        '''
+        dtype = str(values.dtype).replace('torch.', '')
+        saturation = self.signal_saturation(dtype) if signal and dtype != 'bfloat16' else None
+        stats = scan(values, layout, self.first_slice, saturation, non_positive)
+        self.add(name, stats)
+        if fail:
+            stats.check(name.upper())
+        return stats
+
+    def add(self, name, stats):
+        self.stages[name] = self.stages[name].extend(stats) if name in self.stages else stats
+
+    def merge(self, other):
+        '''
+        Statistics of another report (of the next tile), added stage by stage
+        '''
+        for name, stats in other.stages.items():
+            self.add(name, stats)
+
+    def save(self, FileName, **info):
+        report = dict(info, stages = {name: stats.to_dict() for name, stats in self.stages.items()}, error = self.error)
+        with open(FileName, 'w') as f:
+            json.dump(report, f, indent = 1)
+        return FileName
@@ -0,0 +1,350 @@
+import os
+import sys
+import copy
+import json
+import time
+import queue
+import signal
+import shutil
+import socket
+import tempfile
+import threading
+import traceback
+import socketserver
+
+from config import get_parser
+
+'''
+Long-running calculation service with a local job queue
+
+The runtime (torch, SimpleITK, the calculator modules), the device and the configuration are set up once, then
+studies are calculated job by job as they come from a watched directory and/or a Unix socket, without the
+start-up cost of a one-shot run (python main.py) for each of them.
+
+A job is a json object: {"input": 4D image or DICOM series directory, "output": save folder (default: a folder of
+its own per study, <dirname>/<basename without extension>, see batch.study_folder; the directory itself for a DICOM
+series), "config": {config field: value} overriding the configuration of the service, "id": optional name}.
+
+Watched directory (--watch DIR): job files DIR/*.json (written elsewhere and moved in, or named .*.json while being
+written) are claimed in name order by moving them into DIR/running, then into DIR/done or DIR/failed with their
+status and timing, so that a job file is never run twice; jobs left in DIR/running by a stopped service are rerun.
+Unix socket (--socket PATH): one json line per connection, answered by json lines: the queued job, then its final
+status (unless "wait" is false). {"command": "status"} answers the status of all jobs, {"command": "shutdown"}
+stops the service once the running job is done (as SIGINT/SIGTERM do).
+
+Example:
+    python service.py --watch /data/jobs --socket /tmp/perfusion.sock --warmup True
+    python service.py --submit study.nii --output results --socket /tmp/perfusion.sock
+'''
+
+# Job status
+QUEUED, RUNNING, DONE, FAILED = 'queued', 'running', 'done', 'failed'
+
+
+def parse_service_config(args = None):
+
+    parser = get_parser("CTP/MRP Colormaps Calculation Service")
+    parser.add_argument('--watch', type = str, default = '', help = 'Directory watched for job files (*.json), empty for none')
+    parser.add_argument('--socket', type = str, default = '', help = 'Unix socket accepting jobs, empty for none')
+    parser.add_argument('--poll', type = float, default = 0.5, help = 'Interval (s) between two scans of the watched directory')
+    parser.add_argument('--warmup', type = bool, default = False, help = 'Whether calculate a small phantom at start-up, \
+        so that the first job does not pay for the lazy initialization of torch and its kernels')
+    parser.add_argument('--submit', type = str, default = '', help = 'Client: submit this study to the service at --socket, \
+        wait for it and print its status')
+    parser.add_argument('--output', type = str, default = '', help = 'Client: save folder of the submitted study, \
+        empty for <dirname>/<basename without extension> of the study')
+    parser.add_argument('--job_config', type = str, default = '{}', help = 'Client: config overrides of the submitted study (json)')
+
+    return parser.parse_args(args)
+
+
+def now():
+    return time.strftime('%Y-%m-%d %H:%M:%S')
+
+
+class Service(object):
+    '''
+    Jobs queued from any thread, calculated one after another by the thread calling work()
+    config: configuration of all jobs (overridden per job), device and logger: set up once for all jobs
+    '''
+    def __init__(self, config, device, logger):
+        self.config = config
+        self.device = device
+        self.logger = logger
+        self.queue = queue.Queue()
+        self.jobs = {} # status of all jobs, by id
+        self.finished = {} # set once a job is done or failed, by id
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.count = 0
+
+    def job_config(self, overrides):
+        config = copy.copy(self.config)
+        for key, value in overrides.items():
+            if not hasattr(config, key):
+                raise ValueError('Unknown config field: %s' % key)
+            setattr(config, key, value)
+        return config
+
+    def submit(self, job, source, on_finish = None):
+        '''
+        Queue job (see above), from source ('watch'/'socket')
+        on_finish: called with the status of the job once it is done or failed
+        return: status of the job
+        '''
+        with self.lock:
+            self.count += 1
+            JobId = str(job.get('id') or '%s-%d' % (time.strftime('%Y%m%d_%H%M%S'), self.count))
+            if JobId in self.jobs and self.jobs[JobId]['status'] in [QUEUED, RUNNING]:
+                raise ValueError('Job %s is already queued' % JobId)
+            record = {'id': JobId, 'input': job.get('input'), 'output': job.get('output'), 'config': job.get('config', {}), \
+                'source': source, 'status': QUEUED, 'queued': now(), 'started': None, 'finished': None, \
+                'wait_s': None, 'seconds': None, 'error': None}
+            self.jobs[JobId] = record
+            self.finished[JobId] = threading.Event()
+        self.queue.put((record, time.perf_counter(), on_finish))
+        self.logger.info('Job %s queued (%s): %s' % (JobId, source, record['input']))
+        return dict(record)
+
+    def status(self):
+        with self.lock:
+            return [dict(record) for record in self.jobs.values()]
+
+    def wait(self, JobId):
+        self.finished[JobId].wait()
+        with self.lock:
+            return dict(self.jobs[JobId])
+
+    def run_job(self, record, queued):
+        '''
+        Calculate one job in this (warm) process, its status and timing kept in record
+        '''
+        import torch
+        from main import run
+        from batch import study_folder
+
+        started = time.perf_counter()
+        with self.lock:
+            record.update(status = RUNNING, started = now(), wait_s = round(started - queued, 3))
+        try:
+            if not record['input'] or not os.path.exists(record['input']):
+                raise FileNotFoundError('Input not found: %s' % record['input'])
+            config = self.job_config(record['config'])
+            FileName = os.path.abspath(record['input'])
+            # Studies of one folder write the same result file names: each in a folder of its own
+            SaveFolder = record['output'] or study_folder(FileName.rstrip(os.sep))
+            os.makedirs(SaveFolder, exist_ok = True)
+            run(FileName, SaveFolder, config, self.device, self.logger)
+            status, error = DONE, None
+        except Exception as e:
+            status, error = FAILED, ''.join(traceback.format_exception_only(type(e), e)).strip()
+            self.logger.error('Job %s failed:\n%s' % (record['id'], traceback.format_exc()))
+        finally:
+            # Nothing of a job kept on the device for the next one
+            if self.device.type == 'cuda':
+                torch.cuda.empty_cache()
+        with self.lock:
+            record.update(status = status, finished = now(), seconds = round(time.perf_counter() - started, 3), error = error)
+        self.logger.info('Job %s %s in %.1f s (waited %.1f s)' % (record['id'], status, record['seconds'], record['wait_s']))
+        return dict(record)
+
+    def work(self):
+        '''
+        Calculate the queued jobs until the service is stopped (the running job is finished first)
+        '''
+        while not self.stopping.is_set():
+            try:
+                record, queued, on_finish = self.queue.get(timeout = 0.2)
+            except queue.Empty:
+                continue
+            result = self.run_job(record, queued)
+            if on_finish is not None:
+                on_finish(result)
+            self.finished[record['id']].set()
+
+    def stop(self, *args):
+        self.stopping.set()
+
+
+class JobDirectory(object):
+    '''
+    Watched directory of job files (see above)
+    '''
+    def __init__(self, service, directory, poll = 0.5):
+        self.service = service
+        self.directory = directory
+        self.poll = poll
+        for name in ['running', 'done', 'failed']:
+            os.makedirs(os.path.join(directory, name), exist_ok = True)
+
+    def path(self, *names):
+        return os.path.join(self.directory, *names)
+
+    def claim(self, name, folder = ''):
+        '''
+        Queue the job file name (in folder) after moving it into running/
+        '''
+        running = self.path('running', name)
+        if folder != 'running':
+            try:
+                os.rename(self.path(folder, name), running)
+            except FileNotFoundError: # claimed by another service watching the same directory
+                return
+        try:
+            with open(running) as f:
+                job = json.load(f)
+            job.setdefault('id', os.path.splitext(name)[0])
+            self.service.submit(job, 'watch', lambda record: self.finish(name, job, record))
+        except Exception as e:
+            record = {'status': FAILED, 'finished': now(), 'error': ''.join(traceback.format_exception_only(type(e), e)).strip()}
+            self.finish(name, {}, record)
+
+    def finish(self, name, job, record):
+        '''
+        Move the job file into done/ or failed/, with its status and timing
+        '''
+        result = dict(job, **record)
+        folder = 'done' if record['status'] == DONE else 'failed'
+        tmp = self.path(folder, '.' + name)
+        with open(tmp, 'w') as f:
+            json.dump(result, f, indent = 2)
+        os.replace(tmp, self.path(folder, name))
+        os.remove(self.path('running', name))
+
+    def watch(self):
+        for name in sorted(os.listdir(self.path('running'))):
+            if name.endswith('.json') and not name.startswith('.'):
+                self.service.logger.info('Rerun job left by a stopped service: %s' % name)
+                self.claim(name, 'running')
+        while not self.service.stopping.is_set():
+            for name in sorted(os.listdir(self.directory)):
+                if name.endswith('.json') and not name.startswith('.') and os.path.isfile(self.path(name)):
+                    self.claim(name)
+            self.service.stopping.wait(self.poll)
+
+
+class JobHandler(socketserver.StreamRequestHandler):
+    '''
+    One json request per connection on the Unix socket (see above)
+    '''
+    def reply(self, message):
+        self.wfile.write((json.dumps(message) + '\n').encode())
+        self.wfile.flush()
+
+    def handle(self):
+        service = self.server.service
+        try:
+            request = json.loads(self.rfile.readline().decode())
+            command = request.get('command', 'submit')
+            if command == 'status':
+                self.reply({'jobs': service.status()})
+            elif command == 'shutdown':
+                service.stop()
+                self.reply({'status': 'stopping'})
+            elif command == 'submit':
+                record = service.submit(request, 'socket')
+                self.reply(record)
+                if request.get('wait', True):
+                    self.reply(service.wait(record['id']))
+            else:
+                raise ValueError('Unknown command: %s' % command)
+        except Exception as e:
+            self.reply({'status': FAILED, 'error': ''.join(traceback.format_exception_only(type(e), e)).strip()})
+
+
+class JobServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def warmup(service):
+    '''
+    Calculate a small phantom once, so that kernels, thread pools and allocators are initialized before the first job
+    '''
+    from phantom import phantom, save
+
+    config = service.config
+    folder = tempfile.mkdtemp(prefix = 'perfusion_warmup_')
+    try:
+        FileName = os.path.join(folder, 'warmup.nii')
+        save(phantom((2, 32, 32), 20, config.image_type, config.TR if config.image_type == 'MRP' else config.ct_interval)[0], FileName)
+        overrides = {'mask': [[], [], []] if config.image_type == 'CTP' else [0], 'cache_dir': '', 'instrument': False, \
+            'save_intermediates': 'none', 'accuracy_report': False}
+        started = time.perf_counter()
+        record = service.run_job({'id': 'warmup', 'input': FileName, 'output': folder, 'config': overrides}, started)
+        print('Warm-up %s in %.2f s' % (record['status'], record['seconds']))
+    finally:
+        shutil.rmtree(folder, ignore_errors = True)
+
+
+def submit(config):
+    '''
+    Client: submit a study to the service at config.socket, print the replies
+    return: 0 if done
+    '''
+    job = {'input': os.path.abspath(config.submit), 'output': os.path.abspath(config.output) if config.output else None, \
+        'config': json.loads(config.job_config)}
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.connect(config.socket)
+        client.sendall((json.dumps(job) + '\n').encode())
+        replies = [json.loads(line) for line in client.makefile().read().splitlines() if line.strip()]
+    for reply in replies:
+        print(json.dumps(reply, indent = 2))
+    return 0 if replies and replies[-1].get('status') == DONE else 1
+
+
+def main():
+
+    config = parse_service_config()
+    if config.submit:
+        return submit(config)
+    if not (config.watch or config.socket):
+        raise ValueError('Nothing to serve: give --watch and/or --socket')
+
+    # Warm imports: everything a job needs is loaded once, here
+    import torch
+    import main as calculation
+    import tiling
+    import scipy.ndimage
+    if config.shard_workers > 0:
+        import sharding
+    from utils import get_logger
+
+    logger = get_logger('Perfusion Parameters Calculation Service')
+    device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+    logger.info('Service on %s, config: %s' % (device, config))
+    service = Service(config, device, logger)
+    if config.warmup:
+        warmup(service)
+
+    threads = []
+    if config.watch:
+        directory = JobDirectory(service, config.watch, config.poll)
+        threads.append(threading.Thread(target = directory.watch, name = 'JobDirectory', daemon = True))
+    server = None
+    if config.socket:
+        if os.path.exists(config.socket):
+            os.remove(config.socket)
+        server = JobServer(config.socket, JobHandler)
+        server.service = service
+        threads.append(threading.Thread(target = server.serve_forever, name = 'JobServer', daemon = True))
+    for thread in threads:
+        thread.start()
+    signal.signal(signal.SIGINT, service.stop)
+    signal.signal(signal.SIGTERM, service.stop)
+    print('Service ready: %s' % ', '.join(filter(None, [config.watch and 'watching ' + config.watch, \
+        config.socket and 'listening on ' + config.socket])))
+
+    service.work()
+    if server is not None:
+        server.shutdown()
+        server.server_close()
+        os.remove(config.socket)
+    print('Service stopped: %d job(s) done, %d failed' % tuple(sum(record['status'] == status for record in service.status()) \
+        for status in [DONE, FAILED]))
+    return 0
+
+
+########################################################################################################################
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,185 @@
+import os
+import sys
+import numpy as np
+import torch
+import multiprocessing
+from multiprocessing import shared_memory
+from concurrent.futures import ProcessPoolExecutor
+
+import precision
+from batch import init_worker
+from signal_reader import read_signal
+import ParamsCalculator.motion as motion
+from tiling import TiledCalculator, CurveStore, split
+
+'''
+CPU execution sharded by slices over a process pool
+
+The preprocessed signal and the CTC are kept in shared memory, worker processes get them by name (the arrays
+are never pickled) and run the tiling steps (see tiling.py) on their shards of slices, each with its own
+torch/BLAS threads; only per-shard results (maps, AIF features, mean curve sums) are sent back, merged in
+slice order whatever order the shards finish in. Results are the same as those of a single process.
+
+The signal is read and preprocessed slice by slice straight into shared memory (see signal_reader.SlabReader), so
+that the parent holds the study once; with motion correction, which needs all slices at once, it is read as a whole
+first. How the run time scales with the number of workers depends on the node (memory bandwidth, cores): measure
+it there with benchmark.py --scaling_workers rather than assuming it.
+'''
+
+# Shards per worker: smaller shards even out slices with more brain voxels than others
+SHARDS_PER_WORKER = 2
+
+# Shared arrays attached by this process, by name (each is mapped once per worker)
+ATTACHED = {}
+
+
+class SharedArray(object):
+    '''
+    numpy array in shared memory, pickled by name only; created if name is None, else attached
+    '''
+    def __init__(self, shape, dtype, name = None):
+        self.shape, self.dtype = tuple(int(n) for n in shape), np.dtype(dtype)
+        size = max(int(np.prod(self.shape)) * self.dtype.itemsize, 1)
+        self.shm = shared_memory.SharedMemory(name = name, create = name is None, size = size if name is None else 0)
+        self.owner = name is None
+        self.array = np.ndarray(self.shape, dtype = self.dtype, buffer = self.shm.buf)
+
+    def __reduce__(self):
+        return attach, (self.shm.name, self.shape, self.dtype.str)
+
+    def __array__(self, dtype = None, copy = None):
+        return self.array if dtype is None else self.array.astype(dtype)
+
+    def read(self, start, stop):
+        '''
+        Slices [start, stop) of the array (signal source of the tiling steps)
+        '''
+        return self.array[start : stop]
+
+    def close(self):
+        self.array = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+def attach(name, shape, dtype):
+    if name not in ATTACHED:
+        ATTACHED[name] = SharedArray(shape, dtype, name)
+    return ATTACHED[name]
+
+
+def to_numpy(values):
+    '''
+    Tensors in (nested) results as numpy arrays, sent back from workers without torch's own tensor sharing
+    '''
+    if torch.is_tensor(values):
+        return values.cpu().numpy()
+    if isinstance(values, (tuple, list)):
+        return type(values)(to_numpy(value) for value in values)
+    if isinstance(values, dict):
+        return {key: to_numpy(value) for key, value in values.items()}
+    return values
+
+
+def to_torch(values):
+    if isinstance(values, np.ndarray):
+        return torch.from_numpy(values)
+    if isinstance(values, (tuple, list)):
+        return type(values)(to_torch(value) for value in values)
+    if isinstance(values, dict):
+        return {key: to_torch(value) for key, value in values.items()}
+    return values
+
+
+def init_shard_worker(n_threads, quiet = False):
+    init_worker(n_threads)
+    # Printing follows the parent: silenced if its output is redirected away (e.g., by benchmark.py)
+    if quiet:
+        sys.stdout = open(os.devnull, 'w')
+
+
+def run_step(step, job):
+    return to_numpy(step(*job))
+
+
+class ShardedCalculator(TiledCalculator):
+    """Calculator sharding a study by slices over config.shard_workers processes on the CPU.
+    The study is read (and preprocessed) slice by slice into shared memory, then goes through the passes
+    of TiledCalculator with the shards of all workers processed at once.
+    """
+    def __init__(self, FileName, config, save_path, device, logger = None, writer = None, recorder = None):
+        super().__init__(FileName, config, save_path, device, logger, writer, recorder)
+        self.pool = None
+        self.shared = []
+
+    @property
+    def n_workers(self):
+        return max(self.config.shard_workers, 1)
+
+    def open(self):
+        if self.config.motion_correction:
+            return self.open_registered()
+        reader = super().open()
+        first = reader.read(0, 1)
+        signal = SharedArray(self.shape, first.dtype)
+        self.shared.append(signal)
+        signal.array[:1] = first
+        del first
+        for s in range(1, self.nS):
+            signal.array[s : s + 1] = reader.read(s, s + 1)
+        return signal
+
+    def open_registered(self):
+        '''
+        Source of the whole study read, registered (see motion.correct) and then copied into shared memory
+        '''
+        config = self.config
+        sig, origin, spacing, direction = read_signal(self.filename, config.image_type, ToTensor = False, Mask = config.mask, \
+            Writer = self.writer, Precision = config.precision, PercentileError = config.percentile_error, Recorder = self.recorder, \
+            DicomThreads = config.dicom_threads)
+        self.shape, self.geometry, self.raw_dtype = list(sig.shape), (origin, spacing, direction), sig.dtype
+        # Frames registered on the whole study before it is shared (as the motion and registered stages of MainCalculator)
+        with self.recorder.stage('motion', int(np.prod(sig.shape[:3]))):
+            registered, Motion = motion.correct(torch.from_numpy(sig), spacing, config, torch.device('cpu'), motion.background(config))
+            sig = registered.numpy()
+        self.save_motion(Motion)
+        signal = SharedArray(sig.shape, sig.dtype)
+        signal.array[...] = sig
+        self.shared.append(signal)
+        print('  CTC images and the accuracy report are not saved by %s' % type(self).__name__)
+        return signal
+
+    def plan(self):
+        n_shards = min(self.nS, self.n_workers * SHARDS_PER_WORKER)
+        shards = split(self.nS, -(-self.nS // n_shards), self.halo)
+        print('Sharded execution: %d slices in %d shard(s) over %d worker(s) x %d thread(s)' % \
+            (self.nS, len(shards), self.n_workers, self.n_threads))
+        return shards
+
+    def store(self, n_voxel):
+        dtype = precision.storage_dtype(self.config.precision)
+        array = SharedArray((max(n_voxel, 1), self.nT), 'i%d' % (torch.finfo(dtype).bits // 8))
+        self.shared.append(array)
+        return CurveStore(array, dtype, precision.compute_dtype(self.config.precision), self.device)
+
+    def map(self, name, step, tiles, jobs):
+        '''
+        Results of step(*job) for the shards in order, computed by the workers
+        '''
+        with self.recorder.stage(name.replace('tile/', 'shards/'), self.nS * self.nR * self.nC):
+            return [to_torch(result) for result in self.pool.map(run_step, [step] * len(jobs), jobs)]
+
+    def main_cal(self):
+        self.n_threads = self.config.shard_threads if self.config.shard_threads > 0 else max(os.cpu_count() // self.n_workers, 1)
+        # spawn: workers do not inherit torch (thread pool) state of the parent
+        context = multiprocessing.get_context('spawn')
+        try:
+            with ProcessPoolExecutor(max_workers = self.n_workers, mp_context = context, initializer = init_shard_worker, \
+                initargs = (self.n_threads, sys.stdout is not sys.__stdout__)) as self.pool:
+                super().main_cal()
+        finally:
+            self.pool = None
+            for array in self.shared:
+                array.close()
+            self.shared = []
@@ -1,96 +1,381 @@
 import os
-import torch 
+import torch
 import numpy as np
 import SimpleITK as sitk
-import scipy.ndimage as ndimage
 
-from utils import cutoff_percentile
+import instrument
+from qc import QCReport
+from utils import PeakMemory, StreamingHistogram
+from writer import ImageWriter
+from dicom import DicomSeries
+from precision import RAW_DTYPES, numpy_dtype
 
-def read_signal(FileName, ImageType, ToTensor = True, Mask = [0]):
+# Slices of the cropped signal converted to float32 at a time
+SLAB_MB = 64
 
-    print('Reading in %s image: %s' % (ImageType, os.path.basename(FileName)))
-    if ImageType == 'MRP':
-        return read_mrp(FileName, ToTensor, Mask[0])
-    elif ImageType == 'CTP':
-        return read_ctp(FileName, ToTensor, Mask)
+# NIfTI-1 datatype codes readable through a memory map
+NIFTI_DTYPES = {2: np.uint8, 4: np.int16, 8: np.int32, 16: np.float32, 64: np.float64, \
+    256: np.int8, 512: np.uint16, 768: np.uint32}
 
 
-def read_mrp(FileName, ToTensor = True, BackGround = 0):
+def read_signal(FileName, ImageType, ToTensor = True, Mask = [0], Writer = None, Precision = 'float32', PercentileError = 1e-4, \
+    Recorder = None, DicomThreads = 0, QC = None):
+    '''
+    FileName: 4D perfusion image file, or directory of a DICOM series (read in parallel, see dicom.py),
+              or an opened SignalSource (e.g., a FrameSource of frames read one by one)
+    Writer: writer.ImageWriter for the intermediate outputs, None for synchronously writing all of them
+    Precision: precision of float signals (see precision.py), integer MRP signals are kept in their stored type
+    PercentileError: error of the CTP clipping percentiles relative to the signal range (exact for 8/16-bit integer signals)
+    Recorder: instrument.Recorder of the reading steps, None for no instrumentation
+    DicomThreads: threads reading a DICOM series, 0 for min(32, cpu_count + 4)
+    QC: qc.QCReport the statistics of the raw (cropped) signal are added to, None for none
+    '''
+
+    print('Reading in %s image: %s' % (ImageType, os.path.basename(source_name(FileName))))
+    Writer = ImageWriter() if Writer is None else Writer
+    Recorder = instrument.Recorder() if Recorder is None else Recorder
+    with PeakMemory() as memory:
+        if ImageType == 'MRP':
+            res = read_mrp(FileName, ToTensor, Mask[0], Writer, Precision, Recorder, DicomThreads, QC)
+        elif ImageType == 'CTP':
+            res = read_ctp(FileName, ToTensor, Mask, Writer, Precision, PercentileError, Recorder, DicomThreads, QC)
+    print('  Peak memory for reading: %.1f MB (process peak RSS: %.1f MB)' % (memory.peak / 1024 ** 2, memory.rss / 1024 ** 2))
+    return res
+
+
+class SignalSource(object):
+    '''
+    4D perfusion image opened as an array view of size (slice, row, column, time)
+
+    Uncompressed NIfTI is memory-mapped: nothing is read from disk until a slab is converted,
+    other formats (.nii.gz, .mha, ...) are read by SimpleITK in their stored pixel type,
+    a directory is read as a DICOM series by a thread pool (DicomThreads)
+    '''
+    def __init__(self, FileName, DicomThreads = 0):
+        self.filename = FileName
+        self.slope, self.inter = 1.0, 0.0
+        if os.path.isdir(FileName):
+            series = DicomSeries(FileName, threads = DicomThreads)
+            self.origin, self.spacing, self.direction = series.origin, series.spacing, series.direction
+            self.array = series.read()
+            print('  Raw signal array shape:', self.array.shape, 'dtype:', self.array.dtype)
+            return
+        reader = sitk.ImageFileReader()
+        reader.SetFileName(FileName)
+        reader.ReadImageInformation()
+        # 4D scalar images carry one more (time) dimension in their geometry
+        dim = reader.GetDimension()
+        self.origin    = tuple(reader.GetOrigin()[:3])
+        self.spacing   = tuple(reader.GetSpacing()[:3])
+        self.direction = tuple(float(d) for d in np.array(reader.GetDirection()).reshape(dim, dim)[:3, :3].ravel())
+
+        self.array = self.memmap_nifti(FileName)
+        if self.array is None:
+            image = sitk.ReadImage(FileName)
+            self.array = sitk.GetArrayFromImage(image)
+            if image.GetDimension() == 4: # (time, slice, row, column)
+                self.array = self.array.transpose(1, 2, 3, 0)
+            del image
+        print('  Raw signal array shape:', self.array.shape, 'dtype:', self.array.dtype)
+
+    def memmap_nifti(self, FileName):
+        '''
+        Memory-map an uncompressed single-file NIfTI-1 image holding a 4D signal, either
+        4D scalar (X, Y, Z, T) or SimpleITK-style vector (X, Y, Z, 1, T); None if not possible
+        '''
+        if not FileName.endswith('.nii'):
+            return None
+        header = np.fromfile(FileName, dtype = np.uint8, count = 348)
+        if len(header) < 348:
+            return None
+        for endian in ['<', '>']:
+            if np.frombuffer(header[:4], dtype = endian + 'i4')[0] == 348:
+                break
+        else:
+            return None
+        dim = np.frombuffer(header[40:56], dtype = endian + 'i2')
+        datatype = int(np.frombuffer(header[70:72], dtype = endian + 'i2')[0])
+        vox_offset, slope, inter = np.frombuffer(header[108:120], dtype = endian + 'f4')
+        if datatype not in NIFTI_DTYPES or header[344:347].tobytes() != b'n+1':
+            return None
+        if dim[0] == 4:
+            shape = (dim[4], dim[3], dim[2], dim[1])
+        elif dim[0] == 5 and dim[4] == 1:
+            shape = (dim[5], dim[3], dim[2], dim[1])
+        else:
+            return None
+        if slope != 0 and not (slope == 1 and inter == 0):
+            self.slope, self.inter = float(slope), float(inter)
+        dtype = np.dtype(NIFTI_DTYPES[datatype]).newbyteorder(endian)
+        array = np.memmap(FileName, dtype = dtype, mode = 'r', offset = int(vox_offset), shape = tuple(int(n) for n in shape))
+        return array.transpose(1, 2, 3, 0) # (slice, row, column, time)
+
+    @property
+    def basename(self):
+        '''
+        Path of the intermediate outputs without suffix: next to the image, or the DICOM directory
+        '''
+        return self.filename.rstrip(os.sep) if os.path.isdir(self.filename) else self.filename[:-4]
+
+    @property
+    def raw(self):
+        '''
+        Whether the stored values are the signal itself in a compact integer type (no scaling)
+        '''
+        return self.slope == 1 and self.inter == 0 and any(self.array.dtype == dtype for dtype in RAW_DTYPES)
+
+    def read(self, crop, dtype = np.float32, frames = None):
+        '''
+        Convert the cropped region (list of [min, max) for slice/row/column) to one array, slab by slab
+        dtype: float type to convert to, None for keeping the stored type if raw (else float32)
+        frames: [min, max) of the time points, None for all
+        '''
+        frames = [0, self.array.shape[3]] if frames is None else frames
+        view = self.array[crop[0][0] : crop[0][1], crop[1][0] : crop[1][1], crop[2][0] : crop[2][1], frames[0] : frames[1]]
+        if dtype is None:
+            dtype = self.array.dtype.newbyteorder('=') if self.raw else np.float32
+        sig = np.empty(view.shape, dtype = dtype)
+        n_slab = max(int(SLAB_MB * 1024 ** 2 // max(sig[0].nbytes, 1)), 1)
+        for start in range(0, sig.shape[0], n_slab):
+            slab = sig[start : start + n_slab]
+            slab[:] = view[start : start + n_slab]
+            if not (self.slope == 1 and self.inter == 0) and sig.dtype.kind == 'f':
+                slab *= self.slope
+                slab += self.inter
+        return sig
+
+    def cropped_origin(self, crop):
+        # Be careful about the dimension correspondence (transpose) between sitk image and numpy array
+        offset = np.array([crop[2][0], crop[1][0], crop[0][0]]) * np.array(self.spacing)
+        return tuple(float(o) for o in np.array(self.origin) + np.array(self.direction).reshape(3, 3) @ offset)
+
+
+class FrameSource(SignalSource):
+    '''
+    Perfusion image assembled from its time frames (3D images of size (slice, row, column)) added one by one,
+    e.g., as they are written during the acquisition (see streaming.py)
+    FileName: folder of the frames (intermediate outputs are named after it)
+    first: first frame (SimpleITK image), giving the geometry
+    '''
+    def __init__(self, FileName, first):
+        self.filename = FileName
+        self.slope, self.inter = 1.0, 0.0
+        self.origin    = tuple(first.GetOrigin())
+        self.spacing   = tuple(first.GetSpacing())
+        self.direction = tuple(first.GetDirection())
+        self.frames = []
+        self.stacked = None
+        self.add(sitk.GetArrayFromImage(first))
+
+    def add(self, frame):
+        if self.frames and frame.shape != self.frames[0].shape:
+            raise ValueError('Frame %d of size %s, expected %s' % (len(self.frames), frame.shape, self.frames[0].shape))
+        self.frames.append(frame)
+        self.stacked = None
+
+    @property
+    def array(self):
+        '''
+        Frames so far # (slice, row, column, time)
+        '''
+        if self.stacked is None:
+            self.stacked = np.stack(self.frames, axis = -1)
+            # Frames kept as views of the stacked array, not as copies
+            self.frames = list(np.moveaxis(self.stacked, -1, 0))
+        return self.stacked
+
+
+def source_name(FileName):
+    return FileName.filename if isinstance(FileName, SignalSource) else FileName
+
+
+def open_source(FileName, DicomThreads = 0):
+    return FileName if isinstance(FileName, SignalSource) else SignalSource(FileName, DicomThreads)
+
+
+def mrp_region(src, BackGround = 0):
+    '''
+    Brain region of an MRP signal (SignalSource), from the first time point only: list of [min, max) for slice/row/column
+    '''
+    brain = src.array[..., 0] != BackGround
+    region = []
+    for axis in [(1, 2), (0, 2), (0, 1)]:
+        nonzero = np.nonzero(np.any(brain, axis = axis))[0]
+        region.append([int(nonzero[0]), int(nonzero[-1]) + 1])
+    return region
+
+
+def correct_mrp(sig, store = None):
+    '''
+    Convert MRP signals <= 0 to 1 in place, slice by slice
+    store: chunkstore.ChunkStore the corrected slices are written into as they are done, None for none
+    '''
+    for s, slab in enumerate(sig):
+        slab[slab <= 0] = 1.0
+        if store is not None:
+            store.write(s, slab[np.newaxis])
+    return sig
+
+
+def ctp_mask(first):
+    '''
+    Brain mask of a CTP signal from its first time point (slice, row, column): > -300 HU, holes filled
+    '''
+    import scipy.ndimage as ndimage # only CTP needs it, imported when used
+
+    return ndimage.binary_fill_holes(first > -300) # TODO
+
+
+def ctp_statistics(chunks, dtype, PercentileError = 1e-4, CutOff = 2.0):
+    '''
+    Mean/std of the brain signal clipped within the [CutOff, 100 - CutOff] percentiles, from one histogram pass
+    chunks: function returning an iterator over the brain signal arrays (see StreamingHistogram.from_chunks)
+    '''
+    histogram = StreamingHistogram.from_chunks(chunks, dtype, PercentileError)
+    cut_off_lower, cut_off_upper = histogram.percentile([CutOff, 100.0 - CutOff])
+    print('Clip within [%.3f, %.3f]' % (cut_off_lower, cut_off_upper))
+    return histogram.clipped_moments(cut_off_lower, cut_off_upper)
+
+
+def normalize_ctp(sig, mask, mean, std, Precision = 'float32', store = None):
+    '''
+    Normalize the masked CTP signal over the brain region by mean/std,
+    in place if already a float array of the target precision, else slice by slice into one
+    store: chunkstore.ChunkStore the normalized slices are written into as they are done, None for none
+    '''
+    normalized = sig if sig.dtype == numpy_dtype(Precision) else np.zeros(sig.shape, dtype = numpy_dtype(Precision))
+    for s, (slab, out, slab_mask) in enumerate(zip(sig, normalized, mask)):
+        out[slab_mask] = (slab[slab_mask] - mean) / std
+        if store is not None:
+            store.write(s, out[np.newaxis])
+    return normalized
+
+
+class SlabReader(object):
+    '''
+    Preprocessed signal of a perfusion image read slab by slab of slices, the same as read_signal gives for them:
+    cropped, corrected (MRP) or masked and normalized (CTP); the CTP mask and statistics are computed once beforehand,
+    from the first time point and one pass over the brain signal slice by slice (see tiling.py)
+    '''
+    def __init__(self, FileName, ImageType, Mask = [0], Precision = 'float32', PercentileError = 1e-4, DicomThreads = 0):
+        print('Opening %s image for reading by slabs: %s' % (ImageType, os.path.basename(FileName)))
+        self.image_type = ImageType
+        self.precision = Precision
+        self.src = SignalSource(FileName, DicomThreads)
+        if ImageType == 'MRP':
+            self.crop = mrp_region(self.src, Mask[0])
+            self.dtype = None if self.src.raw else numpy_dtype(Precision)
+        elif ImageType == 'CTP':
+            if not len(Mask) == 3:
+                raise ValueError('Mask list for CTP should have 3 sub-list element, got %s' % Mask)
+            self.crop = [list(boundary) if len(boundary) else [0, self.src.array.shape[i]] for i, boundary in enumerate(Mask)]
+            self.dtype = None
+            first = self.read_raw(0, self.shape[0], frames = [0, 1])
+            self.mask = ctp_mask(first[..., 0])
+            # Statistics over the brain signal read slice by slice (the image itself is not held in memory)
+            chunks = lambda: (self.read_raw(s, s + 1)[0][self.mask[s]] for s in range(self.shape[0]))
+            self.mean, self.std = ctp_statistics(chunks, first.dtype, PercentileError)
+            del first
+        else:
+            raise ValueError('Unknown image type: %s' % ImageType)
+        print('  Extracted brain region:', self.crop)
+
+    @property
+    def shape(self):
+        return [stop - start for start, stop in self.crop] + [self.src.array.shape[3]]
+
+    @property
+    def geometry(self):
+        return self.src.cropped_origin(self.crop), self.src.spacing, self.src.direction
+
+    def read_raw(self, start, stop, frames = None):
+        '''
+        Cropped signal of slices [start, stop) (and time points [frames[0], frames[1]) if given) before preprocessing
+        '''
+        crop = [[self.crop[0][0] + start, self.crop[0][0] + stop], self.crop[1], self.crop[2]]
+        return self.src.read(crop, self.dtype, frames)
+
+    def read(self, start, stop):
+        '''
+        Preprocessed signal of slices [start, stop) # (slice, row, column, time)
+        '''
+        sig = self.read_raw(start, stop)
+        if self.image_type == 'MRP':
+            return correct_mrp(sig)
+        mask = self.mask[start : stop]
+        sig *= mask[..., np.newaxis]
+        return normalize_ctp(sig, mask, self.mean, self.std, self.precision)
+
+
+def read_mrp(FileName, ToTensor = True, BackGround = 0, Writer = None, Precision = 'float32', Recorder = None, DicomThreads = 0, \
+    QC = None):
     '''
     Read MRP data, convert to target format
 
     *For MR Perfusion image:
     we need to convert signal of those voxels that are negative to 1, avoiding NaN issue when calculate CTC later
+    Integer signals (e.g., int16) are kept in their stored type, only converted to float when the CTC is computed
     '''
 
-    sig_raw = sitk.ReadImage(FileName)
-    print('  Raw signal image  Size:', sig_raw.GetSize(), 'Width/Height/Depth:', sig_raw.GetWidth(), sig_raw.GetHeight(), sig_raw.GetDepth())
-    print('  Time points:', sig_raw.GetNumberOfComponentsPerPixel())
-        
-    sig_nda = sitk.GetArrayFromImage(sig_raw) # should be (slice, row, column, time)
-    sig_nda = sig_nda.astype(float)
-    print('  Raw signal array shape:', sig_nda.shape)
-
-    # Extract brain region
-    brain = np.where(sig_nda[..., 0] != BackGround)
-    min_s = int(np.min(brain[0]))
-    max_s = int(np.max(brain[0])) + 1
-    min_r = int(np.min(brain[1]))
-    max_r = int(np.max(brain[1])) + 1
-    min_c = int(np.min(brain[2]))
-    max_c = int(np.max(brain[2])) + 1
-    brain_region = [[min_s, max_s], [min_r, max_r], [min_c, max_c]]
-    print('  Extracted brain region:', brain_region)
-    sig_resize = sig_nda[min_s:max_s, min_r:max_r, min_c:max_c, :]
+    Writer = ImageWriter() if Writer is None else Writer
+    Recorder = instrument.Recorder() if Recorder is None else Recorder
+    QC = QCReport() if QC is None else QC
+
+    with Recorder.stage('read_signal/crop') as stage:
+        src = open_source(FileName, DicomThreads)
+        brain_region = mrp_region(src, BackGround)
+        print('  Extracted brain region:', brain_region)
+        sig_resize = src.read(brain_region, None if src.raw else numpy_dtype(Precision))
+        stage.voxels = np.prod(sig_resize.shape[:3])
     print('  Resized signal array shape:', sig_resize.shape)
 
     # Save resized signal image as image_resized.nii
-    img_resize = sitk.GetImageFromArray(sig_resize, isVector = True)
-    img_resize.SetDirection(sig_raw.GetDirection())
-    img_resize.SetSpacing(sig_raw.GetSpacing())
-    # Be careful about the dimension correspondence (transpose) between sitk image and numpy array
-    new_origin = sig_raw.GetOrigin() + np.array([min_c, min_r, min_s]) * sig_raw.GetSpacing()
-    del sig_raw
-    img_resize.SetOrigin(new_origin)
-    ResizeFileName = '%s_resized.nii' % FileName[:-4]
-    print('  Reized signal image saved as:', os.path.basename(ResizeFileName))
-    sitk.WriteImage(img_resize, ResizeFileName)
+    new_origin = src.cropped_origin(brain_region)
+    ResizeFileName = Writer.write('resized', sig_resize, '%s_resized' % src.basename, new_origin, src.spacing, src.direction)
+    if ResizeFileName:
+        print('  Reized signal image saved as:', os.path.basename(ResizeFileName))
+
+    # QC of the signal (one pass): values <= 0 are those converted to 1 below
+    with Recorder.stage('read_signal/qc', np.prod(sig_resize.shape[:3])):
+        stats = QC.scan('signal', sig_resize, signal = True, non_positive = True)
+    print('  Min and max of MRP signal: (%g, %g), values <= 0: %d, saturated: %d' % (stats.slices['min'].min(), stats.slices['max'].max(), \
+        stats.total('non_positive'), stats.total('saturated')))
 
     # Convert signal of those voxels that are negative to 1
-    sig_resize[sig_resize <= 0] = 1.0
+    store = Writer.store('corrected', '%s_resized_corrected' % src.basename, sig_resize.shape, sig_resize.dtype, new_origin, src.spacing, \
+        src.direction)
+    with Recorder.stage('read_signal/correct', np.prod(sig_resize.shape[:3])):
+        correct_mrp(sig_resize, store)
+    if store is not None:
+        store.close()
+        print('    Corrected MR Perfusion store saved as:', os.path.basename(store.path))
     print('  Signal convertion for MRP image: <=0 -> 1')
-    print('    Min and max for corrected MRP image: (%d, %d)' % (np.min(sig_resize), np.max(sig_resize)))
 
     # Save corrected MRP image (.nii) as RawName_corrected.nii
-    CrtFileName = '%s_corrected.nii' % ResizeFileName[:-4]
-    print('    Corrected MR Perfusion image saved as:', os.path.basename(CrtFileName))
-    sig_img_crt = sitk.GetImageFromArray(sig_resize, isVector = True)
-    sig_img_crt.SetDirection(img_resize.GetDirection())
-    sig_img_crt.SetOrigin(img_resize.GetOrigin())
-    sig_img_crt.SetSpacing(img_resize.GetSpacing())
-    sitk.WriteImage(sig_img_crt, CrtFileName)
+    CrtFileName = Writer.write('corrected', sig_resize, '%s_resized_corrected' % src.basename, new_origin, src.spacing, src.direction)
+    if CrtFileName:
+        print('    Corrected MR Perfusion image saved as:', os.path.basename(CrtFileName))
 
     if ToTensor:
         sig_resize = torch.from_numpy(sig_resize)
 
-    return sig_resize, img_resize.GetOrigin(), img_resize.GetSpacing(), img_resize.GetDirection()
+    return sig_resize, new_origin, src.spacing, src.direction
 
 
-def read_ctp(FileName, ToTensor = True, BrainMask = []):
+def read_ctp(FileName, ToTensor = True, BrainMask = [], Writer = None, Precision = 'float32', PercentileError = 1e-4, Recorder = None, \
+    DicomThreads = 0, QC = None):
     '''
-    Read MRP data, convert to target format
+    Read CTP data, convert to target format
 
-    *For MR Perfusion image:
-    we need to convert signal of those voxels that are negative to 1, avoiding NaN issue when calculate CTC later
+    *For CT Perfusion image:
+    non-brain region (first time point <= -300 HU, holes filled) is masked out,
+    then the brain region is normalized by mean/std of its percentile-clipped signal
+    Integer signals (e.g., int16 HU) are kept in their stored type until normalized into a float array of Precision
     '''
 
-    sig_raw = sitk.ReadImage(FileName)
-    print('  Raw signal image  Size:', sig_raw.GetSize(), 'Width/Height/Depth:', sig_raw.GetWidth(), sig_raw.GetHeight(), sig_raw.GetDepth())
-    print('  Time points:', sig_raw.GetNumberOfComponentsPerPixel())
-        
-    sig_nda = sitk.GetArrayFromImage(sig_raw) # should be (slice, row, column, time)
-    sig_nda = sig_nda.astype(float)
-    print('  Raw signal array shape:', sig_nda.shape)
+    Writer = ImageWriter() if Writer is None else Writer
+    Recorder = instrument.Recorder() if Recorder is None else Recorder
+    QC = QCReport() if QC is None else QC
 
     # Crop brain region (for UNC CTP)
     if not len(BrainMask) == 3:
@@ -98,61 +383,55 @@ def read_ctp(FileName, ToTensor = True, BrainMask = []):
             with value [[min_slice, max_slice], [min_row, max_row], [min_column, max_column]], \
                 [] is designed for the entire-range selection")
 
-    for i_boundary in range(len(BrainMask)):
-        if len(BrainMask[i_boundary]) == 0:
-            BrainMask[i_boundary] = [0, sig_nda.shape[i_boundary]]
-    
-    print('  Extracted brain region:', BrainMask)
-    sig_resize = sig_nda[BrainMask[0][0] : BrainMask[0][1], BrainMask[1][0] : BrainMask[1][1], BrainMask[2][0] : BrainMask[2][1], :]
-    print('  Resized signal array shape:', sig_resize.shape)
+    with Recorder.stage('read_signal/crop') as stage:
+        src = open_source(FileName, DicomThreads)
+        BrainMask = [list(boundary) if len(boundary) else [0, src.array.shape[i]] for i, boundary in enumerate(BrainMask)]
+        print('  Extracted brain region:', BrainMask)
+        sig = src.read(BrainMask, None)
+        stage.voxels = np.prod(sig.shape[:3])
+    print('  Resized signal array shape:', sig.shape)
+
+    # QC of the signal (one pass)
+    with Recorder.stage('read_signal/qc', np.prod(sig.shape[:3])):
+        stats = QC.scan('signal', sig, signal = True)
+    print('  Min and max of CTP signal: (%g, %g), saturated: %d' % (stats.slices['min'].min(), stats.slices['max'].max(), \
+        stats.total('saturated')))
 
-    # Masked out non-brain region of raw CT perfusion signal image
-    brain_nda = sig_resize[..., 0]
-    mask = np.zeros(brain_nda.shape)
-    brain = np.where(brain_nda >- 300) # TODO
-    mask[brain] = 1
-    mask = ndimage.binary_fill_holes(mask)
-    mask = np.repeat(mask[..., np.newaxis], sig_resize.shape[3], axis = 3)
+    # Save resized signal image as image_resized.nii
+    new_origin = src.cropped_origin(BrainMask)
+    ResizeFileName = Writer.write('resized', sig, '%s_resized' % src.basename, new_origin, src.spacing, src.direction)
+    if ResizeFileName:
+        print('  Resized signal image saved as:', os.path.basename(ResizeFileName))
 
+    # Masked out non-brain region of raw CT perfusion signal image (3D mask broadcast over time)
+    with Recorder.stage('read_signal/mask', np.prod(sig.shape[:3])):
+        mask = ctp_mask(sig[..., 0])
+        sig *= mask[..., np.newaxis]
     print('  Masked out non-brain region of raw CT perfusion signal image.')
-    sig_masked = mask * sig_resize
 
-    # Normalize masked CT over brain region
-    CutOff = 2.0
-    tmp = cutoff_percentile(sig_masked, mask, CutOff, 100.0 - CutOff)
-    sig_masked_normalized = np.copy(sig_masked)
-    sig_masked_normalized[mask] = (sig_masked[mask] - tmp[mask].mean()) / tmp[mask].std()
+    # Save masked signal image as image_masked.nii
+    MaskedFileName = Writer.write('masked', sig, '%s_masked' % src.basename, new_origin, src.spacing, src.direction)
+    if MaskedFileName:
+        print('  Masked signal image saved as:', os.path.basename(MaskedFileName))
 
-    # Save resized signal image as image_resized.nii
-    img_resize = sitk.GetImageFromArray(sig_resize, isVector = True)
-    img_resize.SetDirection(sig_raw.GetDirection())
-    img_resize.SetSpacing(sig_raw.GetSpacing())
-    # Be careful about the dimension correspondence (transpose) between sitk image and numpy array
-    new_origin = sig_raw.GetOrigin() + np.array([BrainMask[0][0], BrainMask[1][0], BrainMask[2][0]]) * sig_raw.GetSpacing()
-    img_resize.SetOrigin(new_origin)
-    ResizeFileName = '%s_resized.nii' % FileName[:-4]
-    print('  Resized signal image saved as:', os.path.basename(ResizeFileName))
-    sitk.WriteImage(img_resize, ResizeFileName)
+    # Normalize masked CT over brain region, by mean/std of the signal clipped within percentiles,
+    # all from one histogram pass over the brain voxels slice by slice (no sort, no copy of the brain signal)
+    CutOff = 2.0
+    with Recorder.stage('read_signal/normalize', int(mask.sum())):
+        mean, std = ctp_statistics(lambda: (slab[slab_mask] for slab, slab_mask in zip(sig, mask)), sig.dtype, PercentileError, CutOff)
+        store = Writer.store('normalized', '%s_normalized' % src.basename, sig.shape, numpy_dtype(Precision), new_origin, src.spacing, \
+            src.direction)
+        sig = normalize_ctp(sig, mask, mean, std, Precision, store)
+    if store is not None:
+        store.close()
+        print('  Normalized signal store saved as:', os.path.basename(store.path))
 
-    # Save masked signal image as image_masked.nii
-    img_masked = sitk.GetImageFromArray(sig_masked, isVector = True)
-    img_masked.SetOrigin(img_resize.GetOrigin())
-    img_masked.SetDirection(img_resize.GetDirection())
-    img_masked.SetSpacing(img_resize.GetSpacing())
-    MaskedFileName = '%s_masked.nii' % FileName[:-4]
-    print('  Masked signal image saved as:', os.path.basename(MaskedFileName))
-    sitk.WriteImage(img_masked, MaskedFileName) 
-    
     # Save normalized signal image as image_normalized.nii
-    img_normalized = sitk.GetImageFromArray(sig_masked_normalized, isVector = True)
-    img_normalized.SetOrigin(img_resize.GetOrigin())
-    img_normalized.SetDirection(img_resize.GetDirection())
-    img_normalized.SetSpacing(img_resize.GetSpacing())
-    NormalizedFileName = '%s_normalized.nii' % FileName[:-4]
-    print('  Normalized signal image saved as:', os.path.basename(NormalizedFileName))
-    sitk.WriteImage(img_normalized, NormalizedFileName)
+    NormalizedFileName = Writer.write('normalized', sig, '%s_normalized' % src.basename, new_origin, src.spacing, src.direction)
+    if NormalizedFileName:
+        print('  Normalized signal image saved as:', os.path.basename(NormalizedFileName))
 
     if ToTensor:
-        sig_masked_normalized = torch.from_numpy(sig_masked_normalized)
+        sig = torch.from_numpy(sig)
 
-    return sig_masked_normalized, img_resize.GetOrigin(), img_resize.GetSpacing(), img_resize.GetDirection()
+    return sig, new_origin, src.spacing, src.direction
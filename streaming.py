@@ -0,0 +1,285 @@
+import os
+import sys
+import json
+import time
+import numpy as np
+
+from config import get_parser
+
+'''
+Streaming calculation of a study whose time frames arrive one by one (e.g., written by the scanner during acquisition)
+
+Frames are 3D images (.nii, .nii.gz, .mha, ...) of size (slice, row, column) written into a watched folder, one file
+per time point, taken in name order (see FrameWatcher). Each frame is preprocessed and converted to CTC as soon as
+it arrives (see StreamingStudy, ctc.StreamingCTC): the bolus arrival time is detected online and the CTC frames are
+given from then on, while the frames are kept for the final calculation. Once the last frame is in, the study is
+calculated from the frames in memory (no reading left), with the same results as a batch run of the 4D image.
+The online MRP brain mask, S0 and CTC are those of the final calculation if the bolus arrival time found online is
+the one of the whole mean curve (global bolus arrival time, no motion correction): they are then passed on to it
+instead of being computed again (see StreamingStudy.reusable).
+
+The online mean CTC curve, the online and final bolus arrival times and the latency of each CTC frame are saved
+as streaming_report.json in the save folder.
+
+Example:
+    python streaming.py --frames_dir /data/incoming/study_001 --n_frames 40 --image_type MRP --output results
+'''
+
+# File written into the watched folder after the last frame (if the number of frames is not known beforehand)
+END = 'END'
+
+
+def parse_streaming_config(args = None):
+
+    parser = get_parser("CTP/MRP Colormaps Streaming Calculation")
+    parser.add_argument('--frames_dir', type = str, default = '', help = 'Folder watched for the time frames (3D images, one file each)')
+    parser.add_argument('--n_frames', type = int, default = 0, help = 'Number of time frames of the study, 0 for until an END file \
+        appears in the folder (or --timeout)')
+    parser.add_argument('--poll', type = float, default = 0.2, help = 'Interval (s) between two scans of the watched folder')
+    parser.add_argument('--timeout', type = float, default = 0, help = 'Seconds without a new frame after which the study is complete, \
+        0 for waiting forever')
+    parser.add_argument('--output', type = str, default = '', help = 'Save folder, empty for the parent folder of --frames_dir')
+
+    return parser.parse_args(args)
+
+
+class FrameWatcher(object):
+    '''
+    Frame files of a folder in name order: a file is taken once its size is unchanged over one poll (files named .*
+    are skipped as being written), until n_frames are taken, an END file is written or nothing new comes within timeout
+    '''
+    def __init__(self, folder, n_frames = 0, poll = 0.2, timeout = 0):
+        self.folder = folder
+        self.n_frames = n_frames
+        self.poll = poll
+        self.timeout = timeout
+
+    def names(self):
+        return sorted(name for name in os.listdir(self.folder) if not name.startswith('.') and name != END \
+            and os.path.isfile(os.path.join(self.folder, name)))
+
+    def frames(self):
+        taken, sizes = set(), {}
+        last = time.perf_counter()
+        while True:
+            for name in self.names():
+                if name in taken:
+                    continue
+                size = os.path.getsize(os.path.join(self.folder, name))
+                if size == 0 or sizes.get(name) != size:
+                    sizes[name] = size
+                    break
+                taken.add(name)
+                last = time.perf_counter()
+                yield os.path.join(self.folder, name)
+                if len(taken) == self.n_frames:
+                    return
+            else:
+                if os.path.exists(os.path.join(self.folder, END)):
+                    return
+            if self.timeout > 0 and time.perf_counter() - last > self.timeout:
+                print('No new frame within %.1f s: study complete' % self.timeout)
+                return
+            time.sleep(self.poll)
+
+
+class StreamingStudy(object):
+    '''
+    Frames of a study added one by one: kept (signal_reader.FrameSource) for the final calculation, and preprocessed
+    as read_signal does and converted to CTC online (ctc.StreamingCTC)
+
+    The MRP brain region and the CTP brain mask are those of read_signal (both from the first time point); the CTP
+    normalization (mean/std of the clipped brain signal of all time points) can only be estimated from the first
+    time point, so that the online CTP CTC is scaled differently from the final one.
+    folder: folder of the frames; first: first frame (SimpleITK image)
+    '''
+    def __init__(self, folder, first, config, device):
+        import ParamsCalculator.ctc as ctc
+        from signal_reader import FrameSource, mrp_region, ctp_mask, ctp_statistics
+
+        self.config = config
+        self.source = FrameSource(folder, first)
+        frame = self.source.array[..., 0]
+        if config.image_type == 'MRP':
+            self.crop = mrp_region(self.source, config.mask[0])
+            background = 1
+        elif config.image_type == 'CTP':
+            if not len(config.mask) == 3:
+                raise ValueError('Mask list for CTP should have 3 sub-list element, got %s' % config.mask)
+            self.crop = [list(boundary) if len(boundary) else [0, frame.shape[i]] for i, boundary in enumerate(config.mask)]
+            first = self.cropped(frame)
+            self.mask = ctp_mask(first)
+            self.mean, self.std = ctp_statistics(lambda: [first[self.mask]], first.dtype, config.percentile_error)
+            background = 0
+        else:
+            raise ValueError('Unknown image type: %s' % config.image_type)
+        print('  Extracted brain region:', self.crop)
+        self.ctc = ctc.StreamingCTC(config, device, background)
+        self.curve = [] # online mean CTC over the brain, by time point
+        # CTC frames kept for the final calculation, if they may be those it would compute
+        self.keep = config.image_type == 'MRP' and not config.per_voxel_bat and not config.motion_correction
+        self.ctc_frames = []
+        self.ready = self.step(frame)
+
+    def cropped(self, frame):
+        return frame[self.crop[0][0] : self.crop[0][1], self.crop[1][0] : self.crop[1][1], self.crop[2][0] : self.crop[2][1]]
+
+    def preprocess(self, frame):
+        '''
+        Cropped and preprocessed frame as read_signal gives it (with the online CTP normalization) # (slice, row, column)
+        '''
+        import torch
+        from precision import numpy_dtype, storage_dtype
+        from signal_reader import correct_mrp, normalize_ctp
+
+        config = self.config
+        if config.image_type == 'MRP':
+            sig = correct_mrp(np.array(self.cropped(frame), dtype = None if self.source.raw else numpy_dtype(config.precision)))
+        else:
+            sig = (self.cropped(frame) * self.mask)[..., np.newaxis]
+            sig = normalize_ctp(sig, self.mask, self.mean, self.std, config.precision)[..., 0]
+        sig = torch.from_numpy(sig)
+        # Integer (raw) signals stay compact until converted to CTC (as MainCalculator.send_signal)
+        return sig.to(storage_dtype(config.precision)) if sig.is_floating_point() else sig
+
+    def step(self, frame):
+        ready = self.ctc.add(self.preprocess(frame))
+        self.record(ready)
+        return ready
+
+    def record(self, ready):
+        for t, values in ready:
+            self.curve.append(float(values[self.ctc.seen].float().mean()) if self.ctc.seen.any() else 0.)
+            if self.keep:
+                self.ctc_frames.append(values)
+
+    def add(self, frame):
+        '''
+        Add the next frame # (slice, row, column)
+        return: CTC frames made available by it, [(time point, CTC frame)]
+        '''
+        self.source.add(frame)
+        return self.step(frame)
+
+    def finish(self):
+        ready = self.ctc.finish()
+        self.record(ready)
+        return ready
+
+    def reusable(self):
+        '''
+        Whether the online mask, S0 and CTC are those of the final calculation: MRP (the online CTP normalization differs)
+        with the global bolus arrival time, found online as on the whole mean curve (the brain mask is final then)
+        '''
+        return self.keep and len(self.ctc_frames) == self.ctc.n_time and self.ctc.detect(final = True) == self.ctc.bat
+
+    def feed(self, calculator):
+        '''
+        Pass the brain mask, geometry, baseline and CTC computed online on to the final calculation
+        (main_calculator.MainCalculator), which then neither packs the signal nor converts it again
+        '''
+        import torch
+        import ParamsCalculator.ctc as ctc
+        from ParamsCalculator.mask import PackedVolume
+
+        mask = self.ctc.seen
+        frames, self.ctc_frames = self.ctc_frames, []
+        CTC = torch.stack([frame[mask] for frame in frames], dim = -1)
+        del frames
+        pipeline = calculator.pipeline
+        pipeline.put('mask', mask)
+        pipeline.put('geometry', (self.source.cropped_origin(self.crop), self.source.spacing, self.source.direction))
+        pipeline.put('shape', list(mask.shape) + [self.ctc.n_time])
+        pipeline.put('baseline', (self.ctc.s0[mask], ctc.arrival(self.ctc.bat, self.config)))
+        # As MainCalculator.cal_ctc: no NaN (nor Inf) value, in the same pass as its QC statistics
+        calculator.qc.scan('ctc', CTC, PackedVolume.layout(mask), fail = True)
+        pipeline.put('ctc', CTC)
+
+
+def run(folder, SaveFolder, config, device, logger, watcher = None):
+    '''
+    Calculate the study whose frames arrive in folder (see FrameWatcher), results saved under SaveFolder
+    return: streaming report
+    '''
+    import SimpleITK as sitk
+    from writer import ImageWriter
+    from instrument import Recorder
+    from main_calculator import MainCalculator
+    import ParamsCalculator.ctc as ctc
+
+    writer = ImageWriter.from_config(config)
+    recorder = Recorder.from_config(config, logger, device)
+    watcher = FrameWatcher(folder, config.n_frames, config.poll, config.timeout) if watcher is None else watcher
+    if config.tile_memory_budget > 0 or config.shard_workers > 0:
+        print('  Frames are kept in memory: tiling and sharding are not used by streaming calculations')
+
+    print('Watching %s for time frames ...' % folder)
+    study, arrived, emitted = None, [], {}
+    for FileName in watcher.frames():
+        image = sitk.ReadImage(FileName)
+        arrived.append(time.perf_counter())
+        if study is None:
+            study = StreamingStudy(folder, image, config, device)
+            ready = study.ready
+        else:
+            ready = study.add(sitk.GetArrayFromImage(image))
+        for t, _ in ready:
+            emitted[t] = time.perf_counter()
+        print('  Frame %d: %s, %d CTC frame(s) ready' % (len(arrived) - 1, os.path.basename(FileName), len(ready)))
+    if study is None:
+        raise ValueError('No time frame found in %s' % folder)
+    complete = time.perf_counter()
+    for t, _ in study.finish():
+        emitted[t] = time.perf_counter()
+
+    print('All %d frames in, calculating ...' % len(arrived))
+    calculator = MainCalculator.from_file(study.source, config, SaveFolder, device, logger, writer, None, recorder)
+    reused = study.reusable()
+    if reused:
+        print('  Online CTC used: bolus arrival time found online as on the whole mean curve')
+        study.feed(calculator)
+    calculator.run()
+    with recorder.stage('write_wait'):
+        writer.close()
+    recorder.save(os.path.join(SaveFolder, config.run_report), input = folder, config = vars(config))
+    recorder.close()
+
+    # Bolus arrival times from 0 (see ctc.arrival)
+    bat = calculator.pipeline.get('baseline')[1]
+    report = {'frames': len(arrived), 'bat_online': ctc.arrival(study.ctc.bat, config), 'bat_found_at': study.ctc.detected_at, \
+        'bat': None if config.per_voxel_bat else int(bat), 'ctc_reused': reused, 'mean_ctc_online': study.curve, \
+        'ctc_latency_s': [round(emitted[t] - arrived[t], 4) for t in range(len(arrived))], \
+        'maps_after_last_frame_s': round(time.perf_counter() - complete, 3)}
+    ReportName = os.path.join(SaveFolder, 'streaming_report.json')
+    with open(ReportName, 'w') as f:
+        json.dump(report, f, indent = 2)
+    print('Bolus arrival time (start from 0): %d online (found at time point %s), %s final' % \
+        (report['bat_online'], report['bat_found_at'], report['bat']))
+    print('Maps ready %.2f s after the last frame, save streaming report as: %s' % \
+        (report['maps_after_last_frame_s'], os.path.basename(ReportName)))
+    return report
+
+
+def main():
+
+    config = parse_streaming_config()
+    if not config.frames_dir:
+        raise ValueError('Give the folder of the time frames: --frames_dir')
+
+    import torch
+    from utils import get_logger
+
+    logger = get_logger('Perfusion Parameters Streaming Calculation')
+    logger.info(config)
+    device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+    folder = os.path.abspath(config.frames_dir).rstrip(os.sep)
+    SaveFolder = config.output or os.path.dirname(folder)
+    os.makedirs(SaveFolder, exist_ok = True)
+    run(folder, SaveFolder, config, device, logger)
+    return 0
+
+
+########################################################################################################################
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,28 @@
+import numpy as np
+import pytest
+import torch
+
+import phantom
+from config import parse_config
+from main_calculator import MainCalculator
+
+
+@pytest.mark.parametrize('image_type, dt, mask', [('CTP', 1.0, [[], [], []]), ('MRP', 1.55, [0])])
+@pytest.mark.parametrize('seed', [0, 1, 2])
+def test_automatic_aif_in_artery(tmp_path, image_type, dt, mask, seed):
+    '''
+    The automatically selected AIF voxels of a phantom, read from its image as a study, all fall in its artery
+    '''
+    shape = (4, 64, 64)
+    signal, _ = phantom.phantom(shape, 40, image_type, dt, seed = seed)
+    FileName = phantom.save(signal, str(tmp_path / 'phantom.nii'))
+    config = parse_config(['--image_type', image_type])
+    config.mask = mask
+    config.save_intermediates = 'none'
+    calculator = MainCalculator.from_file(FileName, config, str(tmp_path), torch.device('cpu'))
+    _, voxels = calculator.pipeline.get('aif')
+    # Voxels of the image cropped to the head (MRP): shifted back by the origin of the crop (x, y in mm)
+    origin, spacing = calculator.pipeline.get('geometry')[:2]
+    voxels = voxels.cpu().numpy() + [0, round(origin[1] / spacing[1]), round(origin[0] / spacing[0])]
+    assert len(voxels) > 0
+    assert np.all(phantom.labels(shape)[voxels[:, 0], voxels[:, 1], voxels[:, 2]] == phantom.ARTERY)
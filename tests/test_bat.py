@@ -0,0 +1,32 @@
+import numpy as np
+import pytest
+import torch
+
+import phantom
+from config import parse_config
+import ParamsCalculator.ctc as ctc
+import ParamsCalculator.modelfree as modelfree
+import ParamsCalculator.gammafit as gammafit
+
+
+@pytest.mark.parametrize('image_type, dt', [('CTP', 1.0), ('MRP', 1.55)])
+def test_global_and_per_voxel_bat_agree(image_type, dt):
+    '''
+    The global (mean curve) and per-voxel bolus arrival times give the same FMTT and initial gamma-variate t0
+    on a uniform phantom (all voxels of the noise-free tissue class 1), where both find the same arrival
+    '''
+    shape = (2, 32, 32)
+    signal, _ = phantom.phantom(shape, 40, image_type, dt, noise = 0.)
+    n_voxel = int(np.prod(shape))
+    uniform = torch.from_numpy(np.repeat(signal[phantom.labels(shape) == 1][:1], n_voxel, axis = 0)) # (n_voxel, time)
+    fmtt, t0 = [], []
+    for per_voxel_bat in [False, True]:
+        config = parse_config(['--image_type', image_type])
+        config.per_voxel_bat = per_voxel_bat
+        s0, bat = ctc.baseline(uniform, config, torch.device('cpu'))
+        fn = ctc.ct_conversion(config) if image_type == 'CTP' else ctc.mr_conversion(config)
+        curves = fn(uniform.to(s0.dtype), s0.unsqueeze(-1))
+        fmtt.append(modelfree.summarize(curves, dt, bat)[3])
+        t0.append(gammafit.initialize(curves, dt, bat)[:, 1])
+    torch.testing.assert_close(fmtt[0], fmtt[1])
+    torch.testing.assert_close(t0[0], t0[1])
@@ -0,0 +1,22 @@
+import numpy as np
+import pytest
+import torch
+
+import phantom
+import ParamsCalculator.deconv as deconv
+
+
+def block_circulant_tmax(delay, dt = 1.0, n_frames = 40):
+    t = np.arange(n_frames) * dt
+    aif = phantom.gamma_variate(t, t0 = 8., peak = 300.)
+    curve = np.interp(t - delay, t, phantom.tissue_curve(aif, dt, 60., 4., 0.), left = 0., right = 0.)
+    return deconv.deconvolve(torch.tensor(curve).float().unsqueeze(0), torch.tensor(aif).float(), dt, block_circulant = True)[3].item()
+
+
+@pytest.mark.parametrize('delay', [-4., -1., 3.])
+def test_block_circulant_tmax_follows_delay(delay):
+    '''
+    Block-circulant Tmax shifts with the delay of the tissue curve behind the AIF, and is negative when it leads the AIF
+    (its residue peak wrapped into the second half)
+    '''
+    assert block_circulant_tmax(delay) - block_circulant_tmax(0.) == pytest.approx(delay)
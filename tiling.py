@@ -0,0 +1,305 @@
+import os
+import tempfile
+import numpy as np
+import torch
+from collections import namedtuple
+
+import precision
+from qc import QCReport
+from signal_reader import SlabReader
+from main_calculator import MainCalculator
+import ParamsCalculator.ctc as ctc
+import ParamsCalculator.mask as mask
+import ParamsCalculator.aif as aif
+import ParamsCalculator.deconv as deconv
+import ParamsCalculator.modelfree as modelfree
+import ParamsCalculator.gammafit as gammafit
+from ParamsCalculator.mask import PackedVolume
+
+'''
+Tiled execution within a memory budget: the study is processed in slabs of slices (tiles), streamed from the
+image file through the stage chain, and the results are stitched back into whole maps
+
+Per-voxel stages work on the curves of their tile only; the few global quantities (CTP normalization statistics,
+the mean curve for the bolus arrival time, the AIF) are reduced from per-tile partial results. All voxel-parallel
+computations are done on slice-aligned chunks (see PackedVolume.chunks), which are the same whether a slice is
+processed in a tile or with the whole volume, so that tiled results are bit-identical to untiled ones.
+
+The work on a tile is done by the *_step functions, which get all they need as arguments (signal source,
+CTC store, tile), so that they also run in worker processes (see sharding.py).
+'''
+
+# Tile of slices: results are kept for [start, stop), computed from [read_start, read_stop) including the halo
+Tile = namedtuple('Tile', ['start', 'stop', 'read_start', 'read_stop'])
+
+# Copies of a slice's signal alive at once within a tile: the signal on the device and packed, its CTC
+# (and filtered CTC), a compute-precision copy for the AIF features and temporaries of the stages
+SLICE_COPIES = 6
+
+
+def slice_bytes(shape, raw_dtype, config):
+    '''
+    Estimated peak memory of one slice (row, column, time) of a tile through the stage chain
+    '''
+    itemsize = max(torch.finfo(precision.storage_dtype(config.precision)).bits, torch.finfo(precision.compute_dtype(config.precision)).bits) // 8
+    return int(np.prod(shape[1:])) * (np.dtype(raw_dtype).itemsize + SLICE_COPIES * itemsize)
+
+
+def split(n_slices, n_tile, halo = 0):
+    '''
+    Tiles of n_tile slices (the last one may be smaller), with halo slices read on both sides (within the volume)
+    '''
+    return [Tile(start, min(start + n_tile, n_slices), max(start - halo, 0), min(start + n_tile + halo, n_slices)) \
+        for start in range(0, n_slices, n_tile)]
+
+
+def plan_tiles(n_slices, slice_bytes, budget_mb, halo = 0):
+    '''
+    Split n_slices into tiles of as many slices (and their halo for stages needing spatial context) as fit into budget_mb,
+    at least one slice
+    '''
+    return split(n_slices, max(int(budget_mb * 1024 ** 2 // max(slice_bytes, 1)) - 2 * halo, 1), halo)
+
+
+class CurveStore(object):
+    '''
+    Packed CTC (n_voxel, time) kept outside the device memory, curves read back as needed
+    array: numpy array (n_voxel, time) of integers as wide as dtype (numpy has no bfloat16), e.g., a temporary
+           file (see spill) or shared memory (see sharding.py)
+    '''
+    def __init__(self, array, dtype, compute_dtype, device, filename = None):
+        self.array = array
+        self.dtype, self.compute_dtype, self.device = dtype, compute_dtype, device
+        self.filename = filename
+
+    @classmethod
+    def spill(cls, n_voxel, n_t, dtype, compute_dtype, directory, device):
+        '''
+        Store in a temporary file in directory, removed when closed
+        '''
+        handle, FileName = tempfile.mkstemp(prefix = '.ctc_', suffix = '.raw', dir = directory)
+        os.close(handle)
+        array = np.memmap(FileName, dtype = 'i%d' % (torch.finfo(dtype).bits // 8), mode = 'w+', shape = (max(n_voxel, 1), n_t))
+        return cls(array, dtype, compute_dtype, device, FileName)
+
+    @property
+    def curves(self):
+        return torch.from_numpy(np.asarray(self.array)).view(self.dtype)
+
+    def write(self, start, values):
+        self.curves[start : start + values.size(0)] = values.cpu()
+
+    def read(self, start, stop):
+        return self.curves[start : stop].to(self.device)
+
+    def __getitem__(self, rows):
+        return self.curves[torch.as_tensor(rows).cpu()].to(self.device).to(self.compute_dtype)
+
+    def close(self):
+        self.array = None
+        if self.filename is not None and os.path.exists(self.filename):
+            os.remove(self.filename)
+
+
+def load_tile(source, tile, config, device):
+    '''
+    Preprocessed signal of the tile (source.read of its slices) on the device, packed on its brain mask
+    return: packed signal (n_voxel, time), mask.PackedVolume layout of the tile
+    '''
+    signal = torch.as_tensor(source.read(tile.read_start, tile.read_stop))
+    # Integer (raw) signals stay compact until converted to CTC (as MainCalculator.send_signal)
+    if signal.is_floating_point():
+        signal = signal.to(precision.storage_dtype(config.precision))
+    signal = signal.to(device)
+    Mask = mask.cal(signal, config, device)
+    # Halo slices only give context to the stages above
+    keep = slice(tile.start - tile.read_start, tile.stop - tile.read_start)
+    packed = PackedVolume.pack(signal[keep], Mask[keep])
+    return packed.values, PackedVolume.layout(Mask[keep])
+
+
+def baseline_step(source, tile, config, device):
+    '''
+    Pass 1 on a tile: its brain voxels, and the partial sums of the mean curve (chunk by chunk of slices)
+    return: flat indices of the brain voxels in the tile, sums # (n_chunk, time) or None for per-voxel baselines
+    '''
+    signal, layout = load_tile(source, tile, config, device)
+    if config.per_voxel_bat:
+        return layout.index, None
+    return layout.index, ctc.time_sums(signal, precision.compute_dtype(config.precision), layout.chunks())
+
+
+def ctc_step(source, store, offset, tile, bat, config, device):
+    '''
+    Pass 2 on a tile: its CTC (written to store from row offset) and all results needing no AIF
+    bat: bolus arrival time of the mean curve as the number of time points averaged for S0 (see ctc.mean_bat),
+         None for per-voxel baselines
+    return: BAT/S0 maps (per-voxel baselines), model-free maps, gamma-variate maps, AIF features (automatic AIF, else None),
+            qc.QCReport of the tile's CTC
+    '''
+    dtype = precision.compute_dtype(config.precision)
+    report = QCReport(tile.start, config.qc_saturation)
+    signal, layout = load_tile(source, tile, config, device)
+    baseline_maps, free_maps, gamma_maps, features = {}, {}, {}, None
+    if config.per_voxel_bat:
+        s0, bat = ctc.voxel_s0(signal, config, device)
+        baseline_maps = {'BAT': layout.unpack(bat.int()), 'S0': layout.unpack(s0)}
+    else:
+        s0 = torch.mean(signal[..., :bat], dim = -1, dtype = dtype) # as ctp_s0/mrp_s0
+        bat = ctc.arrival(bat, config) # as ctc.baseline
+    CTC = ctc.compute(signal, config, device, s0, layout, report)
+    del signal, s0
+    if config.use_filter:
+        CTC = ctc.medfilt(CTC, config.filter_kernel_size, config.filter_threads, config.ctc_memory_budget)
+        report.scan('ctc_filtered', CTC, layout)
+    store.write(offset, CTC)
+    if config.model_free:
+        free_maps = modelfree.cal(CTC, bat, config, device, layout)
+    if config.gamma_fit:
+        gamma_maps = gammafit.cal(CTC, bat, config, device, layout)
+    if len(config.aif_voxels) == 0:
+        features = aif.chunked_features(CTC.to(dtype), layout.chunks())
+    return baseline_maps, free_maps, gamma_maps, features, report
+
+
+def deconv_step(store, offset, tile, index, shape, AIF, config, device):
+    '''
+    Pass 3 on a tile: deconvolution of its stored CTC (rows from offset) with the AIF
+    index: flat indices of the brain voxels in the tile (see baseline_step); shape: [n_row, n_column]
+    return: CBF/CBV/MTT/Tmax maps
+    '''
+    layout = PackedVolume(None, index, [tile.stop - tile.start] + list(shape))
+    return deconv.cal(store.read(offset, offset + index.numel()), AIF, config, device, layout)
+
+
+class TiledCalculator(MainCalculator):
+    """Calculator processing a study tile by tile of slices within config.tile_memory_budget (MB).
+    Three passes over the tiles: the baseline (mean curve), then the CTC with all per-voxel maps and the AIF
+    features (the CTC is spilled to a temporary file in save_path), then the deconvolution after the AIF is chosen.
+    No stage cache, intermediate 4D images, accuracy report nor motion correction: they would need the whole study at once.
+    """
+    # Slices on both sides of a tile needed by its stages: none so far, brain masks are found slice by slice
+    # and the CTP hole filling is done once on the first time point of the whole image (see SlabReader)
+    halo = 0
+
+    def __init__(self, FileName, config, save_path, device, logger = None, writer = None, recorder = None):
+        super().__init__(None, None, None, None, config, save_path, device, logger, writer, None, None, recorder)
+        self.filename = FileName
+        self.shape = None
+        self.geometry = None
+
+    @classmethod
+    def from_file(cls, FileName, config, save_path, device, logger = None, writer = None, cache = None, recorder = None):
+        if cache is not None:
+            print('  %s: stage cache not used' % cls.__name__)
+        return cls(FileName, config, save_path, device, logger, writer, recorder)
+
+    @property
+    def sitkinfo(self):
+        return list(self.geometry) + [self.save_path]
+
+    @property
+    def size(self):
+        return list(self.shape)
+
+    def open(self):
+        '''
+        Source of the preprocessed signal (read(start, stop) of slices), setting the shape and geometry of the study
+        '''
+        reader = SlabReader(self.filename, self.config.image_type, self.config.mask, self.config.precision, \
+            self.config.percentile_error, self.config.dicom_threads)
+        self.shape, self.geometry = reader.shape, reader.geometry
+        self.raw_dtype = reader.src.array.dtype
+        print('  Intermediate 4D images and the accuracy report are not saved by %s' % type(self).__name__)
+        if self.config.motion_correction:
+            print('  Motion correction is not applied by %s: it needs all slices of the study at once' % type(self).__name__)
+        return reader
+
+    def plan(self):
+        # The images pending in the writer queue (stitched maps) are kept within the budget too
+        budget = self.config.tile_memory_budget - self.writer.queue_memory
+        tiles = plan_tiles(self.nS, slice_bytes(self.size, self.raw_dtype, self.config), budget, self.halo)
+        print('Tiled execution: %d slices in %d tile(s) of at most %d slices (budget %.0f MB, %.0f MB of it for the writer queue)' % \
+            (self.nS, len(tiles), max(tile.stop - tile.start for tile in tiles), self.config.tile_memory_budget, self.writer.queue_memory))
+        return tiles
+
+    def store(self, n_voxel):
+        return CurveStore.spill(n_voxel, self.nT, precision.storage_dtype(self.config.precision), \
+            precision.compute_dtype(self.config.precision), self.save_path, self.device)
+
+    def map(self, name, step, tiles, jobs):
+        '''
+        Results of step(*job) for the tiles in order, one tile after another
+        '''
+        results = []
+        for i, (tile, job) in enumerate(zip(tiles, jobs)):
+            print('Tile %d/%d: slices [%d, %d)' % (i + 1, len(tiles), tile.start, tile.stop))
+            with self.recorder.stage(name, (tile.stop - tile.start) * self.nR * self.nC):
+                results.append(step(*job))
+        return results
+
+    def stitch(self, tiles, tile_maps):
+        '''
+        Whole maps (on the CPU) from the maps (slice, row, column) of the tiles
+        '''
+        maps = {}
+        for tile, values in zip(tiles, tile_maps):
+            for name, value in values.items():
+                if name not in maps:
+                    maps[name] = torch.zeros([self.nS] + list(value.shape[1:]), dtype = value.dtype)
+                maps[name][tile.start : tile.stop] = value.cpu()
+        return maps
+
+    def main_cal(self):
+        config = self.config
+        with self.recorder.stage('read_signal/prepare'):
+            source = self.open()
+        tiles = self.plan()
+
+        # Pass 1: brain voxels and the bolus arrival time of the mean curve
+        results = self.map('tile/baseline', baseline_step, tiles, [(source, tile, config, self.device) for tile in tiles])
+        indices = [index for index, _ in results]
+        offsets = np.cumsum([0] + [index.numel() for index in indices]).tolist()
+        # Layout of the whole volume, for the manually picked AIF voxels
+        volume = PackedVolume(None, torch.cat([index.cpu() + tile.start * self.nR * self.nC \
+            for tile, index in zip(tiles, indices)]), [self.nS, self.nR, self.nC])
+        bat = None
+        if not config.per_voxel_bat:
+            bat = ctc.mean_bat(torch.cat([sums for _, sums in results]).sum(dim = 0) / offsets[-1], config)
+
+        # Pass 2: CTC and the maps needing no AIF; the CTC is kept in the store for the AIF and the deconvolution
+        store = self.store(offsets[-1])
+        try:
+            results = self.map('tile/ctc', ctc_step, tiles, [(source, store, offsets[i], tile, bat, config, self.device) \
+                for i, tile in enumerate(tiles)])
+            for result in results:
+                self.qc.merge(result[4])
+            for i, name in enumerate(['save_baseline', 'save_model_free', 'save_gamma_fit']):
+                maps = self.stitch(tiles, [result[i] for result in results])
+                if maps:
+                    with self.recorder.stage(name):
+                        self.save_maps(maps)
+
+            # AIF from the features of all voxels and the curves of the candidates only
+            with self.recorder.stage('aif'):
+                print('Extracting AIF ...')
+                if len(config.aif_voxels) > 0:
+                    aif_curve, rows = aif.manual(store, volume, config.aif_voxels)
+                    print('  AIF from %d manually picked voxels' % len(rows))
+                else:
+                    features = tuple(torch.cat(values) for values in zip(*[result[3] for result in results]))
+                    candidates = aif.select(features, config.aif_peak_fraction, config.aif_candidates)
+                    aif_curve, rows = aif.cluster(store[candidates], candidates, features, config.aif_clusters)
+                    print('  AIF from %d automatically selected voxels' % len(rows))
+                AIF = (aif_curve, volume.voxels(rows))
+                print('  AIF peak at time point %d' % int(torch.argmax(aif_curve)))
+            with self.recorder.stage('save_aif'):
+                self.save_aif(AIF)
+
+            # Pass 3: deconvolution of the stored CTC
+            results = self.map('tile/deconv', deconv_step, tiles, [(store, offsets[i], tile, indices[i], self.size[1:3], AIF[0], \
+                config, self.device) for i, tile in enumerate(tiles)])
+            with self.recorder.stage('save_maps'):
+                self.save_maps(self.stitch(tiles, results))
+        finally:
+            store.close()
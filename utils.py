@@ -3,6 +3,8 @@ import sys
 import torch
 import shutil
 import logging
+import resource
+import tracemalloc
 import numpy as np
 
 
@@ -10,6 +12,8 @@ def get_logger(name, level = logging.INFO):
 
     logger = logging.getLogger(name)
     logger.setLevel(level)
+    if logger.handlers: # already set up, e.g., by a previous study in the same process
+        return logger
 
     # Logging to console
     stream_handler = logging.StreamHandler(sys.stdout)
@@ -56,17 +60,103 @@ def save_checkpoint(state, is_best, checkpoint_dir, logger=None):
         shutil.copyfile(last_file_path, best_file_path)
 
 
-def cutoff_percentile(image, mask = None, percentile_lower = 0.2, percentile_upper = 99.8):
+class StreamingHistogram(object):
+    '''
+    Histogram of values added chunk by chunk, giving percentiles and percentile-clipped mean/std without any sort
+    integer: one bin per integer in [low, high] (8/16-bit signals), percentiles and moments are then exact,
+             else n_bins bins of width (high - low) / n_bins, percentiles are within one bin width
+    '''
+    def __init__(self, low, high, n_bins = 10000, integer = False):
+        self.integer = integer
+        self.low = float(low)
+        self.n_bins = int(high - low + 1) if integer else max(int(n_bins), 1)
+        self.width = 1. if integer else max(float(high) - float(low), np.finfo(np.float64).tiny) / self.n_bins
+        self.counts = np.zeros(self.n_bins, dtype = np.int64)
+        # Integer bins hold a single value each, their sums follow from the counts
+        self.sums = None if integer else np.zeros(self.n_bins)
+        self.squares = None if integer else np.zeros(self.n_bins)
+
+    @classmethod
+    def from_chunks(cls, chunks, dtype, error = 1e-4):
+        '''
+        Histogram of all values of chunks: a function returning an iterator over the value arrays (of dtype),
+        bin width error * range for float values
+        '''
+        if dtype.kind in 'iu' and dtype.itemsize <= 2:
+            info = np.iinfo(dtype)
+            histogram = cls(info.min, info.max, integer = True)
+        else:
+            # Float values: the range takes one more (min/max only) pass
+            ranges = [(chunk.min(), chunk.max()) for chunk in chunks() if chunk.size]
+            histogram = cls(min(r[0] for r in ranges), max(r[1] for r in ranges), n_bins = np.ceil(1. / error))
+        for chunk in chunks():
+            histogram.add(chunk)
+        return histogram
+
+    def add(self, values):
+        values = values.ravel()
+        if self.integer:
+            self.counts += np.bincount((values.astype(np.int64) - int(self.low)), minlength = self.n_bins)
+            return
+        index = np.clip(((values - self.low) / self.width).astype(np.int64), 0, self.n_bins - 1)
+        values = values.astype(np.float64)
+        self.counts  += np.bincount(index, minlength = self.n_bins)
+        self.sums    += np.bincount(index, weights = values, minlength = self.n_bins)
+        self.squares += np.bincount(index, weights = values * values, minlength = self.n_bins)
+
+    def value(self, rank):
+        '''
+        Value of the (0-based) rank-th smallest value, within its bin assuming evenly spread values
+        '''
+        cumulative = np.cumsum(self.counts)
+        bins = np.searchsorted(cumulative, rank, side = 'right')
+        if self.integer:
+            return self.low + bins
+        before = cumulative[bins] - self.counts[bins]
+        return self.low + (bins + (rank - before + 0.5) / self.counts[bins]) * self.width
+
+    def percentile(self, q):
+        '''
+        Same definition (linear interpolation between ranks) as np.percentile
+        '''
+        rank = np.asarray(q, dtype = np.float64) / 100. * (self.counts.sum() - 1)
+        lower = np.floor(rank)
+        return self.value(lower) + (rank - lower) * (self.value(np.ceil(rank)) - self.value(lower))
+
+    def clipped_moments(self, lower, upper):
+        '''
+        Mean and population std of the values clipped within [lower, upper]
+        (bins straddling lower/upper contribute their clipped mean)
+        '''
+        edges = self.low + np.arange(self.n_bins) * self.width
+        if self.integer:
+            sums = self.counts * edges
+            squares = sums * edges
+            inside = (edges >= lower) & (edges <= upper)
+        else:
+            sums, squares = self.sums, self.squares
+            inside = (edges >= lower) & (edges + self.width <= upper)
+        clipped = np.clip(sums / np.maximum(self.counts, 1), lower, upper)
+        total = np.where(inside, sums, self.counts * clipped).sum()
+        square = np.where(inside, squares, self.counts * clipped ** 2).sum()
+        n = self.counts.sum()
+        mean = total / n
+        return mean, np.sqrt(max(square / n - mean ** 2, 0.))
+
+
+def cutoff_percentile(image, mask = None, percentile_lower = 0.2, percentile_upper = 99.8, percentile_error = 1e-4):
 	
 	if mask is None:
 		mask = image != image[0, 0, 0]
-	cut_off_lower = np.percentile(image[mask != 0].ravel(), percentile_lower)
-	cut_off_upper = np.percentile(image[mask != 0].ravel(), percentile_upper)
+	# Percentiles from one histogram pass over the slices (see StreamingHistogram)
+	chunks = lambda: (slab[slab_mask != 0] for slab, slab_mask in zip(image, mask))
+	histogram = StreamingHistogram.from_chunks(chunks, image.dtype, percentile_error)
+	cut_off_lower, cut_off_upper = histogram.percentile([percentile_lower, percentile_upper])
 	print('Clip within [%.3f, %.3f]' % (cut_off_lower, cut_off_upper))
 
 	res = np.copy(image)
-	res[(res < cut_off_lower) & (mask != 0)] = cut_off_lower
-	res[(res > cut_off_upper) & (mask != 0)] = cut_off_upper
+	for slab, slab_mask in zip(res, mask):
+		slab[slab_mask != 0] = np.clip(slab[slab_mask != 0], cut_off_lower, cut_off_upper)
 
 	return res
 
@@ -94,3 +184,26 @@ def load_checkpoint(checkpoint_path, model, optimizer = None):
         optimizer.load_state_dict(state['optimizer_state_dict'])
 
     return state
+
+
+class PeakMemory(object):
+    '''
+    Context manager tracking the peak memory used within its scope
+    peak: peak bytes allocated through Python/NumPy (tracemalloc) above the entry level
+    rss:  peak resident set size of the whole process (bytes)
+    '''
+    def __enter__(self):
+        self.started = not tracemalloc.is_tracing()
+        if self.started:
+            tracemalloc.start()
+        else:
+            tracemalloc.reset_peak()
+        self.base = tracemalloc.get_traced_memory()[0]
+        return self
+
+    def __exit__(self, *args):
+        self.peak = tracemalloc.get_traced_memory()[1] - self.base
+        if self.started:
+            tracemalloc.stop()
+        self.rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        return False
@@ -0,0 +1,144 @@
+import threading
+import SimpleITK as sitk
+from concurrent.futures import ThreadPoolExecutor
+
+from chunkstore import ChunkStore, CHUNKS
+
+# Intermediate outputs which could be individually selected/disabled
+INTERMEDIATES = ['resized', 'masked', 'normalized', 'corrected', 'ctc', 'ctc_filtered']
+# Those written while the signal is read and preprocessed (see signal_reader.py)
+READ_INTERMEDIATES = ['resized', 'masked', 'normalized', 'corrected']
+
+
+class ImageWriter(object):
+    '''
+    Write images (numpy arrays of size (slice, row, column[, time])) in the background
+
+    intermediates: names of the intermediate outputs to be written, others are skipped
+    n_threads: writing threads, 0 for synchronous writing
+    queue_size: maximum number of pending images, further writes block until one is done
+    queue_memory: maximum memory (MB) of the pending images (their copies, or the arrays kept alive until written),
+                  further writes block until there is room, 0 for no limit but queue_size
+    ext: '.nii' or '.nii.gz'
+    compression_level: compression level for '.nii.gz', -1 for the ITK default
+    stores: names of the intermediate outputs also saved as chunked compressed stores (see chunkstore.py)
+    chunks: chunk shape (slice, row, column, time) of the stores
+    store_level: zlib compression level of the stores
+    '''
+    def __init__(self, intermediates = INTERMEDIATES, n_threads = 0, queue_size = 4, ext = '.nii', compression_level = -1, \
+        stores = [], chunks = CHUNKS, store_level = 1, queue_memory = 0):
+        self.intermediates = list(intermediates)
+        self.stores = list(stores)
+        self.chunks = tuple(chunks)
+        self.store_level = store_level
+        self.ext = ext
+        self.compression_level = compression_level
+        self.pool = ThreadPoolExecutor(max_workers = n_threads, thread_name_prefix = 'ImageWriter') if n_threads > 0 else None
+        self.slots = threading.BoundedSemaphore(max(queue_size, 1))
+        self.queue_memory = queue_memory
+        self.pending = 0 # bytes of the pending images
+        self.room = threading.Condition()
+        self.futures = []
+
+    @staticmethod
+    def names(selection):
+        names = [name.strip() for name in selection.split(',') if name.strip() not in ['', 'none']]
+        for name in names:
+            if name not in INTERMEDIATES:
+                raise ValueError('Unknown intermediate output: %s (choose from %s)' % (name, ', '.join(INTERMEDIATES)))
+        return names
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(cls.names(config.save_intermediates), config.writer_threads, config.writer_queue_size, config.output_ext, \
+            config.compression_level, cls.names(config.chunk_store), config.chunk_shape, config.chunk_compression, \
+            config.writer_queue_memory)
+
+    def enabled(self, name):
+        return name is None or name in self.intermediates
+
+    def stored(self, name):
+        return name in self.stores
+
+    def store(self, name, BaseName, shape, dtype, origin, spacing, direction):
+        '''
+        New chunked store BaseName.chunks of shape (slice, row, column, time), to be written slab by slab by the caller
+        (and closed once all slices are written), if name is selected for stores
+        return: chunkstore.ChunkStore, None if skipped
+        '''
+        if not self.stored(name):
+            return None
+        attrs = {'origin': list(origin), 'spacing': list(spacing), 'direction': list(direction)}
+        return ChunkStore.create(BaseName + '.chunks', shape, dtype, self.chunks, self.store_level, attrs)
+
+    def write(self, name, nda, BaseName, origin, spacing, direction, snapshot = True):
+        '''
+        Write nda as BaseName + ext, if name is None (final output) or selected as intermediate
+        snapshot: copy nda before returning, False (no copy, nda is kept until written) if nda is not modified afterwards
+        return: full file name, None if skipped
+        '''
+        if not self.enabled(name):
+            return None
+        FileName = BaseName + self.ext
+        if self.pool is None:
+            self.save(nda, FileName, origin, spacing, direction)
+            return FileName
+        # Room in the queue first, so that the copy is not made beyond the queue memory
+        self.slots.acquire()
+        self.reserve(nda.nbytes)
+        try:
+            # GetImageFromArray copies the array, which is then safe to be modified by the caller
+            image = self.to_image(nda, origin, spacing, direction) if snapshot else nda
+            future = self.pool.submit(self.save, image, FileName, origin, spacing, direction)
+        except BaseException:
+            self.done(nda.nbytes)
+            raise
+        future.add_done_callback(lambda _, nbytes = nda.nbytes: self.done(nbytes))
+        self.futures.append(future)
+        return FileName
+
+    def reserve(self, nbytes):
+        '''
+        Wait until nbytes more of pending images fit into queue_memory (a larger image waits for an empty queue)
+        '''
+        with self.room:
+            while self.queue_memory > 0 and self.pending > 0 and self.pending + nbytes > self.queue_memory * 1024 ** 2:
+                self.room.wait()
+            self.pending += nbytes
+
+    def done(self, nbytes):
+        with self.room:
+            self.pending -= nbytes
+            self.room.notify_all()
+        self.slots.release()
+
+    def to_image(self, nda, origin, spacing, direction):
+        img = sitk.GetImageFromArray(nda, isVector = nda.ndim == 4)
+        img.SetOrigin(origin)
+        img.SetSpacing(spacing)
+        img.SetDirection(direction)
+        return img
+
+    def save(self, img, FileName, origin, spacing, direction):
+        if not isinstance(img, sitk.Image):
+            img = self.to_image(img, origin, spacing, direction)
+        writer = sitk.ImageFileWriter()
+        writer.SetFileName(FileName)
+        if FileName.endswith('.gz'):
+            writer.SetUseCompression(True)
+            if self.compression_level >= 0:
+                writer.SetCompressionLevel(self.compression_level)
+        writer.Execute(img)
+
+    def wait(self):
+        '''
+        Block until all pending images are written, re-raise the first writing error
+        '''
+        futures, self.futures = self.futures, []
+        for future in futures:
+            future.result()
+
+    def close(self):
+        self.wait()
+        if self.pool is not None:
+            self.pool.shutdown()